@@ -0,0 +1,138 @@
+"""
+Headless benchmark of the simulation loop.
+
+Loads each map into a ServerWorld (no window, no audio), drops in a number of scripted walkers that walk, turn, and
+fire plasma, missiles, and grenades on a fixed schedule, then steps the world a fixed number of ticks with a fixed
+random seed. For each map it reports ticks per second, p50/p99 tick times, how many Python objects the run left
+allocated, and peak memory, and appends the results (tagged with the current commit) to a JSON lines file so runs
+can be compared across commits.
+
+    python benchmark.py [--ticks N] [--walkers N] [--seed N] [--output FILE] [Maps/foo.xml ...]
+"""
+import argparse
+import gc
+import glob
+import json
+import random
+import resource
+import subprocess
+import time
+from timeit import default_timer
+from panda3d.core import loadPrcFile, loadPrcFileData
+
+# Walker commands, in the order each walker cycles through them. Every entry is run on a tick where the walker is
+# due to act; 'missile' and 'grenade' only load a weapon, so the following 'fire' launches it.
+SCRIPT = (
+    ('forward', True),
+    ('fire', True),
+    ('left', True),
+    ('missile', True),
+    ('fire', True),
+    ('left', False),
+    ('grenade_fire', True),
+    ('forward', False),
+    ('right', True),
+    ('fire', True),
+    ('right', False),
+    ('crouch', True),
+    ('crouch', False),
+)
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run_map(path, args):
+    from pavara.world import ServerWorld
+    from pavara.walker import Walker
+    from pavara.maps import load_maps
+    from pavara.simulation import Simulation
+
+    random.seed(args.seed)
+    world = ServerWorld()
+    start = default_timer()
+    load_maps(path, world, use_cache=not args.no_cache)
+    load_time = default_timer() - start
+    if not world.incarnators:
+        print '%s: no incarnators, skipping' % path
+        world.scene.remove_node()
+        return None
+
+    walkers = [world.attach(Walker(world.incarnators[i % len(world.incarnators)])) for i in xrange(args.walkers)]
+    sim = Simulation(world)
+
+    # Let everything settle (walkers landing, free solids falling) before measuring.
+    for i in xrange(args.warmup):
+        sim.step()
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    times = []
+    for tick in xrange(args.ticks):
+        if tick % args.fire_interval == 0:
+            step = tick // args.fire_interval
+            for i, walker in enumerate(walkers):
+                walker.handle_command(*SCRIPT[(step + i) % len(SCRIPT)])
+        start = default_timer()
+        sim.step()
+        times.append(default_timer() - start)
+    gc.collect()
+    objects_after = len(gc.get_objects())
+
+    total = sum(times)
+    ordered = sorted(times)
+    result = {
+        'map': path,
+        'ticks': args.ticks,
+        'walkers': args.walkers,
+        'seed': args.seed,
+        'load_seconds': load_time,
+        'ticks_per_second': args.ticks / total if total else None,
+        'tick_ms_p50': percentile(ordered, 0.5) * 1000.0,
+        'tick_ms_p99': percentile(ordered, 0.99) * 1000.0,
+        'tick_ms_max': ordered[-1] * 1000.0,
+        'objects': len(world.objects),
+        'gc_objects_delta': objects_after - objects_before,
+        # Kilobytes on Linux; this is the peak for the whole process so far, so later maps include earlier ones.
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    world.scene.remove_node()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless benchmark of the simulation loop.')
+    parser.add_argument('maps', nargs='*', help='map files to run (default: every map in Maps/)')
+    parser.add_argument('--ticks', type=int, default=1200)
+    parser.add_argument('--warmup', type=int, default=60)
+    parser.add_argument('--walkers', type=int, default=8)
+    parser.add_argument('--fire-interval', type=int, default=15, help='ticks between scripted walker commands')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-cache', action='store_true', help='build maps from XML instead of their caches')
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    args = parser.parse_args()
+
+    loadPrcFile('panda_config.prc')
+    loadPrcFileData('benchmark', 'window-type none\naudio-library-name null\n')
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+
+    commit = current_commit()
+    results = []
+    for path in args.maps or sorted(glob.glob('Maps/*.xml')):
+        result = run_map(path, args)
+        if result:
+            result['commit'] = commit
+            result['time'] = time.time()
+            results.append(result)
+            print '%(map)s: %(ticks_per_second).1f ticks/s, p50 %(tick_ms_p50).2fms, p99 %(tick_ms_p99).2fms, %(gc_objects_delta)+d objects, %(max_rss)d KB peak' % result
+    with open(args.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+
+if __name__ == '__main__':
+    main()
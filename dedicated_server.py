@@ -0,0 +1,22 @@
+"""
+Dedicated server: runs several matches at once, one worker process per match, behind a single UDP port.
+
+    python dedicated_server.py [--port N] [--matches N] [--max-players N] Maps/foo.xml [Maps/bar.xml ...]
+
+With more matches than maps, the maps are used in turn.
+"""
+import argparse
+from pavara.constants import TCP_PORT, MAX_MATCH_PLAYERS
+from pavara.dedicated import DedicatedServer
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several matches behind one UDP port.')
+    parser.add_argument('maps', nargs='+', help='map files to run')
+    parser.add_argument('--port', type=int, default=TCP_PORT)
+    parser.add_argument('--matches', type=int, help='number of matches (default: one per map)')
+    parser.add_argument('--max-players', type=int, default=MAX_MATCH_PLAYERS)
+    args = parser.parse_args()
+    DedicatedServer(args.maps, args.port, args.matches, args.max_players).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,25 @@
 from pavara.constants import *
 from panda3d.core import GeomNode, NodePath
-from pavara.utils.geom import GeomBuilder
+from pavara.utils.geom import ArrayGeomBuilder
 from panda3d.bullet import BulletRigidBodyNode, BulletManifoldPoint
 
 class WorldObject (object):
     """
-    Base class for anything attached to a World.
+    Base class for anything attached to a World. The base classes (and the short-lived projectiles) use __slots__,
+    so subclasses that are created often can stay compact by declaring their own; others simply get a __dict__.
+    Per-class constants like collide_bits stay class attributes.
     """
 
-    world = None
+    __slots__ = ('name', 'world', 'net_id')
+
     last_unique_id = 0
     collide_bits = NO_COLLISION_BITS
+    # What kind of thing this object's solid is, as CATEGORY_* flags (see constants).
+    category = CATEGORY_NONE
 
     def __init__(self, name=None):
+        self.world = None
+        self.net_id = None
         self.name = name
         if not self.name:
             self.name = '%s:%d' % (self.__class__.__name__, self.__class__.last_unique_id)
@@ -44,10 +51,17 @@ class PhysicalObject (WorldObject):
     solid for physics collisions.
     """
 
-    node = None
-    solid = None
+    __slots__ = ('node', 'solid', 'moved')
+
     collide_bits = MAP_COLLIDE_BIT
-    moved = False
+    # Relative importance of this object's updates to nearby clients, see pavara.interest.
+    net_priority = 1.0
+
+    def __init__(self, name=None):
+        super(PhysicalObject, self).__init__(name)
+        self.node = None
+        self.solid = None
+        self.moved = False
 
     def create_node(self):
         """
@@ -98,19 +112,6 @@ class PhysicalObject (WorldObject):
 
     def position(self):
         return self.node.get_pos()
-    def add_update(self, datagram):
-        if not self.moved:
-            return
-        pos = self.position()
-        hpr = self.node.get_hpr()
-        datagram.addString(self.name)
-        datagram.addFloat32(pos.x)
-        datagram.addFloat32(pos.y)
-        datagram.addFloat32(pos.z)
-        datagram.addFloat32(hpr.x)
-        datagram.addFloat32(hpr.y)
-        datagram.addFloat32(hpr.z)
-        self.moved = False
 
 
 class CompositeObject (PhysicalObject):
@@ -120,15 +121,33 @@ class CompositeObject (PhysicalObject):
         self.objects = []
 
     def create_node(self):
-        composite_geom = GeomBuilder('composite')
+        composite_geom = ArrayGeomBuilder('composite', indexed=True)
         for obj in self.objects:
             obj.add_to(composite_geom)
         return NodePath(composite_geom.get_geom_node())
 
-    def create_solid(self):
+    def create_solid(self, hulls=None):
+        """
+        :param hulls: Optionally, prebuilt geometry for the convex hull of each object that has one, in order (see
+                      hull_node).
+        """
         node = BulletRigidBodyNode(self.name)
+        hulls = iter(hulls or ())
+        for obj in self.objects:
+            if hasattr(obj, 'hull_geom'):
+                obj.add_solid(node, next(hulls, None))
+            else:
+                obj.add_solid(node)
+        return node
+
+    def hull_node(self):
+        """
+        Returns a GeomNode holding the convex hull geometry of each object that has one, in order.
+        """
+        node = GeomNode(self.name + '_hulls')
         for obj in self.objects:
-            obj.add_solid(node)
+            if hasattr(obj, 'hull_geom'):
+                node.add_geom(obj.hull_geom())
         return node
 
     def attach(self, obj):
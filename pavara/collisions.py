@@ -0,0 +1,161 @@
+from panda3d.core import Point3, BitMask32
+from panda3d.bullet import BulletGhostNode
+
+class Contact (object):
+    """
+    One contact involving a collidable object, as seen from that object's side.
+    :param node: The object's own Bullet node.
+    :param other: The Bullet node it touched.
+    :param other_obj: The WorldObject owning other, if there is one.
+    :param other_category: The CATEGORY_* flags other was tagged with.
+    :param point: The BulletManifoldPoint of the contact.
+    :param first: Whether the object's node was the "first" (node0) node of the contact.
+    """
+
+    def __init__(self, node, other, other_obj, other_category, point, first):
+        self.node = node
+        self.other = other
+        self.other_obj = other_obj
+        self.other_category = other_category
+        self.point = point
+        self.first = first
+
+class CollisionDispatcher (object):
+    """
+    Gathers every contact involving the World's colliders once per physics step, and routes them to both the
+    collision() handlers and the per-object contact lists that projectiles and goodies check in their updates.
+
+    Rigid body contacts come straight from Bullet's persistent manifolds, which the physics step has already
+    computed, so they cost no extra queries. Ghost nodes move in their own updates, so each collidable ghost gets one
+    contact test per step, run the first time it asks for its contacts (right after it has moved, as when it tested
+    for itself), or at the end of the step if it never asks. Bullet builds manifolds for pairs involving ghosts too;
+    those are skipped, so ghost contacts are only recorded once.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.contacts = {}
+        # Ghost colliders that have had their contact test this step.
+        self.tested = set()
+
+    def contacts_for(self, obj):
+        if obj not in self.tested and isinstance(obj.solid, BulletGhostNode) and obj in self.world.entities.colliders:
+            self._test_ghost(obj)
+        return self.contacts.get(obj, ())
+
+    def _test_ghost(self, obj):
+        self.tested.add(obj)
+        result = self.world.physics.contact_test(obj.solid)
+        self.world.profiler.count('contact_tests')
+        for contact in result.get_contacts():
+            self._record(contact.get_node0(), contact.get_node1(), contact.get_manifold_point(), True)
+
+    def dispatch(self):
+        # Ghosts that never asked for their contacts during the step still get their collision() calls.
+        for obj in list(self.world.entities.colliders):
+            if obj not in self.tested and isinstance(obj.solid, BulletGhostNode):
+                self._test_ghost(obj)
+        self.contacts = {}
+        self.tested = set()
+        physics = self.world.physics
+        for i in xrange(physics.get_num_manifolds()):
+            manifold = physics.get_manifold(i)
+            count = manifold.get_num_manifold_points()
+            if count == 0:
+                continue
+            node0 = manifold.get_node0()
+            node1 = manifold.get_node1()
+            if isinstance(node0, BulletGhostNode) or isinstance(node1, BulletGhostNode):
+                continue
+            # Report the deepest point of the contact.
+            point = manifold.get_manifold_point(0)
+            for j in xrange(1, count):
+                candidate = manifold.get_manifold_point(j)
+                if candidate.get_distance() < point.get_distance():
+                    point = candidate
+            self._record(node0, node1, point, False)
+
+    def _record(self, node0, node1, point, ghost_query):
+        entities = self.world.entities
+        colliders = entities.colliders
+        obj0, category0 = entities.lookup(node0)
+        obj1, category1 = entities.lookup(node1)
+        is_collider0 = obj0 in colliders
+        # If the other side is a ghost collider too, its own contact test will report this contact from its side.
+        is_collider1 = obj1 in colliders and not (ghost_query and isinstance(obj1.solid, BulletGhostNode))
+        if is_collider0:
+            self.contacts.setdefault(obj0, []).append(Contact(node0, node1, obj1, category1, point, True))
+        if is_collider1:
+            self.contacts.setdefault(obj1, []).append(Contact(node1, node0, obj0, category0, point, False))
+        if obj0 and obj1:
+            # Check the collision bits to see if the two objects should collide.
+            should_collide = obj0.collide_bits & obj1.collide_bits
+            if not should_collide.is_zero():
+                if is_collider0:
+                    obj0.collision(obj1, point, True)
+                if is_collider1:
+                    obj1.collision(obj0, point, False)
+
+class RayQueries (object):
+    """
+    Closest-hit ray tests against the World's physics, gathered and resolved together. Systems submit the rays they
+    will need during the probe phase at the start of a tick, they are all resolved in one pass, and their results
+    are read back during updates. Identical rays (same ends, same mask) are only tested once per tick, whether
+    submitted or asked for directly with closest. Results only last until the next tick.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.pending = {}
+        self.results = {}
+
+    def clear(self):
+        self.pending = {}
+        self.results = {}
+
+    def _key(self, pfrom, pto, mask):
+        return (pfrom[0], pfrom[1], pfrom[2], pto[0], pto[1], pto[2], mask.get_word())
+
+    def submit(self, pfrom, pto, mask):
+        """
+        Queues a ray from pfrom to pto, returning the key to get its result with once it has been resolved.
+        """
+        key = self._key(pfrom, pto, mask)
+        if key not in self.results and key not in self.pending:
+            self.pending[key] = (Point3(pfrom), Point3(pto), mask)
+        else:
+            self.world.profiler.count('ray_tests_deduped')
+        return key
+
+    def resolve(self):
+        physics = self.world.physics
+        results = self.results
+        for key, (pfrom, pto, mask) in self.pending.iteritems():
+            results[key] = physics.ray_test_closest(pfrom, pto, mask)
+        self.world.profiler.count('ray_tests', len(self.pending))
+        self.pending = {}
+
+    def result(self, key):
+        """
+        Returns the BulletClosestHitRayResult of a submitted ray, resolving whatever is pending if need be.
+        """
+        if key not in self.results:
+            if key in self.pending:
+                self.resolve()
+            else:
+                # Submitted on an earlier tick; test it again.
+                return self.closest(Point3(*key[0:3]), Point3(*key[3:6]), BitMask32(key[6]))
+        return self.results[key]
+
+    def closest(self, pfrom, pto, mask):
+        """
+        Tests a ray right away (unless the same ray was already tested this tick).
+        """
+        key = self._key(pfrom, pto, mask)
+        result = self.results.get(key)
+        if result is None:
+            result = self.results[key] = self.world.physics.ray_test_closest(pfrom, pto, mask)
+            self.world.profiler.count('ray_tests')
+        else:
+            self.world.profiler.count('ray_tests_deduped')
+        return result
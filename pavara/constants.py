@@ -18,9 +18,17 @@ MAP_COLLIDE_BIT =   BitMask32.bit(0)
 SOLID_COLLIDE_BIT = BitMask32.bit(1)
 GHOST_COLLIDE_BIT = BitMask32.bit(2)
 
+# entity categories, tagged onto Bullet nodes along with their entity IDs (see pavara.entities)
+
+CATEGORY_NONE = 0
+CATEGORY_GROUND = 1 << 0
+CATEGORY_WALKER = 1 << 1
+CATEGORY_WALKER_CAPSULE = 1 << 2
+CATEGORY_EXPLOSION = 1 << 3
+
 # physics contstants
 
-EXPLOSIONS_DONT_PUSH = ["expl", "ground"]
+EXPLOSIONS_DONT_PUSH = CATEGORY_EXPLOSION | CATEGORY_GROUND | CATEGORY_WALKER
 DEFAULT_GRAVITY = Vec3(0, -9.81, 0)
 DEFAULT_FRICTION = 1
 AIR_FRICTION = 0.02
@@ -35,6 +43,9 @@ WALKER_MIN_CHARGE_ENERGY = .2
 PLASMA_LIFESPAN = 900
 PLASMA_SOUND_FALLOFF = 20
 MISSILE_LIFESPAN = 600
+# Missile thrust along its own z axis, until it reaches top speed (30) and coasts.
+MISSILE_THRUST = Vec3(0, 0, 30)
+MISSILE_COAST = Vec3(0, 0, 0)
 
 # missile/grenade engine color lists in rgb decimal format
 
@@ -46,3 +57,60 @@ ENGINE_COLORS = [ [173.0/255.0, 0, 0, 1] # dark red
 
 TCP_PORT = 19567
 
+# headless simulation
+
+SERVER_TICK_RATE = 60
+MAX_CATCHUP_TICKS = 5
+
+# dedicated server
+
+MAX_MATCH_PLAYERS = 8
+LOAD_REPORT_INTERVAL = 5.0
+MAX_DATAGRAM_SIZE = 65535
+
+# UDP transport
+
+# Datagrams are kept under this many bytes, so they are not fragmented.
+TRANSPORT_MTU = 1200
+# Reliable messages are resent after a couple of round trips without an ack, backing off from there.
+INITIAL_RTT = 0.25
+MIN_RESEND_TIMEOUT = 0.1
+MAX_RESEND_TIMEOUT = 2.0
+# At most this many reliable messages may be waiting for acks; later ones wait their turn.
+RELIABLE_WINDOW = 64
+# Connections whose round trip time goes over CONGESTED_RTT are sent to less often, until it is back under
+# UNCONGESTED_RTT.
+CONGESTED_RTT = 0.25
+UNCONGESTED_RTT = 0.15
+SEND_RATE = 30.0
+CONGESTED_SEND_RATE = 10.0
+# Connections that have heard nothing for this long are dropped.
+CONNECTION_TIMEOUT = 10.0
+
+# world snapshots
+
+SNAPSHOT_HISTORY = 32
+# Clients draw remote objects this many seconds in the past, interpolating between buffered snapshots, and
+# extrapolate for at most MAX_EXTRAPOLATION seconds when snapshots stop arriving.
+RENDER_DELAY = 0.1
+MAX_EXTRAPOLATION = 0.25
+SNAPSHOT_BUFFER_SIZE = 32
+# How many frames of the local walker's movement the client keeps around to replay on top of snapshots. Frames the
+# server has already simulated are dropped as snapshots arrive, so this only needs to cover a round trip.
+PREDICTION_HISTORY = 256
+POSITION_QUANTUM = 1.0 / 64.0
+ANGLE_QUANTUM = 360.0 / 65536.0
+
+# interest management
+
+INTEREST_CELL_SIZE = 32.0
+INTEREST_RADIUS = 160.0
+SNAPSHOT_BYTE_BUDGET = 1200
+
+
+# debris
+
+DEBRIS_POOL_SIZE = 256
+# Debris is batched by color rounded to this many levels per channel (each piece still gets its exact color), so
+# continuously varying colors like plasma energy share a handful of batches.
+DEBRIS_COLOR_LEVELS = 8
@@ -0,0 +1,324 @@
+import errno
+import multiprocessing
+import Queue
+import select
+import socket
+import struct
+import time
+from timeit import default_timer
+from panda3d.core import loadPrcFile, loadPrcFileData
+from pavara.constants import TCP_PORT, MAX_MATCH_PLAYERS, LOAD_REPORT_INTERVAL, MAX_DATAGRAM_SIZE, CONNECTION_TIMEOUT
+from pavara.packets import get_ack, get_input, joined_packet, KIND_PLAYER_JOIN, KIND_PLAYER_INPUT, KIND_SNAPSHOT_ACK
+from pavara.transport import Connection
+
+# Every datagram between the front process and a match worker is prefixed with the address of the client it came
+# from (or is going to): IPv4 address, port. A datagram from the front with nothing after the address means that
+# client has gone.
+RELAY_HEADER = '!4sH'
+RELAY_HEADER_SIZE = struct.calcsize(RELAY_HEADER)
+
+def pack_address(addr):
+    return struct.pack(RELAY_HEADER, socket.inet_aton(addr[0]), addr[1])
+
+def unpack_address(data):
+    ip, port = struct.unpack_from(RELAY_HEADER, data, 0)
+    return socket.inet_ntoa(ip), port
+
+def find_join(data):
+    """
+    Returns the KIND_PLAYER_JOIN packet in a client's datagram, if it is the first one from a new connection.
+    """
+    packets = Connection().receive(data)
+    if packets and packets[0].kind == KIND_PLAYER_JOIN:
+        return packets[0]
+    return None
+
+def receive_all(sock):
+    """
+    Yields (data, address) for every datagram waiting on a non-blocking socket.
+    """
+    while True:
+        try:
+            yield sock.recvfrom(MAX_DATAGRAM_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED, errno.ECONNRESET):
+                return
+            raise
+
+class Match (object):
+    """
+    One match, running in its own worker process: a ServerWorld with its map, stepped by a Simulation, talking to
+    its players through the front process over a localhost UDP socket. Each player has a pavara.transport Connection,
+    so joins are reliable and snapshots are sent at the connection's send rate.
+    """
+
+    def __init__(self, index, path, reports):
+        from pavara.world import ServerWorld
+        from pavara.maps import load_maps
+        from pavara.simulation import Simulation
+        from pavara.snapshots import SnapshotEncoder
+        from pavara.interest import InterestManager
+        self.index = index
+        self.path = path
+        self.reports = reports
+        self.world = ServerWorld()
+        load_maps(path, self.world)
+        self.simulation = Simulation(self.world)
+        self.snapshots = SnapshotEncoder(self.world)
+        self.interest = InterestManager(self.world)
+        self.players = {}
+        self.last_pid = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        # The front process's address, learned from the first datagram it relays.
+        self.front = None
+        self.ticks = 0
+        self.busy = 0.0
+        self.last_report = time.time()
+
+    def add_player(self, addr, name, connection):
+        from pavara.network import Player
+        from pavara.walker import Walker
+        self.last_pid += 1
+        print 'Match %d: player %s joined from %s:%d' % (self.index, name, addr[0], addr[1])
+        player = Player(self.last_pid, self.world.attach(Walker(self.world.get_incarn())), connection)
+        self.players[addr] = player
+        # Tell the client which walker is theirs, so they can predict it.
+        connection.send(joined_packet(player.walker.name))
+        return player
+
+    def remove_player(self, addr):
+        player = self.players.pop(addr, None)
+        if player is None:
+            return
+        print 'Match %d: player %s left from %s:%d' % (self.index, player.pid, addr[0], addr[1])
+        self.world.garbage.add(player.walker)
+
+    def receive(self):
+        for data, front in receive_all(self.sock):
+            self.front = front
+            if len(data) < RELAY_HEADER_SIZE:
+                continue
+            addr = unpack_address(data)
+            data = data[RELAY_HEADER_SIZE:]
+            if not data:
+                self.remove_player(addr)
+                continue
+            player = self.players.get(addr)
+            if player is None:
+                # Only a join starts a connection; the client resends it until we acknowledge it.
+                connection = Connection()
+                packets = connection.receive(data)
+                if not packets or packets[0].kind != KIND_PLAYER_JOIN:
+                    continue
+                player = self.add_player(addr, str(packets[0].payload), connection)
+                packets = packets[1:]
+            else:
+                packets = player.connection.receive(data)
+            for packet in packets:
+                if packet.kind == KIND_PLAYER_INPUT:
+                    player.handle_command(*get_input(packet), sequence=packet.sequence)
+                elif packet.kind == KIND_SNAPSHOT_ACK:
+                    player.snapshots.ack(get_ack(packet))
+
+    def send_snapshots(self):
+        if not self.players or self.front is None:
+            return
+        now = time.time()
+        ready = [(addr, player) for addr, player in self.players.iteritems() if player.connection.ready(now)]
+        if not ready:
+            return
+        snapshot = self.snapshots.capture()
+        self.interest.index(snapshot)
+        for addr, player in ready:
+            walker = player.walker
+            connection = player.connection
+            connection.send(self.interest.encode(snapshot, player.snapshots, walker.position(), [walker.net_id]))
+            for datagram in connection.flush(now):
+                self.sock.sendto(pack_address(addr) + datagram, self.front)
+
+    def report(self, now):
+        elapsed = now - self.last_report
+        self.reports.put({
+            'match': self.index,
+            'map': self.path,
+            'port': self.port,
+            'players': len(self.players),
+            'objects': len(self.world.objects),
+            'ticks_per_second': self.ticks / elapsed if elapsed else 0.0,
+            # Fraction of wall time spent ticking and sending snapshots.
+            'busy': self.busy / elapsed if elapsed else 0.0,
+            'dropped_ticks': self.simulation.dropped_ticks,
+        })
+        self.ticks = 0
+        self.busy = 0.0
+        self.last_report = now
+
+    def run(self):
+        simulation = self.simulation
+        self.report(time.time())
+        simulation.last_time = simulation.clock()
+        while True:
+            self.receive()
+            start = default_timer()
+            ticks = simulation.poll()
+            if ticks:
+                self.send_snapshots()
+                self.ticks += ticks
+            self.busy += default_timer() - start
+            now = time.time()
+            if now - self.last_report >= LOAD_REPORT_INTERVAL:
+                self.report(now)
+            # Sleep until the next tick is due, or a datagram arrives.
+            remaining = simulation.tick_dt - simulation.accumulator
+            select.select([self.sock], [], [], max(remaining, 0))
+
+def run_match(index, path, reports):
+    """
+    The entry point of a match worker process.
+    """
+    loadPrcFile('panda_config.prc')
+    loadPrcFileData('dedicated', 'window-type none\naudio-library-name null\n')
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+    Match(index, path, reports).run()
+
+class Worker (object):
+    """
+    The front process's view of one match worker.
+    """
+
+    def __init__(self, index, path, process):
+        self.index = index
+        self.path = path
+        self.process = process
+        self.port = None
+        self.players = 0
+        self.load = None
+
+    def __repr__(self):
+        return 'Match %d (%s)' % (self.index, self.path)
+
+class DedicatedServer (object):
+    """
+    Runs many independent matches on one host, each in its own worker process (so each gets its own core), behind a
+    single public UDP port. The front process only relays datagrams: the first datagram of a client's connection,
+    carrying its KIND_PLAYER_JOIN packet, picks the least populated match with room, and from then on everything from
+    that client goes to that match's worker, and everything the worker sends back for that client goes to the client.
+    Clients not heard from for CONNECTION_TIMEOUT seconds give up their seat, and their worker is told to drop them.
+    Workers report their load every LOAD_REPORT_INTERVAL seconds.
+    """
+
+    def __init__(self, maps, port=TCP_PORT, matches=None, max_players=MAX_MATCH_PLAYERS):
+        self.port = port
+        self.max_players = max_players
+        self.reports = multiprocessing.Queue()
+        self.workers = []
+        self.routes = {}
+        # Client address -> when we last heard from it.
+        self.last_heard = {}
+        for index in xrange(matches or len(maps)):
+            path = maps[index % len(maps)]
+            process = multiprocessing.Process(target=run_match, args=(index, path, self.reports), name='match-%d' % index)
+            process.daemon = True
+            self.workers.append(Worker(index, path, process))
+        self.public = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.public.bind(('', port))
+        self.public.setblocking(False)
+        self.internal = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.internal.bind(('127.0.0.1', 0))
+        self.internal.setblocking(False)
+
+    def start(self):
+        """
+        Starts every worker, and waits until each has loaded its map and reported in.
+        """
+        for worker in self.workers:
+            worker.process.start()
+        while any(worker.port is None for worker in self.workers):
+            try:
+                self.handle_report(self.reports.get(timeout=1.0))
+            except Queue.Empty:
+                for worker in self.workers:
+                    if not worker.process.is_alive():
+                        raise RuntimeError('%r exited while loading (exit code %s)' % (worker, worker.process.exitcode))
+        print 'Serving %d matches on port %d' % (len(self.workers), self.port)
+
+    def handle_report(self, load):
+        worker = self.workers[load['match']]
+        worker.port = load['port']
+        worker.load = load
+
+    def choose_worker(self):
+        open_workers = [worker for worker in self.workers if worker.players < self.max_players]
+        if not open_workers:
+            return None
+        return min(open_workers, key=lambda worker: worker.players)
+
+    def from_clients(self):
+        now = time.time()
+        for data, addr in receive_all(self.public):
+            worker = self.routes.get(addr)
+            if worker is None:
+                if not find_join(data):
+                    continue
+                worker = self.choose_worker()
+                if worker is None:
+                    print 'All matches are full, ignoring join from %s:%d' % addr
+                    continue
+                self.routes[addr] = worker
+                worker.players += 1
+            self.last_heard[addr] = now
+            self.internal.sendto(pack_address(addr) + data, ('127.0.0.1', worker.port))
+
+    def expire_routes(self, now):
+        """
+        Frees the seats of clients that have gone quiet, and tells their workers to drop them.
+        """
+        for addr, heard in self.last_heard.items():
+            if now - heard <= CONNECTION_TIMEOUT:
+                continue
+            print '%s:%d timed out' % addr
+            worker = self.routes.pop(addr)
+            del self.last_heard[addr]
+            worker.players -= 1
+            self.internal.sendto(pack_address(addr), ('127.0.0.1', worker.port))
+
+    def from_workers(self):
+        for data, worker_addr in receive_all(self.internal):
+            if len(data) > RELAY_HEADER_SIZE:
+                self.public.sendto(data[RELAY_HEADER_SIZE:], unpack_address(data))
+
+    def collect_reports(self):
+        while True:
+            try:
+                self.handle_report(self.reports.get_nowait())
+            except Queue.Empty:
+                return
+
+    def print_loads(self):
+        for worker in self.workers:
+            load = worker.load
+            if not worker.process.is_alive():
+                print '%r: DEAD (exit code %s)' % (worker, worker.process.exitcode)
+            elif load:
+                print '%r: %d players, %d objects, %.1f ticks/s, %.0f%% busy, %d dropped ticks' % (worker,
+                    load['players'], load['objects'], load['ticks_per_second'], load['busy'] * 100, load['dropped_ticks'])
+
+    def serve_forever(self):
+        self.start()
+        last_print = time.time()
+        while True:
+            readable, writable, errored = select.select([self.public, self.internal], [], [], LOAD_REPORT_INTERVAL)
+            if self.public in readable:
+                self.from_clients()
+            if self.internal in readable:
+                self.from_workers()
+            now = time.time()
+            self.expire_routes(now)
+            if now - last_print >= LOAD_REPORT_INTERVAL:
+                self.collect_reports()
+                self.print_loads()
+                last_print = now
@@ -1,44 +1,69 @@
 from pavara.constants import *
-from pavara.utils.geom import GeomBuilder
 from pavara.base_objects import WorldObject, PhysicalObject
 from direct.interval.LerpInterval import LerpFunc
 from panda3d.bullet import BulletRigidBodyNode, BulletBoxShape
-from panda3d.core import Point3, TransparencyAttrib
+from panda3d.core import Point3, TransparencyAttrib, Geom, GeomNode, GeomTriangles, GeomVertexData, GeomVertexFormat
+from panda3d.core import GeomVertexWriter, OmniBoundingVolume
 import math
 import random
 
 class Effect (object):
-    """Effects wrap objects like boxes and ramps and other effects and change
-       behavior of the wrapped object. Subclasses of this class automatically
-       delegate anything not implemented in the effect to the object being
-       wrapped."""
-    def __init__(self, effected):
-        object.__setattr__(self, 'effected', effected)
-
-    def __setattr__(self, name, value):
-        """Attributes should be assigned as deeply in the effect chain as
-           possible, so go all the way down the effect chain, and start coming
-           back until the first object to have the attribute is found. Set it
-           and return. If nothing is found, set it in this object."""
-        objs = []
-        obj = self
-
-        while hasattr(obj, 'effected'):
-            obj = obj.effected
-            objs.append(obj)
-
-        while objs:
-            obj = objs.pop()
-            if hasattr(obj, name):
-                object.__setattr__(obj, name, value)
-                return
-        object.__setattr__(self, name, value)
-
-    def __getattr__(self, name):
-        """Python only calls this function if the attribute is not defined on
-           the object. This makes it so method calls are automatically passed
-           down the effect chain if they are not defined in the effect object"""
-        return getattr(self.effected, name)
+    """Effects change the behavior of objects like boxes and ramps. They are
+       mixins: apply_effects gives an object its effects by copying it into a
+       class that combines the effect classes with the object's own class, so
+       attributes and methods are found with a normal lookup. Effects extend
+       the object's methods through super(), and set up their own state in
+       setup."""
+
+    def setup(self):
+        pass
+
+
+_composed = {}
+
+def compose(effects, base):
+    """
+    Returns the class combining the given effect classes (outermost first) with base, creating it the first time each
+    combination is asked for.
+    """
+    key = (effects, base)
+    cls = _composed.get(key)
+    if cls is None:
+        mixins = []
+        for effect in effects:
+            # An effect nested in itself only applies once.
+            if effect not in mixins and not issubclass(base, effect):
+                mixins.append(effect)
+        if mixins:
+            name = ''.join(effect.__name__ for effect in mixins) + base.__name__
+            cls = type(name, tuple(mixins) + (base,), {})
+        else:
+            cls = base
+        _composed[key] = cls
+    return cls
+
+def copy_state(source, target):
+    if hasattr(source, '__dict__'):
+        target.__dict__.update(source.__dict__)
+    for klass in type(source).__mro__:
+        for slot in klass.__dict__.get('__slots__', ()):
+            try:
+                setattr(target, slot, getattr(source, slot))
+            except AttributeError:
+                pass
+
+def apply_effects(obj, effects):
+    """
+    Returns a copy of obj with the given effects, a list of (effect class, setup arguments) pairs, outermost first.
+    """
+    if not effects:
+        return obj
+    cls = compose(tuple(effect for effect, args in effects), obj.__class__)
+    flat = cls.__new__(cls)
+    copy_state(obj, flat)
+    for effect, args in reversed(effects):
+        effect.setup(flat, *args)
+    return flat
 
 
 class Hologram (Effect):
@@ -46,26 +71,24 @@ class Hologram (Effect):
 
 class FreeSolid (Effect):
 
-    def __init__(self, effected, mass):
+    def setup(self, mass):
         if mass > 0:
             self.mass = mass
-        Effect.__init__(self, effected)
         self.collide_bits = MAP_COLLIDE_BIT | SOLID_COLLIDE_BIT
 
     def create_solid(self):
-        node = self.effected.create_solid()
+        node = super(FreeSolid, self).create_solid()
         node.set_mass(self.mass if self.mass > 0 else 1)
         return node
 
 
 class Transparent (Effect):
 
-    def __init__(self, effected, alpha):
-        Effect.__init__(self, effected)
+    def setup(self, alpha):
         self.alpha = alpha
 
     def create_node(self):
-        node = self.effected.create_node()
+        node = super(Transparent, self).create_node()
         node.setTwoSided(True)
         node.setDepthWrite(False)
         node.set_transparency(TransparencyAttrib.MAlpha)
@@ -76,15 +99,13 @@ class Transparent (Effect):
 
 class Hostile (Effect):
     
-    def __init__(self, effected):
-        Effect.__init__(self, effected)
+    def setup(self):
         self.hostile = True
 
 class Mortal (Effect):
 
-    def __init__(self, effected, hp):
+    def setup(self, hp):
         self.hp = hp
-        Effect.__init__(self, effected)
 
     def damage(self, amt):
         self.hp -= amt
@@ -115,83 +136,175 @@ class Mortal (Effect):
             reduced = radius * .6
             count = int(reduced)
 
-        self.world.attach(TriangleExplosion(expl_pos, count, size=reduced, color=c, lifetime=60, debris_area=size))
-        
-
-class TriangleExplosion (WorldObject):
-    def __init__(self, pos, count, hit_normal=None, lifetime=40, color=[1,1,1,1], size=.2, amount=5, name=None, debris_area=None):
-        super(TriangleExplosion, self).__init__(name)
-        self.pos = Vec3(*pos)
-        self.hit_normal = Vec3(*hit_normal) if hit_normal else None
-        self.lifetime = lifetime
-        self.color = color
-        self.size = size
-        self.count = count
-        self.shrapnels = []
-        self.debris_area = debris_area
+        self.world.debris.explode(expl_pos, count, size=reduced, color=c, lifetime=60, debris_area=size)
 
 
-    def create_node(self):
-        self.pos_node = self.world.scene.attachNewNode(self.name+"_node")
-        return self.pos_node
+class Shrapnel (object):
+    """
+    A single piece of debris owned by a DebrisPool. Pieces are created once, up front, and recycled; they have no
+    geometry of their own, since the pool draws every live piece of a similar color in one batch.
+    """
 
-    def attached(self):
-        for i in xrange(self.count):
-            #if self.hit_normal:
-                #vector = Vec3(*[random.uniform(x+.7, x-.7) for x in self.hit_normal])
-            #else:
-            vector = Vec3(*[random.uniform(-.5,.5) for _ in xrange(3)])
-            if self.debris_area:
-                position = Vec3(*[random.uniform(x + ((y/2)-self.size), x - ((y/2)+self.size)) for x,y in zip(self.pos,self.debris_area)])
-            else:
-                position = Vec3(*[random.uniform(x+self.size, x-self.size) for x in self.pos])
+    __slots__ = ('solid', 'node', 'color', 'lifetime', 'age')
 
-            if position.y < 0:
-                position.y = self.size+.1
-            self.shrapnels.append(self.world.attach(Shrapnel(position, self.size, self.color, vector, self.lifetime)))
+    # The triangle drawn for each piece, in the piece's local space. Pieces are scaled by their size.
+    POINTS = (Point3(0, -.5, -.5), Point3(0, .5, .5), Point3(0, -.5, .5))
 
+    def __init__(self, pool, index):
+        self.solid = BulletRigidBodyNode('%s_shrapnel_%d' % (pool.name, index))
+        self.solid.add_shape(BulletBoxShape(Vec3(.01, 1, 1)))
+        self.solid.set_mass(3)
+        self.solid.set_angular_damping(.7)
+        self.solid.set_into_collide_mask(NO_COLLISION_BITS)
+        self.node = pool.node.attach_new_node(self.solid)
+        self.color = None
+        self.lifetime = 0
+        self.age = 0
 
-class Shrapnel (PhysicalObject):
-    def __init__(self, pos, size, color, vector, lifetime, name=None):
-        super(Shrapnel, self).__init__(name)
-        self.pos = pos
-        self.vector = vector
-        self.lifetime = lifetime
-        self.size = size
+    def spawn(self, pos, size, color, vector, lifetime):
         self.color = color
-        self.mass = .01
+        self.lifetime = lifetime
         self.age = 0
+        self.node.set_pos_hpr_scale(pos, Vec3(0, 0, 0), Vec3(1, size, size))
+        self.solid.set_linear_velocity(Vec3(0, 0, 0))
+        self.solid.set_angular_velocity(Vec3(0, 0, 0))
+        self.solid.clear_forces()
+        self.solid.set_active(True)
+        self.solid.apply_impulse(vector * 12, Point3(pos))
+
+    def faded_color(self):
+        halflife = self.lifetime / 2
+        if self.age > self.lifetime - halflife:
+            fade = (self.lifetime - self.age) / halflife
+            return (self.color[0] * fade, self.color[1] * fade, self.color[2] * fade, 1)
+        return self.color
+
+class DebrisBatch (object):
+    """
+    One dynamic GeomNode holding the triangles of every live Shrapnel piece of a similar color (see color_key). The
+    vertex data is rewritten in place each frame rather than rebuilt.
+    """
+
+    def __init__(self, parent):
+        self.vdata = GeomVertexData('debris', GeomVertexFormat.get_v3n3c4(), Geom.UHDynamic)
+        self.tris = GeomTriangles(Geom.UHDynamic)
+        geom = Geom(self.vdata)
+        geom.add_primitive(self.tris)
+        geom_node = GeomNode('debris')
+        geom_node.add_geom(geom)
+        # Debris moves every frame; don't make Panda recompute bounds for it.
+        geom_node.set_bounds(OmniBoundingVolume())
+        geom_node.set_final(True)
+        self.node = parent.attach_new_node(geom_node)
+        self.node.set_two_sided(True)
+
+    def update(self, pieces):
+        self.vdata.set_num_rows(len(pieces) * 3)
+        vertex = GeomVertexWriter(self.vdata, 'vertex')
+        normal = GeomVertexWriter(self.vdata, 'normal')
+        color = GeomVertexWriter(self.vdata, 'color')
+        for piece in pieces:
+            mat = piece.node.get_mat()
+            n = mat.xform_vec(Vec3(1, 0, 0))
+            c = piece.faded_color()
+            for point in Shrapnel.POINTS:
+                vertex.set_data3f(mat.xform_point(point))
+                normal.set_data3f(n)
+                color.set_data4f(*c)
+        self.tris.clear_vertices()
+        if pieces:
+            self.tris.add_next_vertices(len(pieces) * 3)
+
+    def remove(self):
+        self.node.remove_node()
+
+def color_key(color):
+    """
+    The batch a piece of the given color goes in: its color, rounded to DEBRIS_COLOR_LEVELS per channel.
+    """
+    return tuple(int(round(c * DEBRIS_COLOR_LEVELS)) for c in color)
+
+class DebrisPool (WorldObject):
+    """
+    Owns a fixed number of preallocated Shrapnel pieces. Explosions borrow pieces from the pool rather than
+    attaching new objects to the World; when every piece is in use, the oldest live pieces are recycled. Idle pieces
+    are kept out of the physics world.
+    """
+
+    def __init__(self, capacity=DEBRIS_POOL_SIZE, name=None):
+        super(DebrisPool, self).__init__(name)
+        self.capacity = capacity
+        self.free = []
+        self.live = []
+        self.batches = {}
 
     def create_node(self):
-        extent = self.size/2.0
-        geom_points = [Point3(0,-extent,-extent), Point3(0,extent,extent), Point3(0,-extent,extent)]
-        self.geom = GeomBuilder('tri').add_tri(self.color, geom_points).get_geom_node()
-        self.node = self.world.scene.attach_new_node(self.geom)
-        self.colorhandle = self.node.find('**/*')
-        return self.node
+        return self.world.scene.attach_new_node(self.name + '_node')
 
     def create_solid(self):
-        node = BulletRigidBodyNode(self.name)
-        node_shape = BulletBoxShape(Vec3(.01, self.size, self.size))
-        node.add_shape(node_shape)
-        node.set_mass(3)
-        node.set_angular_damping(.7)
-        return node
+        return None
 
     def attached(self):
-        self.world.register_collider(self)
-        self.world.register_updater_later(self)
-        self.node.set_pos(self.pos)
-        self.solid.apply_impulse(Vec3(*self.vector)*12, Point3(*self.pos))
-        self.solid.setIntoCollideMask(NO_COLLISION_BITS)
+        self.free = [Shrapnel(self, i) for i in xrange(self.capacity)]
+        for piece in self.free:
+            piece.node.stash()
+        self.world.register_updater(self)
+
+    def explode(self, pos, count, size=.2, color=[1,1,1,1], lifetime=40, debris_area=None):
+        """
+        Throws count pieces of debris outward from pos. If debris_area is given, the pieces start scattered across
+        a box of that size centered on pos, e.g. for a destroyed block.
+        """
+        pos = Vec3(*pos)
+        for i in xrange(count):
+            vector = Vec3(*[random.uniform(-.5,.5) for _ in xrange(3)])
+            if debris_area:
+                position = Vec3(*[random.uniform(x + ((y/2)-size), x - ((y/2)+size)) for x,y in zip(pos,debris_area)])
+            else:
+                position = Vec3(*[random.uniform(x+size, x-size) for x in pos])
+
+            if position.y < 0:
+                position.y = size+.1
+            self.spawn(position, size, color, vector, lifetime)
+
+    def spawn(self, pos, size, color, vector, lifetime):
+        if self.free:
+            piece = self.free.pop()
+            piece.node.unstash()
+            self.world.physics.attach_rigid_body(piece.solid)
+        else:
+            piece = self.live.pop(0)
+        piece.spawn(pos, size, color, vector, lifetime)
+        self.live.append(piece)
+        return piece
+
+    def release(self, piece):
+        self.world.physics.remove_rigid_body(piece.solid)
+        piece.node.stash()
+        self.free.append(piece)
 
     def update(self, dt):
-        self.age += dt*60
-        halflife = self.lifetime/2
-        if self.age > self.lifetime-halflife:
-            newcolor = [x*((self.lifetime-self.age)/halflife) for x in self.color]
-            newcolor[3] = 1 #changing the alpha channel doesn't work
-            if self.node:
-                self.node.set_color(*newcolor)
-        if self.age > self.lifetime:
-            self.world.garbage.add(self)
\ No newline at end of file
+        live = []
+        by_color = {}
+        for piece in self.live:
+            piece.age += dt*60
+            if piece.age > piece.lifetime:
+                self.release(piece)
+            else:
+                live.append(piece)
+                by_color.setdefault(color_key(piece.color), []).append(piece)
+        self.live = live
+        # Nothing to draw on a headless server.
+        if self.world.camera is None:
+            return
+        for color, batch in self.batches.items():
+            pieces = by_color.pop(color, None)
+            if pieces:
+                batch.update(pieces)
+            else:
+                # Colors come and go with explosions; don't keep drawing (or holding on to) empty batches.
+                batch.remove()
+                del self.batches[color]
+        for color, pieces in by_color.iteritems():
+            batch = self.batches[color] = DebrisBatch(self.node)
+            batch.update(pieces)
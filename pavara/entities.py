@@ -0,0 +1,221 @@
+from array import array
+from collections import deque
+from pavara.constants import CATEGORY_NONE
+from pavara.utils.integrator import Integrator
+
+# The Python tag on Bullet nodes holding the (entity ID, category) of the object they belong to.
+ENTITY_TAG = 'entity'
+
+class System (object):
+    """
+    The entities taking part in one per-tick system (updates, collisions, integration, ...), kept in a dense list in
+    the order they joined. Membership is looked up through an array indexed by entity ID, and removing an entity moves
+    the last member into its slot, so the list never has holes. Subclasses can keep per-entity data in dense columns
+    of doubles alongside the members; see columns.
+    """
+
+    # (attribute name, values per entity) for each column of per-entity data.
+    columns = ()
+
+    def __init__(self):
+        self.members = []
+        self.slots = array('i')
+        for name, width in self.columns:
+            setattr(self, name, array('d'))
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __contains__(self, obj):
+        return obj is not None and self.slot(obj) >= 0
+
+    def slot(self, obj):
+        """
+        Returns the index of the given entity in members (and the columns), or -1 if it is not a member.
+        """
+        entity = obj.net_id
+        if entity is None or entity >= len(self.slots):
+            return -1
+        slot = self.slots[entity]
+        if slot >= 0 and self.members[slot] is not obj:
+            return -1
+        return slot
+
+    def add(self, obj):
+        """
+        Adds the given entity, returning its slot, or -1 if it was already a member. Subclasses with columns append
+        the entity's data to them when this returns a slot.
+        """
+        if self.slot(obj) >= 0:
+            return -1
+        entity = obj.net_id
+        if entity >= len(self.slots):
+            self.slots.extend([-1] * (entity + 1 - len(self.slots)))
+        slot = len(self.members)
+        self.slots[entity] = slot
+        self.members.append(obj)
+        return slot
+
+    def discard(self, obj):
+        slot = self.slot(obj)
+        if slot < 0:
+            return
+        last = len(self.members) - 1
+        if slot != last:
+            moved = self.members[last]
+            self.members[slot] = moved
+            self.slots[moved.net_id] = slot
+            for name, width in self.columns:
+                column = getattr(self, name)
+                column[slot * width:slot * width + width] = column[last * width:last * width + width]
+        for name, width in self.columns:
+            del getattr(self, name)[last * width:]
+        self.members.pop()
+        self.slots[obj.net_id] = -1
+
+class Bodies (System):
+    """
+    Bodies integrated the same way (an Integrator or a Friction) in one pass per tick, with their positions,
+    velocities, accelerations and frictions in columns. The new positions are written back to each member's node as
+    the bodies are stepped.
+    """
+
+    columns = (('positions', 3), ('velocities', 3), ('accels', 3), ('frictions', 1))
+
+    def __init__(self, integrator=Integrator):
+        super(Bodies, self).__init__()
+        self.step_body = integrator.step
+
+    def add(self, obj, position, velocity, accel, friction=0.0):
+        slot = super(Bodies, self).add(obj)
+        if slot >= 0:
+            self.positions.extend((position[0], position[1], position[2]))
+            self.velocities.extend((velocity[0], velocity[1], velocity[2]))
+            self.accels.extend((accel[0], accel[1], accel[2]))
+            self.frictions.append(friction)
+        return slot
+
+    def speed(self, obj):
+        i = self.slot(obj) * 3
+        v = self.velocities
+        return (v[i] * v[i] + v[i + 1] * v[i + 1] + v[i + 2] * v[i + 2]) ** 0.5
+
+    def set_accel(self, obj, accel):
+        i = self.slot(obj) * 3
+        self.accels[i] = accel[0]
+        self.accels[i + 1] = accel[1]
+        self.accels[i + 2] = accel[2]
+
+    def step(self, dt):
+        step_body = self.step_body
+        p = self.positions
+        v = self.velocities
+        a = self.accels
+        f = self.frictions
+        for slot, obj in enumerate(self.members):
+            i = slot * 3
+            j = i + 1
+            k = i + 2
+            p[i], p[j], p[k], v[i], v[j], v[k] = step_body(p[i], p[j], p[k], v[i], v[j], v[k], a[i], a[j], a[k], f[slot], dt)
+            obj.node.set_pos(p[i], p[j], p[k])
+
+class Lifetimes (System):
+    """
+    Entities that only live so long. Each ages by dt times its rate every tick, and once its age passes its span,
+    its expire method is called (once per tick, until it is removed).
+    """
+
+    columns = (('ages', 1), ('spans', 1), ('rates', 1))
+
+    def add(self, obj, span, rate=1.0):
+        slot = super(Lifetimes, self).add(obj)
+        if slot >= 0:
+            self.ages.append(0.0)
+            self.spans.append(span)
+            self.rates.append(rate)
+        return slot
+
+    def age(self, obj):
+        return self.ages[self.slot(obj)]
+
+    def step(self, dt):
+        ages = self.ages
+        spans = self.spans
+        rates = self.rates
+        expired = []
+        for slot in xrange(len(self.members)):
+            ages[slot] += dt * rates[slot]
+            if ages[slot] > spans[slot]:
+                expired.append(self.members[slot])
+        for obj in expired:
+            obj.expire()
+
+class EntityStore (object):
+    """
+    Every object attached to a World, by integer entity ID, along with the systems they take part in. IDs are compact
+    and freed IDs are recycled oldest-first, so they double as the network IDs of objects (and stay 16-bit); snapshots
+    carry the object name whenever an ID is (re)introduced, so reuse is safe.
+    """
+
+    def __init__(self):
+        # Entity ID 0 is never used.
+        self.entities = [None]
+        self.free = deque()
+        self.updaters = System()
+        # Entities that submit ray queries at the start of each tick, before anything updates.
+        self.probes = System()
+        self.colliders = System()
+        # Bodies that move under a constant acceleration (i.e. missiles).
+        self.bodies = Bodies(Integrator)
+        self.lifetimes = Lifetimes()
+        self.systems = (self.updaters, self.probes, self.colliders, self.bodies, self.lifetimes)
+
+    def __len__(self):
+        return len(self.entities) - 1 - len(self.free)
+
+    def get(self, entity):
+        if 0 < entity < len(self.entities):
+            return self.entities[entity]
+        return None
+
+    def tag(self, node, obj, category=CATEGORY_NONE):
+        """
+        Marks a Bullet node (or any PandaNode) as belonging to the given entity, so that contacts and ray hits on it
+        can be turned back into the object with lookup. Nodes that belong to no object can still be given a category
+        by passing None.
+        """
+        node.set_python_tag(ENTITY_TAG, (obj.net_id if obj is not None else 0, category))
+
+    def lookup(self, node):
+        """
+        Returns the object the given node belongs to (or None) and the node's category.
+        """
+        tag = node.get_python_tag(ENTITY_TAG)
+        if tag is None:
+            return None, CATEGORY_NONE
+        return self.get(tag[0]), tag[1]
+
+    def add(self, obj):
+        """
+        Gives the object an entity ID (as its net_id), and returns it.
+        """
+        if self.free:
+            entity = self.free.popleft()
+            self.entities[entity] = obj
+        else:
+            entity = len(self.entities)
+            self.entities.append(obj)
+        obj.net_id = entity
+        return entity
+
+    def remove(self, obj):
+        """
+        Takes the object out of every system and frees its entity ID.
+        """
+        for system in self.systems:
+            system.discard(obj)
+        self.entities[obj.net_id] = None
+        self.free.append(obj.net_id)
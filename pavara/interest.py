@@ -0,0 +1,96 @@
+import math
+from collections import defaultdict
+from pavara.constants import INTEREST_CELL_SIZE, INTEREST_RADIUS, SNAPSHOT_BYTE_BUDGET, POSITION_QUANTUM
+
+class SpatialGrid (object):
+    """
+    A uniform grid over the ground (XZ) plane, mapping cells to the keys of whatever was inserted into them.
+    """
+
+    def __init__(self, cell_size=INTEREST_CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self.cells = defaultdict(list)
+
+    def cell(self, x, z):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(z / self.cell_size)))
+
+    def clear(self):
+        self.cells.clear()
+
+    def insert(self, key, x, z):
+        self.cells[self.cell(x, z)].append(key)
+
+    def query(self, x, z, radius):
+        """
+        Yields the keys in every cell touched by the square that bounds the given circle. Callers that care about
+        the exact radius should check distances themselves.
+        """
+        min_x, min_z = self.cell(x - radius, z - radius)
+        max_x, max_z = self.cell(x + radius, z + radius)
+        cells = self.cells
+        for cx in xrange(min_x, max_x + 1):
+            for cz in xrange(min_z, max_z + 1):
+                keys = cells.get((cx, cz))
+                if keys:
+                    for key in keys:
+                        yield key
+
+class InterestManager (object):
+    """
+    Decides which objects in a snapshot each client should hear about. Objects are indexed into a SpatialGrid once
+    per snapshot; each client then only considers objects within radius of its focus (usually its own walker),
+    ordered by priority. An object's priority is its net_priority divided by its distance, plus whatever priority
+    it has built up over previous snapshots in which it was relevant but did not fit in the client's byte budget.
+    """
+
+    def __init__(self, world, cell_size=INTEREST_CELL_SIZE, radius=INTEREST_RADIUS, budget=SNAPSHOT_BYTE_BUDGET):
+        self.world = world
+        self.grid = SpatialGrid(cell_size)
+        self.radius = radius
+        self.budget = budget
+        self.priorities = {}
+
+    def index(self, snapshot):
+        """
+        Rebuilds the grid from the given snapshot. Call this once per snapshot, before select.
+        """
+        self.grid.clear()
+        self.priorities = {}
+        objects = self.world.objects
+        for net_id, (name, qpos, qhpr) in snapshot.states.iteritems():
+            self.grid.insert(net_id, qpos[0] * POSITION_QUANTUM, qpos[2] * POSITION_QUANTUM)
+            obj = objects.get(name)
+            self.priorities[net_id] = getattr(obj, 'net_priority', 1.0)
+
+    def select(self, snapshot, stream, focus, always=()):
+        """
+        Returns the net IDs relevant to a client focused at the given point, highest priority first, and the priority
+        each earned this snapshot alone (not counting starvation). Anything in always (e.g. the client's own walker)
+        is included regardless of distance, at the front.
+        """
+        states = snapshot.states
+        fx, fz = focus[0], focus[2]
+        radius_sq = self.radius * self.radius
+        starvation = stream.starvation
+        scored = []
+        for net_id in self.grid.query(fx, fz, self.radius):
+            qpos = states[net_id][1]
+            dx = qpos[0] * POSITION_QUANTUM - fx
+            dz = qpos[2] * POSITION_QUANTUM - fz
+            dist_sq = dx * dx + dz * dz
+            if dist_sq > radius_sq:
+                continue
+            priority = self.priorities[net_id] / (1.0 + math.sqrt(dist_sq))
+            scored.append((priority + starvation.get(net_id, 0.0), priority, net_id))
+        scored.sort(reverse=True)
+        first = [net_id for net_id in always if net_id in states]
+        return first + [net_id for total, priority, net_id in scored if net_id not in first], \
+            dict((net_id, priority) for total, priority, net_id in scored)
+
+    def encode(self, snapshot, stream, focus, always=()):
+        """
+        Encodes the given snapshot for one client, limited to what is relevant to it and fits in the byte budget.
+        Objects the client knew about that have left its radius are sent as removed.
+        """
+        net_ids, priorities = self.select(snapshot, stream, focus, always)
+        return stream.encode(snapshot, net_ids, self.budget, priorities)
@@ -0,0 +1,174 @@
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
+import cPickle
+from panda3d.core import NodePath
+from pavara.effects import Effect
+from pavara.base_objects import CompositeObject
+
+MAP_CACHE_MAGIC = 'PVMC'
+# Bump this whenever the geometry generated for map objects changes, so stale caches are rebuilt.
+MAP_CACHE_VERSION = 5
+# magic, version, SHA-1 of the source XML, length of the pickled index
+MAP_CACHE_HEADER = '!4sH20sL'
+
+def cache_path(path):
+    return os.path.splitext(path)[0] + '.pvm'
+
+def source_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+class CachedElement (object):
+    """
+    A read-only stand-in for a drill XmlElement, supporting just what Map needs to parse a map.
+    """
+
+    __slots__ = ('tagname', 'attrs', '_children')
+
+    def __init__(self, tagname, attrs, children):
+        self.tagname = tagname
+        self.attrs = attrs
+        self._children = children
+
+    def __getitem__(self, name):
+        return self.attrs.get(name)
+
+    def children(self, name=None):
+        for elem in self._children:
+            if name is None or elem.tagname == name:
+                yield elem
+
+def freeze(element):
+    return (element.tagname, dict(element.attrs), [freeze(child) for child in element.children()])
+
+def thaw(frozen):
+    tagname, attrs, children = frozen
+    return CachedElement(tagname, attrs, [thaw(child) for child in children])
+
+class Prebuilt (Effect):
+    """
+    Supplies the geometry of a map object from a MapCache, building (and recording) it only if the cache does not
+    have it yet. Always the innermost effect, so other effects still get to modify the node it returns.
+    """
+
+    def setup(self, cache):
+        self.map_cache = cache
+
+    def create_node(self):
+        node = self.map_cache.node(super(Prebuilt, self).create_node)
+        if hasattr(self, 'hull_geom'):
+            # Convex hull solids are built from the visible geometry.
+            self.geom = node.node()
+        return node
+
+    def create_solid(self):
+        if isinstance(self, CompositeObject):
+            hulls = self.map_cache.node(lambda: NodePath(self.hull_node())).node()
+            return super(Prebuilt, self).create_solid([hulls.get_geom(i) for i in xrange(hulls.get_num_geoms())])
+        return super(Prebuilt, self).create_solid()
+
+class MapCache (object):
+    """
+    The compiled form of a map file: the parsed XML tree, plus prebuilt geometry (as BAM streams) for each map object,
+    in the order Map asks for it. Caches are written next to the source XML as .pvm files, and are only used while the
+    SHA-1 of the XML still matches. Loaded caches are memory-mapped, and each node is decoded only when asked for.
+    """
+
+    def __init__(self, roots, data=None, spans=None):
+        self.roots = roots
+        self.data = data
+        self.spans = spans
+        self.recording = data is None
+        self.blobs = []
+        self.index = 0
+
+    def effect(self):
+        """
+        Returns the effect, with its setup arguments, that makes objects get their geometry from this cache.
+        """
+        return (Prebuilt, (self,))
+
+    def node(self, build):
+        """
+        Returns the next cached NodePath. When recording, calls build to create it, and remembers it.
+        """
+        if self.recording:
+            node = build()
+            self.blobs.append(node.encode_to_bam_stream())
+            return node
+        start, length = self.spans[self.index]
+        self.index += 1
+        return NodePath.decode_from_bam_stream(self.data[start:start + length])
+
+    def save(self, path):
+        """
+        Writes the cache to a temporary file next to the target, then renames it into place, so a crash (or another
+        process compiling the same map) never leaves a partly written cache behind.
+        """
+        index = cPickle.dumps(([freeze(root) for root in self.roots], [len(blob) for blob in self.blobs]), 2)
+        target = cache_path(path)
+        fd, temp = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(target) + '.',
+            dir=os.path.dirname(target) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack(MAP_CACHE_HEADER, MAP_CACHE_MAGIC, MAP_CACHE_VERSION, source_digest(path),
+                    len(index)))
+                f.write(index)
+                for blob in self.blobs:
+                    f.write(blob)
+            # mkstemp makes the file readable only by us.
+            os.chmod(temp, 0644)
+            try:
+                os.rename(temp, target)
+            except OSError:
+                # Windows will not rename over an existing file.
+                os.remove(target)
+                os.rename(temp, target)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the MapCache for the given map file, or None if there is no up-to-date (and intact) cache for it.
+        """
+        try:
+            with open(cache_path(path), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, mmap.error, ValueError):
+            return None
+        offset = struct.calcsize(MAP_CACHE_HEADER)
+        if len(data) < offset:
+            data.close()
+            return None
+        magic, version, digest, index_length = struct.unpack_from(MAP_CACHE_HEADER, data, 0)
+        if magic != MAP_CACHE_MAGIC or version != MAP_CACHE_VERSION or digest != source_digest(path):
+            data.close()
+            return None
+        try:
+            frozen, lengths = cPickle.loads(data[offset:offset + index_length])
+            roots = [thaw(root) for root in frozen]
+            offset += index_length
+            spans = []
+            for length in lengths:
+                spans.append((offset, int(length)))
+                offset += int(length)
+        except Exception:
+            # A corrupt index can fail to unpickle (or describe nonsense) in any number of ways.
+            data.close()
+            return None
+        if offset != len(data):
+            # Truncated, or not what the index describes.
+            data.close()
+            return None
+        return cls(roots, data, spans)
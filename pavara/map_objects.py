@@ -1,10 +1,11 @@
 from pavara.base_objects import *
-from pavara.utils.geom import GeomBuilder, to_cartesian
+from pavara.utils.geom import GeomBuilder, ArrayGeomBuilder, to_cartesian
 from panda3d.core import Shader, NodePath, LRotationf, LRotation, TransformState, Point2, Point3, Vec2, Vec3
 from pavara.assets import load_model
 from panda3d.bullet import BulletBoxShape, BulletGhostNode, BulletSphereShape, BulletPlaneShape, BulletRigidBodyNode, BulletConvexHullShape
 from direct.actor.Actor import Actor
 import math
+import random
 
 class Block (PhysicalObject):
     """
@@ -20,7 +21,7 @@ class Block (PhysicalObject):
         self.hpr = hpr
 
     def create_node(self):
-        return NodePath(GeomBuilder('block').add_block(self.color, (0, 0, 0), self.size).get_geom_node())
+        return NodePath(ArrayGeomBuilder('block').add_block(self.color, (0, 0, 0), self.size).get_geom_node())
 
     def create_solid(self):
         node = BulletRigidBodyNode(self.name)
@@ -58,7 +59,7 @@ class Ramp (PhysicalObject):
     def create_node(self):
         rel_base = Point3(self.base - (self.midpoint - Point3(0, 0, 0)))
         rel_top = Point3(self.top - (self.midpoint - Point3(0, 0, 0)))
-        self.geom = GeomBuilder().add_ramp(self.color, rel_base, rel_top, self.width, self.thickness).get_geom_node()
+        self.geom = ArrayGeomBuilder().add_ramp(self.color, rel_base, rel_top, self.width, self.thickness).get_geom_node()
         return NodePath(self.geom)
 
     def create_solid(self):
@@ -68,9 +69,15 @@ class Ramp (PhysicalObject):
         node.add_shape(mesh)
         return node
 
-    def add_solid(self, node):
+    def hull_geom(self):
+        """
+        The geometry of this ramp in its parent's space, for building a convex hull solid.
+        """
+        return ArrayGeomBuilder().add_ramp(self.color, self.base, self.top, self.width, self.thickness, LRotationf(*self.hpr)).get_geom()
+
+    def add_solid(self, node, geom=None):
         mesh = BulletConvexHullShape()
-        mesh.add_geom(GeomBuilder().add_ramp(self.color, self.base, self.top, self.width, self.thickness, LRotationf(*self.hpr)).get_geom())
+        mesh.add_geom(self.hull_geom() if geom is None else geom)
         node.add_shape(mesh)
         return node
 
@@ -99,7 +106,7 @@ class Wedge (PhysicalObject):
     def create_node(self):
         rel_base = Point3(self.base - (self.midpoint - Point3(0, 0, 0)))
         rel_top = Point3(self.top - (self.midpoint - Point3(0, 0, 0)))
-        self.geom = GeomBuilder().add_wedge(self.color, rel_base, rel_top, self.width).get_geom_node()
+        self.geom = ArrayGeomBuilder().add_wedge(self.color, rel_base, rel_top, self.width).get_geom_node()
         return NodePath(self.geom)
 
     def create_solid(self):
@@ -109,9 +116,15 @@ class Wedge (PhysicalObject):
         node.add_shape(mesh)
         return node
 
-    def add_solid(self, node):
+    def hull_geom(self):
+        """
+        The geometry of this wedge in its parent's space, for building a convex hull solid.
+        """
+        return ArrayGeomBuilder().add_wedge(self.color, self.base, self.top, self.width, LRotationf(*self.hpr)).get_geom()
+
+    def add_solid(self, node, geom=None):
         mesh = BulletConvexHullShape()
-        mesh.add_geom(GeomBuilder().add_wedge(self.color, self.base, self.top, self.width, LRotationf(*self.hpr)).get_geom())
+        mesh.add_geom(self.hull_geom() if geom is None else geom)
         node.add_shape(mesh)
         return node
 
@@ -196,7 +209,7 @@ class BlockRamp (PhysicalObject):
 
 
     def create_node(self):
-        return NodePath(GeomBuilder('ramp').add_block(self.color, (0, 0, 0), (self.thickness, self.width, self.length)).get_geom_node())
+        return NodePath(ArrayGeomBuilder('ramp').add_block(self.color, (0, 0, 0), (self.thickness, self.width, self.length)).get_geom_node())
 
     def create_solid(self):
         node = BulletRigidBodyNode(self.name)
@@ -204,9 +217,15 @@ class BlockRamp (PhysicalObject):
         return node
 
     def add_solid(self, node):
-        node.add_shape(BulletBoxShape(Vec3(self.thickness / 2.0, self.width / 2.0, self.length / 2.0)), TransformState.make_pos_hpr(Point3(*self.midpoint), self.hpr))
+        node.add_shape(BulletBoxShape(Vec3(self.thickness / 2.0, self.width / 2.0, self.length / 2.0)), TransformState.make_pos_hpr(Point3(*self.midpoint), self.composite_rotation().get_hpr()))
 
     def add_to(self, geom_builder):
+        geom_builder.add_block(self.color, self.midpoint, (self.thickness, self.width, self.length), self.composite_rotation())
+
+    def composite_rotation(self):
+        """
+        The rotation of this ramp when it is part of a CompositeObject.
+        """
         # honestly i don't understand this at all
         diff = self.top - self.base
         if diff.get_z() == 0:
@@ -218,9 +237,7 @@ class BlockRamp (PhysicalObject):
             vec1 = Vec2(diff.get_y(), abs(diff.get_z()))
             vec2 = Vec2(0, -1)
         rot = LRotation(diff.get_xz().signedAngleDeg(Vec2(0, -1)), (vec1.signedAngleDeg(vec2) ), 90)
-        rot = rot * LRotation(*self.hpr)
-        self.hpr = rot.get_hpr()
-        geom_builder.add_block(self.color, self.midpoint, (self.thickness, self.width, self.length), rot)
+        return rot * LRotation(*self.hpr)
 
     def attached(self):
         # Do the block rotation after we've been attached (i.e. have a NodePath), so we can use node.look_at.
@@ -244,7 +261,7 @@ class Dome (PhysicalObject):
         self.hpr = hpr
 
     def create_node(self):
-        self.geom = GeomBuilder().add_dome(self.color, (0, 0, 0), self.radius, self.samples, self.planes).get_geom_node()
+        self.geom = ArrayGeomBuilder().add_dome(self.color, (0, 0, 0), self.radius, self.samples, self.planes).get_geom_node()
         return NodePath(self.geom)
 
     def create_solid(self):
@@ -254,9 +271,15 @@ class Dome (PhysicalObject):
         node.add_shape(mesh)
         return node
 
-    def add_solid(self, node):
+    def hull_geom(self):
+        """
+        The geometry of this dome in its parent's space, for building a convex hull solid.
+        """
+        return ArrayGeomBuilder().add_dome(self.color, self.center, self.radius, self.samples, self.planes, LRotationf(*self.hpr)).get_geom()
+
+    def add_solid(self, node, geom=None):
         mesh = BulletConvexHullShape()
-        mesh.add_geom(GeomBuilder().add_dome(self.color, self.center, self.radius, self.samples, self.planes, LRotationf(*self.hpr)).get_geom())
+        mesh.add_geom(self.hull_geom() if geom is None else geom)
         node.add_shape(mesh)
         return node
 
@@ -268,7 +291,120 @@ class Dome (PhysicalObject):
         self.move(self.center)
         self.rotate_by(*self.hpr)
 
+def celestial_samples(radius):
+    """
+    How many sides the dome of a visible celestial with the given radius gets.
+    """
+    if radius <= 2.0:
+        return 6
+    elif radius >= 36.0:
+        return 40
+    return int(round(((1.5 * radius) * (2 / 3.0)) + 3.75))
+
+class Starfield (object):
+    """
+    Every star of a <starfield>, built in one pass into a single Geom. Each star looks exactly like a visible
+    celestial of the same size (a flat dome facing the origin), but its triangles are computed directly from the
+    star's rotated basis vectors rather than going through a Dome and GeomBuilder.add_dome. Seeded starfields always
+    come out the same, so their geometry is cached and shared.
+    """
+
+    cache = {}
+    # The unrotated triangles (and their normals) of a unit celestial dome with the given number of samples.
+    fans = {}
+
+    def __init__(self, seed, count, min_color, max_color, min_size, max_size, mode='default'):
+        self.seed = seed
+        self.count = count
+        self.min_color = tuple(min_color)
+        self.max_color = tuple(max_color)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mode = mode
+
+    def stars(self):
+        """
+        Yields (azimuth, elevation, color, size) for each star.
+        """
+        rng = random.Random(self.seed) if self.seed else random
+        min_r, min_g, min_b = self.min_color[:3]
+        delta_r = self.max_color[0] - min_r
+        delta_g = self.max_color[1] - min_g
+        delta_b = self.max_color[2] - min_b
+        delta_size = self.max_size - self.min_size
+        two_pi = math.pi * 2
+        half_pi = math.pi / 2
+        for s in xrange(self.count):
+            theta = two_pi * rng.random()
+            phi = abs(half_pi - math.acos(rng.random()))
+            if self.mode == 'realistic':
+                star_type = rng.randint(0,2)
+                if star_type == 0: # white star
+                    r = g = b = 1
+                elif star_type == 1: # orange/yellow
+                    r = 1
+                    g = 0.5 + rng.random() * 0.5
+                    b = g / 2
+                elif star_type == 2: # blue
+                    b = 1
+                    g = b * (1 - rng.random() * 0.30)
+                    r = g * (1 - rng.random() * 0.30)
+            elif self.mode == 'monochrome':
+                dice = rng.random()
+                r = min_r + dice * delta_r
+                g = min_g + dice * delta_g
+                b = min_b + dice * delta_b
+            else:
+                r = min_r + rng.random() * delta_r
+                g = min_g + rng.random() * delta_g
+                b = min_b + rng.random() * delta_b
+            color = (r, g, b, 1 - (1 - phi/math.pi)**6)
+            size = self.min_size + rng.random() * delta_size
+            yield theta, phi, color, size
+
+    @classmethod
+    def fan(cls, samples):
+        if samples not in cls.fans:
+            ring = [(math.sin(2 * math.pi * i / samples), 0.0, -math.cos(2 * math.pi * i / samples)) for i in range(samples + 1)]
+            apex = (0.0, 1.0, 0.0)
+            tris = []
+            for k in range(samples):
+                p1, p3 = ring[k], ring[k + 1]
+                v1 = [p1[i] - apex[i] for i in range(3)]
+                v2 = [apex[i] - p3[i] for i in range(3)]
+                n = (v1[1] * v2[2] - v1[2] * v2[1], v1[2] * v2[0] - v1[0] * v2[2], v1[0] * v2[1] - v1[1] * v2[0])
+                length = math.sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2])
+                tris.append(((p1, apex, p3), (n[0] / length, n[1] / length, n[2] / length)))
+            cls.fans[samples] = tris
+        return cls.fans[samples]
+
+    def add_to(self, geom_builder):
+        for azimuth, elevation, color, size in self.stars():
+            radius = size * 1.5
+            center = to_cartesian(azimuth, elevation, 1000.0 * 255.0 / 256.0)
+            rot = LRotationf(-math.degrees(azimuth), 90 + math.degrees(elevation), 0)
+            axes = [rot.xform(axis) for axis in (Vec3(1, 0, 0), Vec3(0, 1, 0), Vec3(0, 0, 1))]
+            # Rows of the rotation, scaled by the star's radius.
+            basis = [(axes[0][i] * radius, axes[1][i] * radius, axes[2][i] * radius) for i in range(3)]
+            for points, normal in self.fan(celestial_samples(size)):
+                points = [[center[i] + basis[i][0] * p[0] + basis[i][1] * p[1] + basis[i][2] * p[2] for i in range(3)] for p in points]
+                normal = [(basis[i][0] * normal[0] + basis[i][1] * normal[1] + basis[i][2] * normal[2]) / radius for i in range(3)]
+                geom_builder.add_triangle(color, points, normal)
+        return geom_builder
+
+    def get_geom_node(self):
+        key = (self.seed, self.count, self.min_color, self.max_color, self.min_size, self.max_size, self.mode)
+        if self.seed and key in self.cache:
+            return self.cache[key]
+        node = self.add_to(ArrayGeomBuilder('starfield')).get_geom_node()
+        if self.seed:
+            self.cache[key] = node
+        return node
+
 class Goody (PhysicalObject):
+    __slots__ = ('pos', 'grenades', 'missiles', 'boosters', 'model', 'respawn', 'spin', 'geom', 'active', 'timeout',
+        'spin_bone')
+
     def __init__(self, pos, model, items, respawn, spin, name=None):
         super(Goody, self).__init__(name)
         self.pos = Vec3(*pos)
@@ -335,11 +471,8 @@ class Goody (PhysicalObject):
             self.spin_bone.set_hpr(self.spin_bone, self.spin[2]*dt, self.spin[1]*dt, self.spin[0]*dt)
         else:
             self.rotate_by(*[x * dt for x in self.spin])
-        result = self.world.physics.contact_test(self.solid)
-        for contact in result.getContacts():
-            node_1 = contact.getNode0()
-            node_2 = contact.getNode1()
-            if "Walker" in node_2.get_name():
+        for contact in self.world.contacts(self):
+            if contact.other_category & CATEGORY_WALKER:
                # TODO: identify which player and credit them with the items.
                self.active = False
                self.node.hide()
@@ -401,6 +534,8 @@ class Ground (PhysicalObject):
     The ground. This is not a visible object, but does create a physical solid.
     """
 
+    category = CATEGORY_GROUND
+
     def __init__(self, radius, color, name=None):
         super(Ground, self).__init__(name)
         self.color = color
@@ -2,8 +2,8 @@ from pavara.utils import drill
 from pavara.map_objects import *
 from pavara.effects import *
 from pavara.world import World
+from pavara.map_cache import MapCache
 from panda3d.core import ColorAttrib
-import random
 import math
 
 def parse_int(s, default=0):
@@ -32,6 +32,9 @@ def parse_color(s, default=None):
         return list(v) + [1]
     return v
 
+# Objects whose geometry is worth caching; see pavara.map_cache.
+CACHEABLE_OBJECTS = (Block, Ramp, Wedge, BlockRamp, Dome, CompositeObject)
+
 class Map (object):
     """
     Includes meta-information about a map, along with a World object containing all the objects.
@@ -45,7 +48,7 @@ class Map (object):
     has_celestials = False
     effects = []
 
-    def __init__(self, root, world):
+    def __init__(self, root, world, cache=None):
         self.name = root['name'] or 'Untitled Map'
         self.author = root['author'] or 'Unknown Author'
         self.tagline = root['tagline']
@@ -53,6 +56,7 @@ class Map (object):
         self.preview_cam = (parse_vector(root['preview_cam_pos'], (0,20,40)), parse_vector(root['preview_cam_hp'], (0,0)))
         self.world = world #World(camera, debug=parse_bool(root['debug']), audio3d=audio3d)
         self.world.debug = parse_bool(root['debug'])
+        self.cache = cache
         self.process_children(root)
         if not self.has_celestials:
             self.world.add_celestial(math.radians(20), math.radians(45), (1, 1, 1, 1), 0.4, 30.0, False)
@@ -80,48 +84,54 @@ class Map (object):
 
     def parse_static(self, node):
         world = self.world
-        self.world = self.wrap_object(CompositeObject())
+        composite = CompositeObject()
+        self.world = composite
         self.process_children(node)
-        world.attach(self.world)
         self.world = world
+        self.attach(composite)
 
     def parse_transparent(self, node):
         alpha = parse_float(node['alpha'])
-        self.effects.append(lambda effected: Transparent(effected, alpha))
+        self.effects.append((Transparent, (alpha,)))
         self.process_children(node)
         self.effects.pop()
 
     def parse_freesolid(self, node):
         mass = parse_float(node['mass'])
-        self.effects.append(lambda effected: FreeSolid(effected, mass))
+        self.effects.append((FreeSolid, (mass,)))
         self.process_children(node)
         self.effects.pop()
 
     def parse_mortal(self, node):
         hp = parse_float(node['hp'])
-        self.effects.append(lambda effected: Mortal(effected, hp))
+        self.effects.append((Mortal, (hp,)))
         self.process_children(node)
         self.effects.pop()
 
     def parse_hologram(self, node):
-        self.effects.append(Hologram)
+        self.effects.append((Hologram, ()))
         self.process_children(node)
         self.effects.pop()
 
     def parse_hostile(self, node):
-        self.effects.append(Hostile)
+        self.effects.append((Hostile, ()))
         self.process_children(node)
         self.effects.pop()
 
-    def wrap_object(self, obj):
-        for effect in reversed(self.effects):
-            obj = effect(obj)
-        return obj
+    def attach(self, obj):
+        """
+        Gives the given object the current effects and attaches it to whatever is being populated (the World, or a
+        static CompositeObject). Geometry attached directly to the World comes from the map cache, if there is one.
+        """
+        effects = self.effects
+        if self.cache and isinstance(self.world, World) and isinstance(obj, CACHEABLE_OBJECTS):
+            effects = effects + [self.cache.effect()]
+        return self.world.attach(apply_effects(obj, effects))
 
     def parse_incarnator(self, node):
         pos = parse_vector(node['location'])
         heading = parse_float(node['heading'])
-        incarn = self.world.attach(self.wrap_object(Incarnator(pos, heading, name=node['id'])))
+        incarn = self.attach(Incarnator(pos, heading, name=node['id']))
 
     def parse_block(self, node):
         center = parse_vector(node['center'])
@@ -131,7 +141,7 @@ class Map (object):
         yaw = parse_float(node['yaw'])
         pitch = parse_float(node['pitch'])
         roll = parse_float(node['roll'])
-        block = self.world.attach(self.wrap_object(Block(size, color, mass, center, (yaw, pitch, roll), name=node['id'])))
+        block = self.attach(Block(size, color, mass, center, (yaw, pitch, roll), name=node['id']))
 
     def parse_ramp(self, node):
         base = parse_vector(node['base'])
@@ -143,7 +153,7 @@ class Map (object):
         yaw = parse_float(node['yaw'])
         pitch = parse_float(node['pitch'])
         roll = parse_float(node['roll'])
-        ramp = self.world.attach(self.wrap_object(Ramp(base, top, width, thickness, color, mass, (yaw, pitch, roll), name=node['id'])))
+        ramp = self.attach(Ramp(base, top, width, thickness, color, mass, (yaw, pitch, roll), name=node['id']))
 
     def parse_wedge(self, node):
         base = parse_vector(node['base'])
@@ -154,7 +164,7 @@ class Map (object):
         yaw = parse_float(node['yaw'])
         pitch = parse_float(node['pitch'])
         roll = parse_float(node['roll'])
-        wedge = self.world.attach(self.wrap_object(Wedge(base, top, width, color, mass, (yaw, pitch, roll), name=node['id'])))
+        wedge = self.attach(Wedge(base, top, width, color, mass, (yaw, pitch, roll), name=node['id']))
 
     def parse_blockramp(self, node):
         base = parse_vector(node['base'])
@@ -166,12 +176,12 @@ class Map (object):
         yaw = parse_float(node['yaw'])
         pitch = parse_float(node['pitch'])
         roll = parse_float(node['roll'])
-        ramp = self.world.attach(self.wrap_object(BlockRamp(base, top, width, thickness, color, mass, (yaw, pitch, roll), name=node['id'])))
+        ramp = self.attach(BlockRamp(base, top, width, thickness, color, mass, (yaw, pitch, roll), name=node['id']))
 
     def parse_ground(self, node):
         color = parse_color(node['color'], (1, 1, 1, 1))
         radius = parse_float(node['radius'], 1000)
-        self.world.attach(self.wrap_object(Ground(radius, color, name=(node['id'] or 'ground'))))
+        self.attach(Ground(radius, color, name=(node['id'] or 'ground')))
 
     def parse_goody(self, node):
         model = node["model"]
@@ -181,7 +191,7 @@ class Map (object):
         boosters = parse_int(node["boosters"])
         respawn = parse_float(node["respawn"], 8.0) # Default spawn time.
         spin = parse_vector(node['spin'])
-        goody = self.world.attach(self.wrap_object(Goody(pos, model, (grenades, missles, boosters), respawn, spin)))
+        goody = self.attach(Goody(pos, model, (grenades, missles, boosters), respawn, spin))
 
     def parse_dome(self, node):
         center = parse_vector(node['center'])
@@ -193,7 +203,7 @@ class Map (object):
         yaw = parse_float(node['yaw'])
         pitch = parse_float(node['pitch'])
         roll = parse_float(node['roll'])
-        dome = self.world.attach(self.wrap_object(Dome(radius, samples, planes, color, mass, center, (yaw, pitch, roll), name=node['id'])))
+        dome = self.attach(Dome(radius, samples, planes, color, mass, center, (yaw, pitch, roll), name=node['id']))
 
     def parse_sky(self, node):
         color = parse_color(node['color'], DEFAULT_SKY_COLOR)
@@ -225,56 +235,29 @@ class Map (object):
             max_size = parse_float(child['maxSize'], 1.0)
             mode = child['mode'] or 'default'
             mode = mode.strip().lower()
-            min_r = min_color[0]
-            delta_r = max_color[0] - min_r
-            min_g = min_color[1]
-            delta_g = max_color[1] - min_g
-            min_b = min_color[2]
-            delta_b = max_color[2] - min_b
-            delta_size = max_size - min_size
-            two_pi = math.pi * 2
-            half_pi = math.pi / 2
-            if seed:
-                random.seed(seed)
-            for s in range(count):
-                theta = two_pi * random.random()
-                phi = abs(half_pi - math.acos(random.random()))
-                if mode == 'realistic':
-                    star_type = random.randint(0,2)
-                    if star_type == 0: # white star
-                        r = g = b = 1
-                    elif star_type == 1: # orange/yellow
-                        r = 1
-                        g = 0.5 + random.random() * 0.5
-                        b = g / 2
-                    elif star_type == 2: # blue
-                        b = 1
-                        g = b * (1 - random.random() * 0.30)
-                        r = g * (1 - random.random() * 0.30)
-                elif mode == 'monochrome':
-                    dice = random.random()
-                    r = min_r + dice * delta_r
-                    g = min_g + dice * delta_g
-                    b = min_b + dice * delta_b
-                else:
-                    r = min_r + random.random() * delta_r
-                    g = min_g + random.random() * delta_g
-                    b = min_b + random.random() * delta_b
-                color = (r, g, b, 1 - (1 - phi/math.pi)**6)
-                size = min_size + random.random() * delta_size
-                self.world.add_celestial(theta, phi, color, 0, size, True)
-            # Reset the seed.
-            random.seed()
-
-def load_maps(path, world):
+            self.world.add_starfield(Starfield(seed, count, min_color, max_color, min_size, max_size, mode))
+
+def load_maps(path, world, use_cache=True):
     """
-    Given a path to an XML file and the world, returns a list of parsed/populated Map objects.
+    Given a path to an XML file and the world, returns a list of parsed/populated Map objects. Unless use_cache is
+    False, the map is loaded from its compiled cache when that is up to date, and the cache is (re)written otherwise.
     """
+    cache = MapCache.load(path) if use_cache else None
+    if cache:
+        maps = [Map(map_root, world, cache) for map_root in cache.roots]
+        cache.close()
+        return maps
     root = drill.parse(path)
     if root.tagname.lower() == 'map':
-        return [Map(root, world)]
+        roots = [root]
     else:
-        maps = []
-        for map_root in root.find('map'):
-            maps.append(Map(map_root, world))
-        return maps
+        roots = list(root.find('map'))
+    cache = MapCache(roots) if use_cache else None
+    maps = [Map(map_root, world, cache) for map_root in roots]
+    if cache:
+        try:
+            cache.save(path)
+        except (IOError, OSError):
+            # Not being able to write the cache (e.g. a read-only install) just means we build the map next time too.
+            pass
+    return maps
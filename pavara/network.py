@@ -7,20 +7,35 @@ from direct.distributed.PyDatagramIterator import PyDatagramIterator
 #from pandac.PandaModules import NetDatagram
 #from direct.gui.DirectGui import *
 import random
+import time
+from collections import deque
 
 from pavara.walker import Walker
+from pavara.packets import parse_packet, ack_packet, get_ack, input_packet, get_input, joined_packet, get_joined
+from pavara.packets import KIND_PLAYER_INPUT, KIND_SNAPSHOT_ACK, KIND_WORLD_SNAPSHOT, KIND_PLAYER_JOINED
+from pavara.snapshots import SnapshotEncoder, SnapshotStream, SnapshotDecoder, dequantize_pos, dequantize_hpr
+from pavara.interest import InterestManager
+from pavara.prediction import Prediction
+
+# Seconds to hold back every packet the client sends or receives, to try prediction and interpolation out against a
+# local server.
+simulated_latency = ConfigVariableDouble('pavara-simulated-latency', 0.0)
 
 class Player (object):
-    def __init__(self, pid, walker):
+    def __init__(self, pid, walker, connection=None):
         self.pid = pid
         self.walker = walker
+        self.snapshots = SnapshotStream()
+        # The pavara.transport.Connection to the player, for servers that talk to clients over UDP.
+        self.connection = connection
 
     def __repr__(self):
         return 'Player %s' % self.pid
 
-    def handle_command(self, direction, pressed):
+    def handle_command(self, direction, pressed, sequence=0):
         print 'PLAYER %s GOT CMD %s %s' % (self.pid, direction, pressed)
         self.walker.handle_command(direction, pressed)
+        self.snapshots.input_applied(sequence)
 
 class Server (object):
     def __init__(self, world, port):
@@ -32,6 +47,8 @@ class Server (object):
         self.connections = []
         self.players = {}
         self.last_pid = 0
+        self.snapshots = SnapshotEncoder(world)
+        self.interest = InterestManager(world)
         sock = self.manager.openTCPServerRendezvous(port, 1000)
         self.listener.addConnection(sock)
         taskMgr.doMethodLater(0.05, self.server_task, 'serverManagementTask')
@@ -48,7 +65,9 @@ class Server (object):
                 self.connections.append(newConnection)
                 self.reader.addConnection(newConnection)
                 self.last_pid += 1
-                self.players[netAddress.getIpString()] = Player(self.last_pid, self.world.create_walker())
+                player = Player(self.last_pid, self.world.attach(Walker(self.world.get_incarn())))
+                self.players[netAddress.getIpString()] = player
+                self.writer.send(PyDatagram(joined_packet(player.walker.name).flatten()), newConnection)
         while self.manager.resetConnectionAvailable():
             connPointer = PointerToConnection()
             self.manager.getResetConnection(connPointer)
@@ -62,24 +81,36 @@ class Server (object):
                 if self.connections[idx] == connection:
                     del self.connections[idx]
                     break
+        profiler = self.world.profiler
+        profiler.begin('Network:Receive')
         while self.reader.dataAvailable():
             datagram = NetDatagram()
             if self.reader.getData(datagram):
                 conn = datagram.getConnection()
-                dataIter = PyDatagramIterator(datagram)
                 addr = conn.getAddress()
                 player = self.players[addr.getIpString()]
-                player.handle_command(dataIter.getString(), dataIter.getBool())
-        update = PyDatagram()
-        update.addInt8(len([o for o in self.world.updatables if o.moved]))
-        for obj in self.world.updatables:
-            obj.add_update(update)
+                packet = parse_packet(datagram.getMessage())
+                if not packet:
+                    continue
+                if packet.kind == KIND_PLAYER_INPUT:
+                    player.handle_command(*get_input(packet), sequence=packet.sequence)
+                elif packet.kind == KIND_SNAPSHOT_ACK:
+                    player.snapshots.ack(get_ack(packet))
+        profiler.end('Network:Receive')
+        profiler.begin('Network:Send')
+        snapshot = self.snapshots.capture()
+        self.interest.index(snapshot)
         for conn in self.connections:
-            self.writer.send(update, conn)
+            player = self.players.get(conn.getAddress().getIpString())
+            if player:
+                walker = player.walker
+                packet = self.interest.encode(snapshot, player.snapshots, walker.position(), [walker.net_id])
+                self.writer.send(PyDatagram(packet.flatten()), conn)
+        profiler.end('Network:Send')
         return task.again
 
 class Client (object):
-    def __init__(self, world, host, port, timeout=3000):
+    def __init__(self, world, host, port, timeout=3000, latency=None):
         self.world = world
         self.manager = QueuedConnectionManager()
         self.reader = QueuedConnectionReader(self.manager, 0)
@@ -90,33 +121,94 @@ class Client (object):
             self.reader.addConnection(self.connection)
             self.connected = True
         self.players = {}
+        self.snapshots = SnapshotDecoder()
+        # The name of our own walker, once the server tells us, and the prediction that moves it.
+        self.walker_name = None
+        self.prediction = None
+        self.input_sequence = 0
+        self.latency = simulated_latency.getValue() if latency is None else latency
+        # (time due, data) of packets held back by the simulated latency.
+        self.incoming = deque()
+        self.outgoing = deque()
         taskMgr.add(self.update, 'clientUpdatesFromServer')
 
     def send(self, cmd, onoff):
         print 'CLIENT SEND', cmd, onoff
-        datagram = PyDatagram()
-        datagram.addString(cmd)
-        datagram.addBool(onoff)
-        self.writer.send(datagram, self.connection)
+        self.input_sequence += 1
+        if self.prediction:
+            self.prediction.command(self.input_sequence, cmd, onoff)
+        self.send_packet(input_packet(cmd, onoff, self.input_sequence))
+
+    def send_packet(self, packet):
+        self.outgoing.append((time.time() + self.latency, packet.flatten()))
+        self.flush(time.time())
+
+    def flush(self, now):
+        self.world.profiler.begin('Network:Send')
+        while self.outgoing and self.outgoing[0][0] <= now:
+            self.writer.send(PyDatagram(self.outgoing.popleft()[1]), self.connection)
+        self.world.profiler.end('Network:Send')
+
+    def handle_packet(self, packet):
+        if not packet:
+            return
+        if packet.kind == KIND_PLAYER_JOINED:
+            self.walker_name = get_joined(packet)
+        elif packet.kind == KIND_WORLD_SNAPSHOT:
+            snapshot = self.snapshots.decode(packet)
+            if not snapshot:
+                return
+            self.send_packet(ack_packet(snapshot.tick))
+            self.world.snapshots.add(snapshot, time.time())
+            self.reconcile(snapshot)
+
+    def reconcile(self, snapshot):
+        """
+        Corrects our own walker to where the snapshot has it, replaying whatever the server has not seen yet.
+        """
+        if self.walker_name is None:
+            return
+        for name, qpos, qhpr in snapshot.states.itervalues():
+            if name == self.walker_name:
+                break
+        else:
+            return
+        if self.prediction is None:
+            if name not in self.world.objects:
+                self.world.attach(Walker(self.world.get_incarn(), player=True, name=name))
+            self.prediction = Prediction(self.world.objects[name])
+            self.prediction.sequence = self.input_sequence
+        self.prediction.reconcile(dequantize_pos(qpos), dequantize_hpr(qhpr), snapshot.input_ack, snapshot.input_age)
 
     def update(self, task):
+        profiler = self.world.profiler
+        profiler.begin('Network:Receive')
+        now = time.time()
         while self.reader.dataAvailable():
             datagram = NetDatagram()
             if self.reader.getData(datagram):
-                update = PyDatagramIterator(datagram)
-                num_objects = update.getInt8()
-                for i in range(num_objects):
-                    name = update.getString()
-                    x = update.getFloat32()
-                    y = update.getFloat32()
-                    z = update.getFloat32()
-                    h = update.getFloat32()
-                    p = update.getFloat32()
-                    r = update.getFloat32()
-                    if name.startswith('Walker') and name not in self.world.objects:
-                        self.world.create_walker(name)
-                    obj = self.world.objects.get(name)
-                    if obj:
-                        obj.move((x, y, z))
-                        obj.rotate(h, p, r)
+                self.incoming.append((now + self.latency, datagram.getMessage()))
+        while self.incoming and self.incoming[0][0] <= now:
+            self.handle_packet(parse_packet(self.incoming.popleft()[1]))
+        profiler.end('Network:Receive')
+        self.flush(now)
+        # Draw everything as of a little while ago, between the snapshots on either side.
+        buffered = self.world.snapshots
+        if buffered.snapshots:
+            for name in buffered.removed(now):
+                obj = self.world.objects.get(name)
+                if obj:
+                    self.world.garbage.add(obj)
+                if name == self.walker_name:
+                    self.prediction = None
+            for name, pos, hpr in buffered.sample(now):
+                if name == self.walker_name:
+                    # Our own walker is predicted, not interpolated.
+                    continue
+                if name.startswith('Walker') and name not in self.world.objects:
+                    self.world.attach(Walker(self.world.get_incarn(), name=name))
+                obj = self.world.objects.get(name)
+                if obj:
+                    obj.move(pos)
+                    obj.rotate(*hpr)
         return task.cont
@@ -4,7 +4,8 @@ from twisted.internet import reactor
 from panda3d.core import *
 from panda3d.core import ConfigVariableString
 from pandac.PandaModules import *
-from pavara.packets import ServerPacket, ClientPacket
+from pavara.packets import *
+from pavara.transport import Connection
 from pavara.constants import *
 import sys
 import signal, random
@@ -12,17 +13,15 @@ import signal, random
 FPS = 60.0
 
 class Player (object):
-	def __init__(self, server, address, pid, name):
+	def __init__(self, server, address, pid, name, connection=None):
 		self.server = server
 		self.address = address
 		self.pid = pid
 		self.name = name
-		self.last_seq = 0
-		self.pending = {}
-		self.received = []
+		self.connection = connection or Connection()
 
-	def send(self, packet, transport):
-		transport.send(packet.flatten())
+	def send(self, packet):
+		self.connection.send(packet)
 
 	def __repr__(self):
 		return 'Player<%s:%s>' % (self.name, self.pid)
@@ -38,11 +37,9 @@ class Server(object):
 class ServerDatagramProtocol(DatagramProtocol):
 	def __init__(self):
 		#self.world = world
-		self.connections = set()
 		self.players = {}
 
 		self.last_pid = 0
-		self.last_txid = 0
 
 		self.updates = []
 
@@ -53,29 +50,47 @@ class ServerDatagramProtocol(DatagramProtocol):
 		self.last_pid += 1
 		return self.last_pid
 
-	@property
-	def next_txid(self):
-		self.last_txid += 1
-		return self.last_txid
-
 	def datagramReceived(self, data, addr):
-		if addr not in self.connections:
-			name = get_join_packet(data)
-			if name:
-				self.add_player(addr, name)
-			return
+		player = self.players.get(addr)
+		if player is None:
+			# Only a join starts a connection; the client resends it until we acknowledge it.
+			connection = Connection()
+			packets = connection.receive(data)
+			if not packets or packets[0].kind != KIND_PLAYER_JOIN:
+				return
+			player = self.add_player(addr, str(packets[0].payload), connection)
+			packets = packets[1:]
 		else:
-			pass
+			packets = player.connection.receive(data)
+		for packet in packets:
+			self.handle_packet(player, packet)
 
-	def add_player(self, addr, name):
+	def handle_packet(self, player, packet):
+		if packet.kind == KIND_CHAT_CHARS:
+			print '%r: %s' % (player, packet.payload)
+
+	def add_player(self, addr, name, connection=None):
 		print "Player '%s' joined from" % name, addr
-		p = Player(self, addr, self.next_pid, name)
+		p = Player(self, addr, self.next_pid, name, connection)
 		self.players[addr] = p
+		p.send(joined_packet(name))
+		return p
 
 	def server_task(self, task):
 
 		for u in self.updates:
 			self.send_update(u);
+		self.updates = []
+
+		for addr, player in self.players.items():
+			connection = player.connection
+			now = connection.clock()
+			if connection.timed_out(now):
+				print '%r timed out' % player
+				del self.players[addr]
+			elif connection.ready(now):
+				for datagram in connection.flush(now):
+					self.transport.write(datagram, addr)
 
 		return task.again
 
@@ -83,8 +98,8 @@ class ServerDatagramProtocol(DatagramProtocol):
 		self.send_to_all(packet)
 
 	def send_to_all(self, packet):
-		for player in self.players:
-			player.send(packet, self.transport)
+		for player in self.players.itervalues():
+			player.send(packet)
 
 class Client(object):
 	def __init__(self, host, port):
@@ -102,21 +117,18 @@ class ClientDatagramProtocol(DatagramProtocol):
 	def __init__(self, host, port):
 		self.host = host
 		self.port = port
-		self.last_txid = 0
-
-	@property
-	def next_txid(self):
-		self.last_txid += 1
-	    return self.last_txid
+		self.connection = Connection()
 
 	def startProtocol(self):
 		self.transport.connect(self.host, self.port)
 		nick = ConfigVariableString('nick', 'Some Jerk').getValue()
 		self.join_server(nick)
 
-	def datagram_received(self, data, addr):
-		p = parse_packet(data)
+	def datagramReceived(self, data, addr):
+		for p in self.connection.receive(data):
+			self.handle_packet(p)
 
+	def handle_packet(self, p):
 		if p.kind == KIND_PLAYER_JOINED:
 			pass
 		if p.kind == KIND_GAME_STARTED:
@@ -131,14 +143,19 @@ class ClientDatagramProtocol(DatagramProtocol):
 			pass
 
 	def join_server(self, nick):
-		self.transport.write(join_packet(nick))
+		self.connection.send(join_packet(nick))
 
 	def send_input(self):
 		pass
 
 	def send_chat_chars(self, chars):
-		self.transport.write(chat_packet(chars))
+		self.connection.send(chat_packet(chars))
 
 	def client_task(self, task):
+		connection = self.connection
+		now = connection.clock()
+		if connection.ready(now):
+			for datagram in connection.flush(now):
+				self.transport.write(datagram)
 
-		return task.again
\ No newline at end of file
+		return task.again
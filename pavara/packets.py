@@ -10,6 +10,7 @@ KIND_PLAYER_UPDATE = 0xA3
 KIND_WORLD_UPDATE = 0xA3
 KIND_PROJECTILE_SPAWN = 0xA4
 KIND_PROJECTILE_HIT = 0xA5
+KIND_WORLD_SNAPSHOT = 0xA6
 
 # Client-initiated
 
@@ -18,6 +19,8 @@ KIND_LOAD_MAP = 0x02
 KIND_GAME_START = 0x03
 KIND_CHANGE_NAME = 0x04
 KIND_CHAT_CHARS = 0x05
+KIND_SNAPSHOT_ACK = 0x06
+KIND_PLAYER_INPUT = 0x07
 
 class Packet(object):
 	HEADER_FORMAT = '!BHL'
@@ -61,4 +64,29 @@ def get_join_packet(data):
 	return False
 
 def join_packet(nick):
-	return Packet(KIND_PLAYER_JOIN, 0, payload=bytes(nick))
\ No newline at end of file
+	return Packet(KIND_PLAYER_JOIN, 0, payload=bytes(nick))
+
+def chat_packet(chars):
+	return Packet(KIND_CHAT_CHARS, 0, payload=bytes(chars))
+
+def joined_packet(name):
+	return Packet(KIND_PLAYER_JOINED, 0, payload=bytes(name))
+
+def get_joined(packet):
+	return str(packet.payload)
+
+def ack_packet(tick):
+	return Packet(KIND_SNAPSHOT_ACK, 0, payload=struct.pack('!L', tick))
+
+def get_ack(packet):
+	return struct.unpack('!L', packet.payload[:4])[0]
+
+def input_packet(cmd, pressed, sequence=0):
+	# Inputs are numbered (in the packet sequence) so snapshots can say which ones the server has applied.
+	packet = Packet(KIND_PLAYER_INPUT, 0, payload=struct.pack('!B', int(pressed)) + bytes(cmd))
+	packet.sequence = sequence
+	return packet
+
+def get_input(packet):
+	pressed = struct.unpack('!B', packet.payload[:1])[0]
+	return str(packet.payload[1:]), bool(pressed)
@@ -0,0 +1,88 @@
+from collections import deque
+from pavara.constants import PREDICTION_HISTORY
+
+# The commands that only move the walker, and so can be applied on the client without waiting for the server.
+PREDICTED_COMMANDS = ('forward', 'backward', 'left', 'right', 'crouch')
+
+class Prediction (object):
+    """
+    Client-side prediction for the local player's Walker. Inputs are applied locally as soon as they are made, and
+    every frame the walker simulates is recorded along with the inputs applied at its start. Snapshots from the server
+    say which input it last applied, and how long it has simulated since; reconcile puts the walker where the server
+    had it, and replays every recorded frame the server has not simulated yet on top of that. Both are measured on the
+    client's own clock of simulated time, anchored at the frame each input was first applied in.
+    """
+
+    def __init__(self, walker, history=PREDICTION_HISTORY):
+        self.walker = walker
+        walker.prediction = self
+        # The sequence number of the last input made (including ones that are not predicted).
+        self.sequence = 0
+        self.pending = []
+        # Seconds of walker movement simulated so far.
+        self.time = 0.0
+        # Input sequence number -> simulated time it was first applied at, for inputs the server may still ack.
+        self.applied = {}
+        # [input sequence, start time, dt, commands, motion state after applying the commands] for each recorded
+        # frame the server has not simulated yet.
+        self.frames = deque(maxlen=history)
+
+    def command(self, sequence, cmd, pressed):
+        """
+        Notes an input that was just sent to the server with the given sequence number. Movement is applied to the
+        walker at the start of its next update.
+        """
+        self.sequence = sequence
+        if cmd in PREDICTED_COMMANDS:
+            self.pending.append((cmd, pressed))
+
+    def record(self, dt):
+        """
+        Applies pending inputs, and records the frame of dt seconds the walker is about to simulate.
+        """
+        walker = self.walker
+        commands = self.pending
+        self.pending = []
+        for cmd, pressed in commands:
+            walker.handle_command(cmd, pressed)
+        if self.sequence not in self.applied:
+            self.applied[self.sequence] = self.time
+        self.frames.append([self.sequence, self.time, dt, commands, walker.motion_state()])
+        self.time += dt
+
+    def reconcile(self, pos, hpr, input_ack, input_age):
+        """
+        Corrects the walker to the server's position and hpr for it, which it had input_age seconds after applying
+        input input_ack, then replays the frames since.
+        """
+        frames = self.frames
+        anchor = self.applied.get(input_ack)
+        if anchor is None:
+            # We never applied that input (e.g. it was made before we started predicting); all we know is that the
+            # server has not seen anything later.
+            target = None
+            while frames and frames[0][0] <= input_ack:
+                frames.popleft()
+        else:
+            # Drop the frames the server has simulated all of. The one it is partway through is kept, since later
+            # snapshots may acknowledge the same input.
+            target = anchor + input_age
+            while frames and frames[0][1] + frames[0][2] <= target:
+                frames.popleft()
+        for sequence in [sequence for sequence in self.applied if sequence < input_ack]:
+            del self.applied[sequence]
+        walker = self.walker
+        walker.move(pos)
+        walker.rotate(*hpr)
+        if not frames:
+            return
+        frame = frames[0]
+        walker.restore_motion(frame[4])
+        walker.simulate(frame[2] - max(target - frame[1], 0.0) if target is not None else frame[2])
+        for i in xrange(1, len(frames)):
+            frame = frames[i]
+            for cmd, pressed in frame[3]:
+                walker.handle_command(cmd, pressed)
+            # Later reconciles may start from this frame, so remember how it starts now.
+            frame[4] = walker.motion_state()
+            walker.simulate(frame[2])
@@ -0,0 +1,159 @@
+import json
+import time
+import os
+from collections import deque
+from timeit import default_timer
+from panda3d.core import PStatCollector, ConfigVariableBool, ConfigVariableString, ConfigVariableInt
+
+profile_enabled = ConfigVariableBool('pavara-profile', False)
+profile_file = ConfigVariableString('pavara-profile-file', '')
+profile_window = ConfigVariableInt('pavara-profile-window', 300)
+
+# Histogram bucket bounds for phase times (in milliseconds) and for counts.
+PHASE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 33.0)
+COUNTER_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class RollingHistogram (object):
+    """
+    The most recent window samples of some per-frame value, e.g. the milliseconds spent in a phase.
+    """
+
+    def __init__(self, window, buckets):
+        self.samples = deque(maxlen=window)
+        # Upper bounds of the histogram buckets; anything larger lands in a final overflow bucket.
+        self.bounds = buckets
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def buckets(self):
+        counts = [0] * (len(self.bounds) + 1)
+        for value in self.samples:
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return counts
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {'count': 0}
+        def percentile(fraction):
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+        return {
+            'count': len(ordered),
+            'mean': float(sum(ordered)) / len(ordered),
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': ordered[-1],
+            'buckets': self.buckets(),
+        }
+
+class Phase (object):
+    def __init__(self, name, window):
+        self.collector = PStatCollector(name)
+        self.histogram = RollingHistogram(window, PHASE_BUCKETS)
+        self.elapsed = 0.0
+        self.started = 0.0
+
+class FrameProfiler (object):
+    """
+    Times named phases of each frame (or simulation tick) and counts named events, such as ray tests. Phases are
+    reported to PStats as they happen, under their names (use ':' to nest them, as PStats does), and both phases and
+    counters are kept as rolling histograms of their per-frame totals. If a file is configured, a summary of the
+    histograms is appended to it every window frames, as JSON lines or, if the file name ends in .csv, as CSV rows.
+
+    Everything is a no-op unless the profiler is enabled, which by default comes from the pavara-profile config
+    variable (with pavara-profile-file and pavara-profile-window for the sink).
+    """
+
+    def __init__(self, enabled=None, path=None, window=None):
+        self.enabled = profile_enabled.get_value() if enabled is None else enabled
+        self.path = profile_file.get_value() if path is None else path
+        self.window = profile_window.get_value() if window is None else window
+        self.phases = {}
+        self.counters = {}
+        self.counter_stats = {}
+        self.frame = 0
+
+    def phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(name, self.window)
+        return phase
+
+    def begin(self, name):
+        if self.enabled:
+            phase = self.phase(name)
+            phase.collector.start()
+            phase.started = default_timer()
+
+    def end(self, name):
+        if self.enabled:
+            phase = self.phases[name]
+            phase.elapsed += default_timer() - phase.started
+            phase.collector.stop()
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def end_frame(self):
+        """
+        Closes out the current frame, adding its phase times and counts to the histograms.
+        """
+        if not self.enabled:
+            return
+        for phase in self.phases.itervalues():
+            phase.histogram.add(phase.elapsed * 1000.0)
+            phase.elapsed = 0.0
+        for name in self.counters:
+            if name not in self.counter_stats:
+                self.counter_stats[name] = (PStatCollector('Counters:' + name), RollingHistogram(self.window, COUNTER_BUCKETS))
+        for name, (collector, histogram) in self.counter_stats.iteritems():
+            value = self.counters.get(name, 0)
+            collector.set_level(value)
+            histogram.add(value)
+        self.counters = {}
+        self.frame += 1
+        if self.path and self.frame % self.window == 0:
+            self.write()
+
+    def report(self):
+        return {
+            'frame': self.frame,
+            'time': time.time(),
+            'phases': dict((name, phase.histogram.summary()) for name, phase in self.phases.iteritems()),
+            'counters': dict((name, histogram.summary()) for name, (collector, histogram) in self.counter_stats.iteritems()),
+        }
+
+    def write(self):
+        report = self.report()
+        if self.path.endswith('.csv'):
+            new = not os.path.exists(self.path)
+            with open(self.path, 'a') as f:
+                if new:
+                    f.write('frame,time,kind,name,count,mean,p50,p90,p99,max\n')
+                for kind in ('phases', 'counters'):
+                    for name, summary in sorted(report[kind].iteritems()):
+                        if summary['count']:
+                            f.write('%d,%.3f,%s,%s,%d,%f,%f,%f,%f,%f\n' % (report['frame'], report['time'], kind[:-1], name,
+                                summary['count'], summary['mean'], summary['p50'], summary['p90'], summary['p99'], summary['max']))
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+
+_profiler = None
+
+def get_profiler():
+    """
+    Returns the process-wide FrameProfiler, creating it (from the config variables) on first use.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = FrameProfiler()
+    return _profiler
@@ -2,23 +2,25 @@ from pandac.PandaModules import Point3
 from panda3d.bullet import BulletGhostNode, BulletSphereShape, BulletRigidBodyNode
 from direct.actor.Actor import Actor
 from pavara.base_objects import PhysicalObject
-from pavara.effects import TriangleExplosion
-from pavara.utils.integrator import Integrator
 from pavara.assets import load_model
 from pavara.constants import *
 import math
 import random
 
 class Projectile(PhysicalObject):
-    pass
+    __slots__ = ('pos', 'hpr')
+
+    net_priority = 2.0
 
 class Plasma (Projectile):
+    __slots__ = ('energy', 'sound')
+
     def __init__(self, pos, hpr, energy, name=None):
         super(Plasma, self).__init__(name)
         self.pos = Vec3(*pos)
         self.hpr = hpr
         self.energy = energy
-        self.age = 0
+        self.sound = None
 
     def create_node(self):
         m = load_model('plasma.egg')
@@ -48,50 +50,51 @@ class Plasma (Projectile):
         #self.world.scene.set_light(self.light_node)
         self.world.register_updater(self)
         self.world.register_collider(self)
+        self.world.entities.lifetimes.add(self, PLASMA_LIFESPAN, 60)
         self.solid.setIntoCollideMask(NO_COLLISION_BITS)
-        self.sound = self.world.audio3d.loadSfx('Sounds/plasma.wav')
-        self.sound.set_balance(0)
-        self.world.audio3d.attachSoundToObject(self.sound, self.node)
-        self.world.audio3d.setSoundVelocity(self.sound, self.world.scene.get_relative_vector(self.node, Vec3(0,0,400)))
-        self.sound.set_loop(True)
-        self.sound.play()
+        self.sound = None
+        if self.world.audio3d:
+            self.sound = self.world.audio3d.loadSfx('Sounds/plasma.wav')
+            self.sound.set_balance(0)
+            self.world.audio3d.attachSoundToObject(self.sound, self.node)
+            self.world.audio3d.setSoundVelocity(self.sound, self.world.scene.get_relative_vector(self.node, Vec3(0,0,400)))
+            self.sound.set_loop(True)
+            self.sound.play()
 
     def update(self, dt):
         self.move_by(0,0,(dt*60)/4)
         self.rotate_by(0,0,(dt*60)*3)
-        result = self.world.physics.contact_test(self.solid)
-        self.age += dt*60
-        contacts = result.getContacts()
+        contacts = self.world.contacts(self)
         if len(contacts) > 0:
             #self.world.scene.clear_light(self.light_node)
             cf = self.energy
             expl_color = [1,(150/255.0)*cf,(150/255.0)*cf, 1]
             expl_pos = self.node.get_pos(self.world.scene)
-            expl = self.world.attach(TriangleExplosion(expl_pos, 5, size=.1, color=expl_color))
-            contact = contacts[0]
-            contact.getManifoldPoint().getLocalPointB()
-            n1_name = contact.getNode1().get_name()
-            self.world.do_plasma_push(self, n1_name, self.energy)
-            self.sound.stop()
-            self.world.audio3d.detachSound(self.sound)
-            self.world.garbage.add(self)
+            self.world.debris.explode(expl_pos, 5, size=.1, color=expl_color)
+            self.world.do_plasma_push(self, contacts[0].other_obj, contacts[0].other_category, self.energy)
+            self._remove_all()
 
-        if self.age > PLASMA_LIFESPAN:
-            self.sound.stop()
-            self.world.audio3d.detachSound(self.sound)
-            self.world.garbage.add(self)
+    def expire(self):
+        self._remove_all()
 
     def decompose(self):
         pass
 
+    def _remove_all(self):
+        if self.sound:
+            self.sound.stop()
+            self.world.audio3d.detachSound(self.sound)
+        self.world.garbage.add(self)
+
 class Missile (Projectile):
+    __slots__ = ('color', 'sound', 'model', 'body', 'main_engines', 'wing_engines')
+
     def __init__(self, pos, hpr, color, name=None):
         super(Missile, self).__init__(name)
         self.pos = Vec3(*pos)
         self.hpr = hpr
-        self.age = 0
         self.color = color
-        self.velocity = Vec3(0,0,0)
+        self.sound = None
 
     def create_node(self):
         self.model = load_model('missile.egg')
@@ -118,12 +121,15 @@ class Missile (Projectile):
         self.world.register_updater(self)
         self.world.register_collider(self)
         self.solid.setIntoCollideMask(NO_COLLISION_BITS)
-        self.sound = self.world.audio3d.loadSfx('Sounds/plasma.wav')
-        self.sound.set_balance(0)
-        self.world. audio3d.attachSoundToObject(self.sound, self.node)
-        self.sound.set_loop(True)
-        self.sound.play()
-        self.integrator = Integrator(self.world.scene.get_relative_vector(self.node, Vec3(0,0,30)))
+        self.sound = None
+        if self.world.audio3d:
+            self.sound = self.world.audio3d.loadSfx('Sounds/plasma.wav')
+            self.sound.set_balance(0)
+            self.world.audio3d.attachSoundToObject(self.sound, self.node)
+            self.sound.set_loop(True)
+            self.sound.play()
+        self.world.entities.bodies.add(self, self.pos, Vec3(0,0,0), self.world.scene.get_relative_vector(self.node, MISSILE_THRUST))
+        self.world.entities.lifetimes.add(self, MISSILE_LIFESPAN)
 
     def decompose(self):
         clist = list(self.color)
@@ -132,42 +138,43 @@ class Missile (Projectile):
         expl_colors.extend(ENGINE_COLORS)
         expl_pos = self.node.get_pos(self.world.scene)
         for c in expl_colors:
-            self.world.attach(TriangleExplosion(expl_pos, 1, size=.1, color=c, lifetime=40))
+            self.world.debris.explode(expl_pos, 1, size=.1, color=c, lifetime=40)
         self._remove_all()
 
     def update(self, dt):
-        current_pos = Point3(0, self.position().get_y(), 0)
-        pos, self.velocity = self.integrator.integrate(self.node.get_pos(), self.velocity, dt)
-        if self.velocity.length() > 30:
-            self.integrator.accel = Vec3(0,0,0)
+        # The world's bodies have already been integrated (and moved) this tick; just keep the thrust up to date.
+        bodies = self.world.entities.bodies
+        if bodies.speed(self) > 30:
+            bodies.set_accel(self, MISSILE_COAST)
         else:
-            self.integrator.accel = self.world.scene.get_relative_vector(self.node, Vec3(0,0,30))
-        self.move(self.position() + (pos - self.node.get_pos()))
+            bodies.set_accel(self, self.world.scene.get_relative_vector(self.node, MISSILE_THRUST))
 
         self.main_engines.set_color(*random.choice(ENGINE_COLORS))
         self.wing_engines.set_color(*random.choice(ENGINE_COLORS))
-        result = self.world.physics.contact_test(self.solid)
-        self.age += dt
-        if len(result.getContacts()) > 0:
+        if len(self.world.contacts(self)) > 0:
             clist = list(self.color)
             clist.extend([1])
             expl_colors = [clist]
             expl_colors.extend(ENGINE_COLORS)
             expl_pos = self.node.get_pos(self.world.scene)
             for c in expl_colors:
-                self.world.attach(TriangleExplosion(expl_pos, 3, size=.1, color=c, lifetime=80))
+                self.world.debris.explode(expl_pos, 3, size=.1, color=c, lifetime=80)
             self.world.do_explosion(self.node, 1.5, 30)
             self._remove_all()
 
-        if self.age > MISSILE_LIFESPAN:
-            self._remove_all()
+    def expire(self):
+        self._remove_all()
 
     def _remove_all(self):
-        self.sound.stop()
-        self.world.audio3d.detachSound(self.sound)
+        if self.sound:
+            self.sound.stop()
+            self.world.audio3d.detachSound(self.sound)
         self.world.garbage.add(self)
 
 class Grenade (Projectile):
+    __slots__ = ('move_divisor', 'color', 'forward_m', 'walker_v', 'model', 'shell', 'inner_top', 'inner_bottom',
+        'spin_bone')
+
     def __init__(self, pos, hpr, color, walker_v, name=None):
         super(Grenade, self).__init__(name)
         self.pos = Vec3(*pos)
@@ -216,18 +223,16 @@ class Grenade (Projectile):
         expl_colors.extend(ENGINE_COLORS)
         expl_pos = self.node.get_pos(self.world.scene)
         for c in expl_colors:
-            self.world.attach(TriangleExplosion(expl_pos, 1, size=.1, color=c, lifetime=40))
+            self.world.debris.explode(expl_pos, 1, size=.1, color=c, lifetime=40)
         self.world.garbage.add(self)
 
     def update(self, dt):
         self.inner_top.set_color(*random.choice(ENGINE_COLORS))
         self.inner_bottom.set_color(*random.choice(ENGINE_COLORS))
-        result = self.world.physics.contact_test(self.solid)
         self.spin_bone.set_hpr(self.spin_bone, 0,0,10)
-        contacts = result.getContacts()
+        contacts = self.world.contacts(self)
         if len(contacts) > 0:
-            hit_node = contacts[0].get_node1().get_name()
-            if hit_node.endswith("_walker_cap"):
+            if contacts[0].other_category & CATEGORY_WALKER_CAPSULE:
                 return
             clist = list(self.color)
             clist.extend([1])
@@ -235,7 +240,7 @@ class Grenade (Projectile):
             expl_colors.extend(ENGINE_COLORS)
             expl_pos = self.node.get_pos(self.world.scene)
             for c in expl_colors:
-                self.world.attach(TriangleExplosion(expl_pos, 3, size=.1, color=c, lifetime=80,))
+                self.world.debris.explode(expl_pos, 3, size=.1, color=c, lifetime=80)
             self.world.do_explosion(self.node, 3, 100)
             self.world.garbage.add(self)
 
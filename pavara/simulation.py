@@ -0,0 +1,86 @@
+import time
+from pavara.constants import SERVER_TICK_RATE, MAX_CATCHUP_TICKS
+
+class Simulation (object):
+    """
+    Steps a World at a fixed tick rate, independent of any renderer or task manager. Real time is fed into an
+    accumulator, and the world is stepped in whole ticks of 1/tick_rate seconds. If the simulation falls behind
+    (e.g. the process was descheduled), at most max_catchup ticks are run per advance, and the rest of the backlog
+    is dropped rather than letting the server spiral trying to catch up.
+    """
+
+    def __init__(self, world, tick_rate=SERVER_TICK_RATE, max_catchup=MAX_CATCHUP_TICKS, clock=time.time):
+        self.world = world
+        self.tick_rate = tick_rate
+        self.tick_dt = 1.0 / tick_rate
+        self.max_catchup = max_catchup
+        self.clock = clock
+        self.tick = 0
+        self.accumulator = 0.0
+        self.dropped_ticks = 0
+        self.last_time = None
+        self.running = False
+
+    def step(self):
+        """
+        Runs exactly one simulation tick.
+        """
+        self.world.step(self.tick_dt)
+        self.tick += 1
+
+    def advance(self, elapsed):
+        """
+        Adds elapsed seconds of real time to the accumulator and runs as many whole ticks as fit, up to max_catchup.
+        Returns the number of ticks that were run.
+        """
+        self.accumulator += elapsed
+        ticks = 0
+        while self.accumulator >= self.tick_dt and ticks < self.max_catchup:
+            self.step()
+            self.accumulator -= self.tick_dt
+            ticks += 1
+        if self.accumulator >= self.tick_dt:
+            dropped = int(self.accumulator / self.tick_dt)
+            self.dropped_ticks += dropped
+            self.accumulator -= dropped * self.tick_dt
+        return ticks
+
+    def poll(self):
+        """
+        Advances the simulation by however much real time has passed since the last poll. Suitable for calling from
+        an external loop, such as a Twisted LoopingCall.
+        """
+        now = self.clock()
+        if self.last_time is None:
+            self.last_time = now
+        elapsed = now - self.last_time
+        self.last_time = now
+        return self.advance(elapsed)
+
+    @property
+    def alpha(self):
+        """
+        How far (0-1) real time has progressed into the next tick. Useful for interpolating between ticks.
+        """
+        return self.accumulator / self.tick_dt
+
+    def run(self, duration=None):
+        """
+        Blocks, stepping the world in real time until stop is called or duration seconds have passed.
+        """
+        self.running = True
+        start = self.clock()
+        self.last_time = start
+        while self.running:
+            self.poll()
+            now = self.clock()
+            if duration is not None and now - start >= duration:
+                break
+            # Sleep until the next tick is due.
+            remaining = self.tick_dt - self.accumulator
+            if remaining > 0:
+                time.sleep(remaining)
+        self.running = False
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,367 @@
+import struct
+import time
+from collections import deque
+from pavara.constants import SNAPSHOT_HISTORY, POSITION_QUANTUM, ANGLE_QUANTUM
+from pavara.constants import RENDER_DELAY, MAX_EXTRAPOLATION, SNAPSHOT_BUFFER_SIZE
+from pavara.packets import Packet, KIND_WORLD_SNAPSHOT
+from pavara.base_objects import PhysicalObject
+from panda3d.bullet import BulletRigidBodyNode
+
+# Per-entry flags.
+SNAP_NEW = 0x01         # The object name follows; the client should (re)bind this net ID to it.
+SNAP_POS = 0x02         # Position follows.
+SNAP_POS_DELTA = 0x04   # Position is a signed 16-bit delta against the baseline, rather than an absolute 32-bit value.
+SNAP_HPR = 0x08         # Heading, pitch and roll follow.
+SNAP_REMOVED = 0x10     # The object no longer exists.
+
+# baseline tick, server time in ms, last input applied, ms since it was applied, entry count (the snapshot tick is the
+# packet sequence)
+SNAPSHOT_HEADER = '!LLLLH'
+ENTRY_HEADER = '!HB'        # net ID, flags
+NAME_LENGTH = '!B'
+ABSOLUTE_POS = '!3i'
+DELTA_POS = '!3h'
+HPR = '!3H'
+
+DELTA_MIN = -32768
+DELTA_MAX = 32767
+
+def quantize_pos(pos):
+    return (int(round(pos[0] / POSITION_QUANTUM)), int(round(pos[1] / POSITION_QUANTUM)), int(round(pos[2] / POSITION_QUANTUM)))
+
+def quantize_hpr(hpr):
+    return (int(round(hpr[0] / ANGLE_QUANTUM)) & 0xFFFF, int(round(hpr[1] / ANGLE_QUANTUM)) & 0xFFFF, int(round(hpr[2] / ANGLE_QUANTUM)) & 0xFFFF)
+
+def dequantize_pos(qpos):
+    return (qpos[0] * POSITION_QUANTUM, qpos[1] * POSITION_QUANTUM, qpos[2] * POSITION_QUANTUM)
+
+def dequantize_hpr(qhpr):
+    return tuple((a if a < 32768 else a - 65536) * ANGLE_QUANTUM for a in qhpr)
+
+def lerp_angle(a, b, t):
+    return a + (((b - a) + 180.0) % 360.0 - 180.0) * t
+
+class Snapshot (object):
+    """
+    The quantized state of every networked object at a given tick. States are keyed by net ID and hold
+    (name, quantized position, quantized hpr) tuples. The time is in seconds on the server's clock, to millisecond
+    precision. Decoded snapshots also say which of the client's inputs the server had applied (input_ack), and how
+    many seconds it had been simulating since (input_age).
+    """
+
+    def __init__(self, tick, states, removed=None, changed=None, time=0.0):
+        self.tick = tick
+        self.time = time
+        self.input_ack = 0
+        self.input_age = 0.0
+        self.states = states
+        self.removed = removed or []
+        self.changed = changed
+
+    def transforms(self):
+        """
+        Yields (name, position, hpr) in world units for every object that changed in this snapshot (or for every
+        object, if the snapshot was captured rather than decoded).
+        """
+        net_ids = self.states.iterkeys() if self.changed is None else self.changed
+        for net_id in net_ids:
+            name, qpos, qhpr = self.states[net_id]
+            yield name, dequantize_pos(qpos), dequantize_hpr(qhpr)
+
+class SnapshotEncoder (object):
+    """
+    Captures server-side snapshots of a World. Only objects that can actually move are captured: anything that is
+    updatable, plus any non-static rigid body (e.g. free solids).
+    """
+
+    def __init__(self, world, clock=time.time):
+        self.world = world
+        self.tick = 0
+        self.clock = clock
+        self.start = clock()
+
+    def is_networked(self, obj):
+        if not isinstance(obj, PhysicalObject) or obj.net_id is None or not obj.node:
+            return False
+        if obj in self.world.entities.updaters:
+            return True
+        return isinstance(obj.solid, BulletRigidBodyNode) and not obj.solid.is_static()
+
+    def capture(self):
+        self.tick += 1
+        states = {}
+        for obj in self.world.objects.itervalues():
+            if self.is_networked(obj):
+                states[obj.net_id] = (obj.name, quantize_pos(obj.node.get_pos()), quantize_hpr(obj.node.get_hpr()))
+        return Snapshot(self.tick, states, time=round(self.clock() - self.start, 3))
+
+class SnapshotStream (object):
+    """
+    The server's per-client view of snapshots. Each snapshot is delta-encoded against the most recent snapshot the
+    client has acknowledged, so objects that have not changed since then cost nothing. If the client has not
+    acknowledged anything we still remember, a full snapshot is sent. Every snapshot also acknowledges the last input
+    the client sent that the server has applied, for client-side prediction.
+    """
+
+    def __init__(self, history=SNAPSHOT_HISTORY, clock=time.time):
+        self.history = history
+        self.clock = clock
+        self.acked = 0
+        self.input_ack = 0
+        self.input_time = 0.0
+        # What the client will know once it receives each snapshot we sent, keyed by tick.
+        self.known = {}
+        # Priority built up by objects that were relevant but did not fit in the byte budget, keyed by net ID.
+        self.starvation = {}
+
+    def ack(self, tick):
+        if tick > self.acked and tick in self.known:
+            self.acked = tick
+            for old in [t for t in self.known if t < tick]:
+                del self.known[old]
+
+    def input_applied(self, sequence):
+        """
+        Records that the client's input with the given sequence number has been applied.
+        """
+        if sequence > self.input_ack:
+            self.input_ack = sequence
+            self.input_time = self.clock()
+
+    def encode(self, snapshot, net_ids=None, budget=None, priorities=None):
+        """
+        Encodes the snapshot as a packet for this client. If net_ids is given, only those objects are considered,
+        in that order, and entries stop being added once the payload would exceed budget bytes; objects the client
+        knows about that are no longer in net_ids are removed from its view. Objects that were skipped for lack of
+        room accumulate their priority (from priorities) so they win out in later snapshots.
+        """
+        baseline_tick = self.acked if self.acked in self.known else 0
+        baseline = self.known.get(baseline_tick, {})
+        # Removals are always sent; they are tiny, and a client must never keep a ghost of a dead object (or one that
+        # has gone out of its scope, which would otherwise sit frozen where it was last seen).
+        if net_ids is None:
+            removed = [net_id for net_id in baseline if net_id not in snapshot.states]
+        else:
+            relevant = set(net_ids)
+            removed = [net_id for net_id in baseline if net_id not in relevant]
+        entries = [struct.pack(ENTRY_HEADER, net_id, SNAP_REMOVED) for net_id in removed]
+        for net_id in removed:
+            self.starvation.pop(net_id, None)
+        size = struct.calcsize(SNAPSHOT_HEADER) + len(entries) * struct.calcsize(ENTRY_HEADER)
+        if net_ids is None:
+            known = snapshot.states
+            for net_id, state in snapshot.states.iteritems():
+                entry = self._encode_entry(net_id, state, baseline.get(net_id))
+                if entry:
+                    entries.append(entry)
+        else:
+            known = dict(baseline)
+            for net_id in removed:
+                del known[net_id]
+            for net_id in [net_id for net_id in self.starvation if net_id not in relevant]:
+                del self.starvation[net_id]
+            full = False
+            for net_id in net_ids:
+                state = snapshot.states[net_id]
+                entry = None if full else self._encode_entry(net_id, state, baseline.get(net_id))
+                if entry and budget is not None and size + len(entry) > budget:
+                    full = True
+                    entry = None
+                if full:
+                    if priorities and known.get(net_id) != state:
+                        self.starvation[net_id] = self.starvation.get(net_id, 0.0) + priorities.get(net_id, 0.0)
+                    continue
+                if entry:
+                    entries.append(entry)
+                    size += len(entry)
+                known[net_id] = state
+                self.starvation.pop(net_id, None)
+        self.known[snapshot.tick] = known
+        if len(self.known) > self.history:
+            del self.known[min(self.known)]
+        server_time = int(snapshot.time * 1000) & 0xFFFFFFFF
+        input_age = min(int((self.clock() - self.input_time) * 1000), 0xFFFFFFFF) if self.input_ack else 0
+        header = struct.pack(SNAPSHOT_HEADER, baseline_tick, server_time, self.input_ack, input_age, len(entries))
+        packet = Packet(KIND_WORLD_SNAPSHOT, payload=header + ''.join(entries))
+        packet.sequence = snapshot.tick
+        return packet
+
+    def _encode_entry(self, net_id, state, base):
+        name, qpos, qhpr = state
+        flags = 0
+        data = []
+        if base is None or base[0] != name:
+            flags |= SNAP_NEW
+            base = None
+            data.append(struct.pack(NAME_LENGTH, len(name)) + name)
+        if base is None or base[1] != qpos:
+            flags |= SNAP_POS
+            if base is not None:
+                delta = [qpos[i] - base[1][i] for i in range(3)]
+                if DELTA_MIN <= min(delta) and max(delta) <= DELTA_MAX:
+                    flags |= SNAP_POS_DELTA
+                    data.append(struct.pack(DELTA_POS, *delta))
+            if not flags & SNAP_POS_DELTA:
+                data.append(struct.pack(ABSOLUTE_POS, *qpos))
+        if base is None or base[2] != qhpr:
+            flags |= SNAP_HPR
+            data.append(struct.pack(HPR, *qhpr))
+        if not flags:
+            return None
+        return struct.pack(ENTRY_HEADER, net_id, flags) + ''.join(data)
+
+class SnapshotDecoder (object):
+    """
+    The client side of a SnapshotStream. Keeps the decoded states of recent snapshots around so later deltas can be
+    applied to whichever baseline the server chose.
+    """
+
+    def __init__(self):
+        self.states = {0: {}}
+        self.latest = 0
+
+    def decode(self, packet):
+        """
+        Returns the decoded Snapshot, or None if the packet is stale or its baseline is unknown.
+        """
+        tick = packet.sequence
+        if tick <= self.latest:
+            return None
+        payload = packet.payload
+        baseline_tick, server_time, input_ack, input_age, count = struct.unpack_from(SNAPSHOT_HEADER, payload, 0)
+        if baseline_tick not in self.states:
+            return None
+        states = dict(self.states[baseline_tick])
+        removed = []
+        changed = []
+        offset = struct.calcsize(SNAPSHOT_HEADER)
+        for i in xrange(count):
+            net_id, flags = struct.unpack_from(ENTRY_HEADER, payload, offset)
+            offset += struct.calcsize(ENTRY_HEADER)
+            if flags & SNAP_REMOVED:
+                state = states.pop(net_id, None)
+                if state:
+                    removed.append(state[0])
+                continue
+            base = states.get(net_id)
+            if flags & SNAP_NEW:
+                length = struct.unpack_from(NAME_LENGTH, payload, offset)[0]
+                offset += struct.calcsize(NAME_LENGTH)
+                name = payload[offset:offset + length]
+                offset += length
+                if base is not None and base[0] != name:
+                    removed.append(base[0])
+                qpos, qhpr = (0, 0, 0), (0, 0, 0)
+            else:
+                name, qpos, qhpr = base
+            if flags & SNAP_POS:
+                if flags & SNAP_POS_DELTA:
+                    delta = struct.unpack_from(DELTA_POS, payload, offset)
+                    offset += struct.calcsize(DELTA_POS)
+                    qpos = (qpos[0] + delta[0], qpos[1] + delta[1], qpos[2] + delta[2])
+                else:
+                    qpos = struct.unpack_from(ABSOLUTE_POS, payload, offset)
+                    offset += struct.calcsize(ABSOLUTE_POS)
+            if flags & SNAP_HPR:
+                qhpr = struct.unpack_from(HPR, payload, offset)
+                offset += struct.calcsize(HPR)
+            states[net_id] = (name, qpos, qhpr)
+            changed.append(net_id)
+        # The server only ever deltas against snapshots we acknowledged, and never against anything older than the
+        # baseline it just used, so anything before that can go. The empty baseline is always kept for full snapshots.
+        for old in [t for t in self.states if 0 < t < baseline_tick]:
+            del self.states[old]
+        self.states[tick] = states
+        self.latest = tick
+        snapshot = Snapshot(tick, states, removed, changed, server_time / 1000.0)
+        snapshot.input_ack = input_ack
+        snapshot.input_age = input_age / 1000.0
+        return snapshot
+
+class SnapshotBuffer (object):
+    """
+    The client's buffer of recently received snapshots, for drawing remote objects smoothly however server ticks and
+    client frames line up. Objects are drawn render_delay seconds in the past, interpolated between the two snapshots
+    on either side of that time. If no newer snapshot has arrived (e.g. one was lost), positions are extrapolated
+    from the last two snapshots for up to max_extrapolation seconds, and then held. Removals are held back the same
+    way, so objects do not vanish before they are drawn at their last positions.
+
+    Snapshots are timestamped with the server's clock. The offset to the local clock is taken as the smallest
+    (arrival time - server time) seen recently, i.e. from the least delayed snapshot, so jitter does not move it.
+    """
+
+    def __init__(self, render_delay=RENDER_DELAY, max_extrapolation=MAX_EXTRAPOLATION, size=SNAPSHOT_BUFFER_SIZE):
+        self.render_delay = render_delay
+        self.max_extrapolation = max_extrapolation
+        self.snapshots = deque(maxlen=size)
+        self.offsets = deque(maxlen=size)
+        # (server time, name) of removals not yet drawn.
+        self.removals = deque()
+
+    def add(self, snapshot, now):
+        """
+        Buffers a decoded snapshot, which arrived at local time now.
+        """
+        if self.snapshots and snapshot.time <= self.snapshots[-1].time:
+            return
+        self.snapshots.append(snapshot)
+        self.offsets.append(now - snapshot.time)
+        for name in snapshot.removed:
+            self.removals.append((snapshot.time, name))
+
+    def render_time(self, now):
+        """
+        The server time that should be drawn at local time now.
+        """
+        return now - min(self.offsets) - self.render_delay
+
+    def removed(self, now):
+        """
+        Yields the names of objects that should be gone by local time now, once each.
+        """
+        t = self.render_time(now)
+        removals = self.removals
+        while removals and removals[0][0] <= t:
+            yield removals.popleft()[1]
+
+    def sample(self, now):
+        """
+        Yields (name, position, hpr) for every buffered object, as it should be drawn at local time now.
+        """
+        snapshots = self.snapshots
+        if not snapshots:
+            return iter(())
+        t = self.render_time(now)
+        if t < snapshots[0].time:
+            return self.blend(snapshots[0], snapshots[0], 0.0, True)
+        for i in xrange(len(snapshots) - 1, -1, -1):
+            older = snapshots[i]
+            if older.time <= t:
+                break
+        if i + 1 < len(snapshots):
+            newer = snapshots[i + 1]
+            return self.blend(older, newer, (t - older.time) / (newer.time - older.time), True)
+        if len(snapshots) < 2:
+            return self.blend(older, older, 0.0, True)
+        # Nothing newer yet: carry on from the last two snapshots for a little while.
+        previous = snapshots[-2]
+        extra = min(t - older.time, self.max_extrapolation)
+        return self.blend(previous, older, 1.0 + extra / (older.time - previous.time), False)
+
+    def blend(self, a, b, fraction, blend_hpr):
+        """
+        Yields every object in b, moved fraction of the way from its state in a to its state in b (which
+        extrapolates, for a fraction over 1). Headings, pitches and rolls are only blended if blend_hpr is set.
+        """
+        a_states = a.states
+        for net_id, (name, qpos, qhpr) in b.states.iteritems():
+            pos = dequantize_pos(qpos)
+            hpr = dequantize_hpr(qhpr)
+            base = a_states.get(net_id)
+            if base is not None and base[0] == name and fraction != 1.0:
+                a_pos = dequantize_pos(base[1])
+                pos = tuple(a_pos[i] + (pos[i] - a_pos[i]) * fraction for i in xrange(3))
+                if blend_hpr:
+                    a_hpr = dequantize_hpr(base[2])
+                    hpr = tuple(lerp_angle(a_hpr[i], hpr[i], fraction) for i in xrange(3))
+            yield name, pos, hpr
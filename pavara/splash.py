@@ -109,7 +109,8 @@ class Splash (object):
         props = WindowProperties()
         props.setCursorHidden(True)
         self.win.requestProperties(props)
-        print self.render.analyze()
+        if self.map.world.profiler.enabled:
+            print self.render.analyze()
 
     def quit_clicked(self):
         exit()
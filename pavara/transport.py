@@ -0,0 +1,242 @@
+import struct
+import time
+from collections import deque, OrderedDict
+from pavara.constants import TRANSPORT_MTU, INITIAL_RTT, MIN_RESEND_TIMEOUT, MAX_RESEND_TIMEOUT, RELIABLE_WINDOW
+from pavara.constants import CONGESTED_RTT, UNCONGESTED_RTT, SEND_RATE, CONGESTED_SEND_RATE, CONNECTION_TIMEOUT
+from pavara.packets import parse_packet, KIND_PLAYER_JOIN, KIND_LOAD_MAP, KIND_GAME_START, KIND_CHANGE_NAME
+from pavara.packets import KIND_CHAT_CHARS, KIND_PLAYER_JOINED, KIND_GAME_STARTED
+
+# Every datagram starts with its sequence number, the latest sequence number received from the other end, and a
+# bitfield of which of the ACK_BITS before that were received too (bit n is ack - 1 - n). Then come any number of
+# messages, each a channel, a message ID and a length, followed by a flattened Packet.
+DATAGRAM_HEADER = '!HHL'
+MESSAGE_HEADER = '!BHH'
+DATAGRAM_HEADER_SIZE = struct.calcsize(DATAGRAM_HEADER)
+MESSAGE_HEADER_SIZE = struct.calcsize(MESSAGE_HEADER)
+ACK_BITS = 32
+
+# Unreliable messages are sent once and may be lost, duplicated or reordered; anything sent this way must cope (e.g.
+# snapshots, which carry their own ticks). Reliable messages are resent until acknowledged, and delivered in order.
+CHANNEL_UNRELIABLE = 0
+CHANNEL_RELIABLE = 1
+
+RELIABLE_KINDS = frozenset([KIND_PLAYER_JOIN, KIND_LOAD_MAP, KIND_GAME_START, KIND_CHANGE_NAME, KIND_CHAT_CHARS,
+	KIND_PLAYER_JOINED, KIND_GAME_STARTED])
+
+def sequence_newer(a, b):
+	"""
+	Whether the 16-bit sequence number a is more recent than b, allowing for wraparound.
+	"""
+	return (a > b and a - b <= 32768) or (a < b and b - a > 32768)
+
+def channel_for(packet):
+	if packet.kind in RELIABLE_KINDS or packet.needs_ack:
+		return CHANNEL_RELIABLE
+	return CHANNEL_UNRELIABLE
+
+class Connection (object):
+	"""
+	One end of a conversation over UDP. Packets passed to send are queued on their channel, and flush coalesces
+	everything due into as few datagrams as fit under the MTU. Every datagram acknowledges the last ACK_BITS + 1
+	datagrams received, so a lost ack is covered by the next one. Acks give round trip times, which set how long a
+	reliable message waits before it is resent (doubling with each resend), and how often the connection sends at
+	all: if the round trip time climbs over CONGESTED_RTT, the send rate drops until it recovers.
+	"""
+
+	def __init__(self, clock=time.time):
+		self.clock = clock
+		# Sequence 0 is skipped until the first wraparound, so acks sent before anything was received match nothing.
+		self.local_sequence = 1
+		self.remote_sequence = 0
+		self.received_bits = 0
+		self.any_received = False
+		self.ack_owed = False
+		# Sequence number -> (time sent, IDs of the reliable messages in it), for datagrams not yet acknowledged.
+		self.sent = {}
+		self.sent_order = deque()
+		self.srtt = None
+		self.rttvar = INITIAL_RTT / 2
+		self.congested = False
+		self.last_flush = None
+		self.last_received = clock()
+		# Reliable messages: waiting for room in the window, and sent but not yet acknowledged (ID -> [data, time
+		# last sent, resend timeout]).
+		self.next_message_id = 0
+		self.waiting = deque()
+		self.unacked = OrderedDict()
+		self.unreliable = []
+		# Reliable messages received ahead of the next one expected.
+		self.next_expected = 0
+		self.early = {}
+		self.lost = 0
+		self.resent = 0
+
+	@property
+	def rtt(self):
+		return INITIAL_RTT if self.srtt is None else self.srtt
+
+	@property
+	def resend_timeout(self):
+		return min(max(self.rtt + 4 * self.rttvar, MIN_RESEND_TIMEOUT), MAX_RESEND_TIMEOUT)
+
+	@property
+	def send_interval(self):
+		return 1.0 / (CONGESTED_SEND_RATE if self.congested else SEND_RATE)
+
+	def ready(self, now):
+		"""
+		Whether it is time to flush again, given the current send rate.
+		"""
+		return self.last_flush is None or now - self.last_flush >= self.send_interval
+
+	def timed_out(self, now):
+		return now - self.last_received > CONNECTION_TIMEOUT
+
+	def send(self, packet, channel=None):
+		if channel is None:
+			channel = channel_for(packet)
+		if channel == CHANNEL_RELIABLE:
+			self.waiting.append((self.next_message_id, packet.flatten()))
+			self.next_message_id = (self.next_message_id + 1) & 0xFFFF
+		else:
+			self.unreliable.append(packet.flatten())
+
+	def flush(self, now=None):
+		"""
+		Returns the datagrams to send now: reliable messages that are new or due for a resend, then any unreliable
+		messages, coalesced up to the MTU. If nothing is going out but something needs acknowledging, a datagram with
+		just the header is returned.
+		"""
+		if now is None:
+			now = self.clock()
+		self.last_flush = now
+		while self.waiting and len(self.unacked) < RELIABLE_WINDOW:
+			message_id, data = self.waiting.popleft()
+			self.unacked[message_id] = [data, None, self.resend_timeout]
+		messages = []
+		for message_id, entry in self.unacked.iteritems():
+			if entry[1] is None or now - entry[1] >= entry[2]:
+				if entry[1] is not None:
+					entry[2] = min(entry[2] * 2, MAX_RESEND_TIMEOUT)
+					self.resent += 1
+				entry[1] = now
+				messages.append((CHANNEL_RELIABLE, message_id, entry[0]))
+		for data in self.unreliable:
+			messages.append((CHANNEL_UNRELIABLE, 0, data))
+		self.unreliable = []
+		datagrams = []
+		chunks = []
+		ids = []
+		size = DATAGRAM_HEADER_SIZE
+		for channel, message_id, data in messages:
+			if chunks and size + MESSAGE_HEADER_SIZE + len(data) > TRANSPORT_MTU:
+				datagrams.append(self._datagram(chunks, ids, now))
+				chunks = []
+				ids = []
+				size = DATAGRAM_HEADER_SIZE
+			chunks.append(struct.pack(MESSAGE_HEADER, channel, message_id, len(data)) + data)
+			size += MESSAGE_HEADER_SIZE + len(data)
+			if channel == CHANNEL_RELIABLE:
+				ids.append(message_id)
+		if chunks or self.ack_owed:
+			datagrams.append(self._datagram(chunks, ids, now))
+		return datagrams
+
+	def _datagram(self, chunks, ids, now):
+		sequence = self.local_sequence
+		self.local_sequence = (sequence + 1) & 0xFFFF
+		self.sent[sequence] = (now, ids)
+		self.sent_order.append(sequence)
+		if len(self.sent_order) > ACK_BITS + 1:
+			# Too old to be acknowledged any more.
+			if self.sent.pop(self.sent_order.popleft(), None) is not None:
+				self.lost += 1
+		self.ack_owed = False
+		header = struct.pack(DATAGRAM_HEADER, sequence, self.remote_sequence, self.received_bits)
+		return header + ''.join(chunks)
+
+	def receive(self, data, now=None):
+		"""
+		Handles a datagram from the other end, and returns the Packets in it that are ready to be delivered.
+		"""
+		if len(data) < DATAGRAM_HEADER_SIZE:
+			return []
+		if now is None:
+			now = self.clock()
+		sequence, ack, ack_bits = struct.unpack_from(DATAGRAM_HEADER, data, 0)
+		self.last_received = now
+		self._acknowledge(ack, ack_bits, now)
+		if not self._note_received(sequence):
+			return []
+		packets = []
+		offset = DATAGRAM_HEADER_SIZE
+		while offset + MESSAGE_HEADER_SIZE <= len(data):
+			channel, message_id, length = struct.unpack_from(MESSAGE_HEADER, data, offset)
+			offset += MESSAGE_HEADER_SIZE
+			packet = parse_packet(data[offset:offset + length])
+			offset += length
+			if not packet:
+				continue
+			if channel == CHANNEL_RELIABLE:
+				packets.extend(self._deliver(message_id, packet))
+			else:
+				packets.append(packet)
+		return packets
+
+	def _acknowledge(self, ack, ack_bits, now):
+		for i in xrange(ACK_BITS + 1):
+			if i and not ack_bits & (1 << (i - 1)):
+				continue
+			record = self.sent.pop((ack - i) & 0xFFFF, None)
+			if record is None:
+				continue
+			sent_time, ids = record
+			self._measure(now - sent_time)
+			for message_id in ids:
+				self.unacked.pop(message_id, None)
+
+	def _measure(self, sample):
+		if self.srtt is None:
+			self.srtt = sample
+			self.rttvar = sample / 2
+		else:
+			self.rttvar += (abs(self.srtt - sample) - self.rttvar) * 0.25
+			self.srtt += (sample - self.srtt) * 0.125
+		if self.srtt > CONGESTED_RTT:
+			self.congested = True
+		elif self.srtt < UNCONGESTED_RTT:
+			self.congested = False
+
+	def _note_received(self, sequence):
+		"""
+		Records that the datagram with the given sequence number arrived. Returns False if it is a duplicate (or too
+		old to tell).
+		"""
+		if not self.any_received:
+			self.any_received = True
+		elif sequence_newer(sequence, self.remote_sequence):
+			shift = (sequence - self.remote_sequence) & 0xFFFF
+			# The previous latest becomes bit shift - 1.
+			self.received_bits = (((self.received_bits << 1) | 1) << (shift - 1)) & 0xFFFFFFFF
+		else:
+			behind = (self.remote_sequence - sequence) & 0xFFFF
+			if behind == 0 or behind > ACK_BITS or self.received_bits & (1 << (behind - 1)):
+				return False
+			self.received_bits |= 1 << (behind - 1)
+			self.ack_owed = True
+			return True
+		self.remote_sequence = sequence
+		self.ack_owed = True
+		return True
+
+	def _deliver(self, message_id, packet):
+		if message_id != self.next_expected:
+			if sequence_newer(message_id, self.next_expected):
+				self.early[message_id] = packet
+			return []
+		delivered = [packet]
+		self.next_expected = (self.next_expected + 1) & 0xFFFF
+		while self.next_expected in self.early:
+			delivered.append(self.early.pop(self.next_expected))
+			self.next_expected = (self.next_expected + 1) & 0xFFFF
+		return delivered
@@ -1,5 +1,7 @@
 from math import pi, sin, cos
+from array import array
 from panda3d.core import Vec3, Geom, GeomNode, GeomVertexFormat, GeomVertexWriter, GeomVertexData
+from panda3d.core import GeomVertexArrayFormat, InternalName, RenderState, CullFaceAttrib
 from panda3d.core import GeomTriangles, LRotationf, LVector3f, Point3
 import random
 
@@ -40,38 +42,76 @@ class Polygon (object):
         return normal
 
 class GeomBuilder(object):
+    """
+    :param indexed: If True, identical vertices (same position, normal, and color) are only stored once and shared
+                    between triangles, and add_tri makes the geometry two-sided through its render state instead of
+                    adding each triangle a second time with the opposite winding.
+    """
 
-    def __init__(self, name='tris'):
+    def __init__(self, name='tris', indexed=False):
         self.name = name
         self.vdata = GeomVertexData(name, GeomVertexFormat.get_v3n3cpt2(), Geom.UHDynamic)
         self.writer = VertexDataWriter(self.vdata)
         self.tris = GeomTriangles(Geom.UHDynamic)
+        self._init_indexing(indexed)
+
+    def _init_indexing(self, indexed):
+        self.indexed = indexed
+        self.vertex_ids = {}
+        self.two_sided = False
+
+    def _vertex(self, point, normal, color, texcoord):
+        """
+        Returns the index of a vertex with the given attributes, adding it unless indexed mode already has one.
+        """
+        if not self.indexed:
+            return self._add_vertex(point, normal, color, texcoord)
+        key = (point[0], point[1], point[2], normal[0], normal[1], normal[2], tuple(color))
+        vertex_id = self.vertex_ids.get(key)
+        if vertex_id is None:
+            vertex_id = self.vertex_ids[key] = self._add_vertex(point, normal, color, texcoord)
+        return vertex_id
+
+    def _add_vertex(self, point, normal, color, texcoord):
+        """
+        Adds a vertex, returning its index.
+        """
+        self.writer.add_vertex(point, normal, color, texcoord)
+        return self.writer.count - 1
+
+    def _add_triangle(self, a, b, c):
+        self.tris.add_vertices(a, b, c)
+        self.tris.close_primitive()
 
     def _commit_polygon(self, poly, color):
         """
         Transmutes colors and vertices for tris and quads into visible geometry.
         """
-        point_id = self.writer.count
-        for p in poly.points:
-            self.writer.add_vertex(p, poly.get_normal(), color, (0.0, 1.0))
-        if len(poly.points) == 3:
-            self.tris.add_consecutive_vertices(point_id, 3)
-            self.tris.close_primitive()
-        elif len(poly.points) == 4:
-            self.tris.add_vertex(point_id)
-            self.tris.add_vertex(point_id + 1)
-            self.tris.add_vertex(point_id + 3)
-            self.tris.close_primitive()
-            self.tris.add_consecutive_vertices(point_id + 1, 3)
-            self.tris.close_primitive()
-        else:
+        if len(poly.points) not in (3, 4):
             raise InvalidPrimitive
-            
+        normal = poly.get_normal()
+        ids = [self._vertex(p, normal, color, (0.0, 1.0)) for p in poly.points]
+        if len(ids) == 3:
+            self._add_triangle(ids[0], ids[1], ids[2])
+        else:
+            self._add_triangle(ids[0], ids[1], ids[3])
+            self._add_triangle(ids[1], ids[2], ids[3])
+
     def add_tri(self, color, points):
         self._commit_polygon(Polygon(points), color)
-        self._commit_polygon(Polygon(points[::-1]), color)
+        if self.indexed:
+            self.two_sided = True
+        else:
+            self._commit_polygon(Polygon(points[::-1]), color)
         return self
         
+    def add_triangle(self, color, points, normal):
+        """
+        Adds a single one-sided triangle whose normal is already known.
+        """
+        self._add_triangle(*[self._vertex(p, normal, color, (0.0, 1.0)) for p in points])
+        return self
+
     def add_rect(self, color, x1, y1, z1, x2, y2, z2):
         p1 = Point3(x1, y1, z1)
         p3 = Point3(x2, y2, z2)
@@ -293,11 +333,64 @@ class GeomBuilder(object):
         geom.add_primitive(self.tris)
         return geom
 
+    def get_state(self):
+        if self.two_sided:
+            return RenderState.make(CullFaceAttrib.make(CullFaceAttrib.M_cull_none))
+        return RenderState.make_empty()
+
     def get_geom_node(self):
         node = GeomNode(self.name)
-        node.add_geom(self.get_geom())
+        node.add_geom(self.get_geom(), self.get_state())
         return node
 
+class ArrayGeomBuilder (GeomBuilder):
+    """
+    A GeomBuilder that accumulates vertices and triangle indices in flat arrays, and hands each array to Panda in a
+    single copy when the Geom is built, instead of writing every vertex column by column through GeomVertexWriters.
+    Meant for static geometry built in bulk, such as map objects.
+    """
+
+    # Interleaved float32 columns, so a row is exactly what _add_vertex appends to the array.
+    format = None
+
+    def __init__(self, name='tris', indexed=False):
+        self.name = name
+        self.vertices = array('f')
+        self.indices = array('I')
+        self.count = 0
+        self._init_indexing(indexed)
+
+    @classmethod
+    def get_format(cls):
+        if cls.format is None:
+            array_format = GeomVertexArrayFormat()
+            array_format.add_column(InternalName.make('vertex'), 3, Geom.NT_float32, Geom.C_point)
+            array_format.add_column(InternalName.make('normal'), 3, Geom.NT_float32, Geom.C_vector)
+            array_format.add_column(InternalName.make('color'), 4, Geom.NT_float32, Geom.C_color)
+            array_format.add_column(InternalName.make('texcoord'), 2, Geom.NT_float32, Geom.C_texcoord)
+            cls.format = GeomVertexFormat.register_format(array_format)
+        return cls.format
+
+    def _add_vertex(self, point, normal, color, texcoord):
+        self.vertices.extend((point[0], point[1], point[2], normal[0], normal[1], normal[2],
+                              color[0], color[1], color[2], color[3], texcoord[0], texcoord[1]))
+        self.count += 1
+        return self.count - 1
+
+    def _add_triangle(self, a, b, c):
+        self.indices.extend((a, b, c))
+
+    def get_geom(self):
+        vdata = GeomVertexData(self.name, self.get_format(), Geom.UHStatic)
+        vdata.unclean_set_num_rows(self.count)
+        vdata.modify_array(0).modify_handle().set_data(self.vertices.tostring())
+        tris = GeomTriangles(Geom.UHStatic)
+        tris.set_index_type(Geom.NT_uint32)
+        tris.modify_vertices().modify_handle().set_data(self.indices.tostring())
+        geom = Geom(vdata)
+        geom.add_primitive(tris)
+        return geom
+
 
 def to_cartesian(azimuth, elevation, length):
     x = length * sin(azimuth) * cos(elevation)
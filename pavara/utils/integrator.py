@@ -1,6 +1,47 @@
+import math
 from panda3d.core import Point3, Vec3
 
 
+def constant_step(px, py, pz, vx, vy, vz, ax, ay, az, friction, dt):
+    """
+    One RK4 step under a constant acceleration, on plain floats. With the acceleration constant, the four RK4
+    evaluations collapse to exactly x + v*dt + a*dt^2/2 and v + a*dt.
+    """
+    half = 0.5 * dt * dt
+    return (px + vx * dt + ax * half, py + vy * dt + ay * half, pz + vz * dt + az * half,
+            vx + ax * dt, vy + ay * dt, vz + az * dt)
+
+def friction_acceleration(ax, ay, az, vx, vy, vz, friction):
+    dx = ax - vx
+    dy = ay - vy
+    dz = az - vz
+    scale = friction * 70
+    length = math.sqrt(dx * dx + dy * dy + dz * dz)
+    if length > friction / 5.0:
+        scale /= length
+    return dx * scale, dy * scale, dz * scale
+
+def friction_step(px, py, pz, vx, vy, vz, ax, ay, az, friction, dt):
+    """
+    One RK4 step towards the target velocity a, at a rate set by friction, on plain floats.
+    """
+    half = dt * 0.5
+    dvax, dvay, dvaz = friction_acceleration(ax, ay, az, vx, vy, vz, friction)
+    bx, by, bz = vx + dvax * half, vy + dvay * half, vz + dvaz * half
+    dvbx, dvby, dvbz = friction_acceleration(ax, ay, az, bx, by, bz, friction)
+    cx, cy, cz = vx + dvbx * half, vy + dvby * half, vz + dvbz * half
+    dvcx, dvcy, dvcz = friction_acceleration(ax, ay, az, cx, cy, cz, friction)
+    dx, dy, dz = vx + dvcx * dt, vy + dvcy * dt, vz + dvcz * dt
+    dvdx, dvdy, dvdz = friction_acceleration(ax, ay, az, dx, dy, dz, friction)
+    sixth = dt / 6.0
+    return (px + (vx + (bx + cx) * 2.0 + dx) * sixth,
+            py + (vy + (by + cy) * 2.0 + dy) * sixth,
+            pz + (vz + (bz + cz) * 2.0 + dz) * sixth,
+            vx + (dvax + (dvbx + dvcx) * 2.0 + dvdx) * sixth,
+            vy + (dvay + (dvby + dvcy) * 2.0 + dvdy) * sixth,
+            vz + (dvaz + (dvbz + dvcz) * 2.0 + dvdz) * sixth)
+
+
 class Integrator(object):
     """Integrator is based on a game physics article. It's supposedly much less
        dependent on frame rate than simply adding a multiple of dt to the velocity
@@ -8,44 +49,32 @@ class Integrator(object):
 
        http://gafferongames.com/game-physics/integration-basics/"""
 
+    step = staticmethod(constant_step)
+    friction = 0.0
+
     def __init__(self, accel):
         self.accel = accel
 
-    def acceleration(self, x, v, dt):
-        return self.accel
-
-    def evaluate(self, x, v, dt, dx, dv):
-        x = x + dx * dt
-        v = v + dv * dt
-
-        dx = v
-        dv = self.acceleration(x, v, dt)
-
-        return dx, dv
-
     def integrate(self, x, v, dt):
-        dxa, dva = self.evaluate(x, v, 0.0, Vec3(0, 0, 0), Vec3(0,0,0))
-        dxb, dvb = self.evaluate(x, v, dt*0.5, dxa, dva)
-        dxc, dvc = self.evaluate(x, v, dt*0.5, dxb, dvb)
-        dxd, dvd = self.evaluate(x, v, dt, dxc, dvc)
+        a = self.accel
+        px, py, pz, vx, vy, vz = self.step(x[0], x[1], x[2], v[0], v[1], v[2], a[0], a[1], a[2], self.friction, dt)
+        return Point3(px, py, pz), Vec3(vx, vy, vz)
 
-        dxdt = (dxa + (dxb + dxc)*2.0 + dxd) * 1.0/6.0
-        dvdt = (dva + (dvb + dvc)*2.0 + dvd) * 1.0/6.0
-        x = x + dxdt * dt
-        v = v + dvdt * dt
-        return x, v
+    def integrate_into(self, x, v, dt, x_out, v_out):
+        """
+        Like integrate, but writes the new position and velocity into x_out and v_out (which may be x and v) instead
+        of allocating new vectors.
+        """
+        a = self.accel
+        px, py, pz, vx, vy, vz = self.step(x[0], x[1], x[2], v[0], v[1], v[2], a[0], a[1], a[2], self.friction, dt)
+        x_out.set(px, py, pz)
+        v_out.set(vx, vy, vz)
 
 class Friction(Integrator):
 
+    step = staticmethod(friction_step)
+
     def __init__(self, accel, friction):
         super(Friction, self).__init__(accel)
         self.friction = friction
 
-
-    def acceleration(self, x, v, dt):
-        direction = self.accel - v
-        if direction.length() > self.friction / 5.0:
-            direction.normalize()
-            return direction * self.friction * 70
-        else:
-            return direction * self.friction * 70
@@ -1,9 +1,10 @@
-from panda3d.core import Vec3, TransformState, rad2Deg, AmbientLight, ColorBlendAttrib, LineSegs
+from panda3d.core import Vec3, Point3, TransformState, rad2Deg, AmbientLight, ColorBlendAttrib, LineSegs
 from panda3d.bullet import BulletGhostNode, BulletCylinderShape, BulletConvexHullShape, BulletRigidBodyNode, YUp
 from direct.actor.Actor import Actor
 from direct.interval.IntervalGlobal import *
 from pavara.world import *
 from pavara.projectiles import *
+from pavara.profiler import get_profiler
 
 TOP_LEG_LENGTH = 1
 BOTTOM_LEG_LENGTH = 1.21
@@ -20,23 +21,90 @@ MIN_WALKFUNC_SIZE_FACTOR = .001
 MAX_WALKFUNC_SIZE_FACTOR = 22
 WALKFUNC_STEPS = 14
 
+# Animation levels of detail. Nearby walkers get full IK against the floor; further away, legs follow a walk cycle
+# precomputed for flat ground, and walkers that are far off or out of view only move their legs every
+# FROZEN_POSE_INTERVAL seconds. Walkers on a server (with no camera) are never seen, but their legs carry the hitboxes
+# the server checks hits against, so they always follow the walk cycle.
+LOD_FULL = 0
+LOD_CYCLE = 1
+LOD_FROZEN = 2
+LOD_FULL_DISTANCE = 40.0
+LOD_CYCLE_DISTANCE = 120.0
+FROZEN_POSE_INTERVAL = 0.25
+
+# How far (up or down) the floor under a foot can be from where it is on flat ground before the leg needs live IK.
+FLAT_FLOOR_TOLERANCE = .05
+
+# Where the on-ground ray starts relative to the walker's feet, and the ray itself.
+FOOT_RAY_OFFSET = Vec3(0, 1, 0)
+FOOT_RAY = Vec3(0, -1.1, 0)
+
+def walkfunc_target(step, up_step, direction, sizeparam, coefficient):
+    """
+    The x input to the walk ellipse at the given point of the walk cycle, and where the foot should be there (x, y
+    relative to its reference node); see LegBones.
+    """
+    x_max = math.sqrt(float(sizeparam) / float(coefficient))
+    x = (abs(step) * x_max) / WALKFUNC_STEPS
+    x = (x * sizeparam) / MAX_WALKFUNC_SIZE_FACTOR
+    if step < 0:
+        x = -x
+    root = math.sqrt(75 * ((-coefficient * x * x) + sizeparam))
+    y = ((-direction * 15 * x) + (root if up_step else -root)) / 100
+    d = 1 if direction > 0 else -1
+    return x, x + d * (.03 * sizeparam), y
+
+def leg_angles(target_vector):
+    """
+    Solves the two-bone leg for a foot at the end of target_vector (from the foot to the hip), returning the
+    pitches of the top and bottom bones, or None if the foot is out of reach.
+    """
+    pt_length = target_vector.length()
+    if not .01 < pt_length < (TOP_LEG_LENGTH + BOTTOM_LEG_LENGTH +.1):
+        return None
+    tt_angle_cos = (math.pow(TOP_LEG_LENGTH, 2) + math.pow(pt_length, 2) - math.pow(BOTTOM_LEG_LENGTH,2))/(2*TOP_LEG_LENGTH*pt_length)
+    tb_angle_cos = ((math.pow(TOP_LEG_LENGTH, 2) + math.pow(BOTTOM_LEG_LENGTH, 2) - math.pow(pt_length,2))/(2*TOP_LEG_LENGTH*BOTTOM_LEG_LENGTH))
+    try:
+        target_top_angle = rad2Deg(math.acos(tt_angle_cos))
+        target_bottom_angle = rad2Deg(math.acos(tb_angle_cos))
+    except ValueError:
+        return None
+    target_vector.normalize()
+    delta = target_vector.get_xy().signed_angle_deg(Vec3.unitY().get_xy())
+    return 90 - target_top_angle + delta, (180 - target_bottom_angle) * -1
+
+def instance_template(template, parent, name):
+    """
+    Instances a shared template model under a new node attached to parent, and returns that node. Transforms, colors
+    and visibility set on the returned node only affect this instance.
+    """
+    holder = parent.attach_new_node(name)
+    template.instance_to(holder)
+    return holder
+
 class LoadedMissile (object):
 
+    # The missile model shared (instanced) by every walker, with its engines already colored; see get_template.
+    template = None
+
+    @classmethod
+    def get_template(cls):
+        if cls.template is None:
+            cls.template = load_model('missile.egg')
+            cls.template.find('**/mainengines').set_color(.2,.2,.2)
+            cls.template.find('**/wingengines').set_color(.2,.2,.2)
+        return cls.template
+
     def __init__(self, actor, color):
         self.missile_loaded = False
-        self.loaded_missile = load_model('missile.egg')
+        self.loaded_missile = instance_template(self.get_template(), actor, 'loaded_missile')
         self.loaded_missile.hide()
-        self.loaded_missile.reparentTo(actor)
-        self.loaded_missile.set_pos(self.loaded_missile, *MISSILE_OFFSET)
+        self.loaded_missile.set_pos(*MISSILE_OFFSET)
         self.loaded_missile.set_h(180)
         self.loaded_missile.set_scale(MISSILE_SCALE)
-        main_engines = self.loaded_missile.find('**/mainengines')
-        main_engines.set_color(.2,.2,.2)
-        wing_engines = self.loaded_missile.find('**/wingengines')
-        wing_engines.set_color(.2,.2,.2)
-        self.body = self.loaded_missile.find('**/bodywings')
         self.color = color
-        self.body.set_color(*color)
+        # Only the body is left uncolored by the template, so it takes the instance's color.
+        self.loaded_missile.set_color(*color)
 
     def toggle_visibility(self):
         self.missile_loaded = not self.missile_loaded
@@ -58,21 +126,27 @@ class LoadedMissile (object):
 
 class LoadedGrenade (object):
 
+    # The grenade model shared (instanced) by every walker, with its insides already colored; see get_template.
+    template = None
+
+    @classmethod
+    def get_template(cls):
+        if cls.template is None:
+            cls.template = load_model('grenade.egg')
+            cls.template.find('**/inner_top').set_color(.2,.2,.2)
+            cls.template.find('**/inner_bottom').set_color(.2,.2,.2)
+        return cls.template
+
     def __init__(self, actor, color):
         self.grenade_loaded = False
-        self.loaded_grenade = load_model('grenade.egg')
+        self.loaded_grenade = instance_template(self.get_template(), actor, 'loaded_grenade')
         self.loaded_grenade.hide()
-        self.loaded_grenade.reparentTo(actor)
-        self.loaded_grenade.set_pos(self.loaded_grenade, *GRENADE_OFFSET)
+        self.loaded_grenade.set_pos(*GRENADE_OFFSET)
         self.loaded_grenade.set_hpr(0,180,0)
         self.loaded_grenade.set_scale(GRENADE_SCALE)
-        inner_top = self.loaded_grenade.find('**/inner_top')
-        inner_top.set_color(.2,.2,.2)
-        inner_bottom = self.loaded_grenade.find('**/inner_bottom')
-        inner_bottom.set_color(.2,.2,.2)
-        shell = self.loaded_grenade.find('**/shell')
         self.color = color
-        shell.set_color(*color)
+        # Only the shell is left uncolored by the template, so it takes the instance's color.
+        self.loaded_grenade.set_color(*color)
 
     def toggle_visibility(self):
         self.grenade_loaded = not self.grenade_loaded
@@ -128,22 +202,25 @@ class Sights (object):
         self.right_plasma.set_depth_write(False)
         self.right_plasma.set_light(sight_lightnp)
 
-    def update(self, left_barrel, right_barrel):
-        self.do_barrel_raytest(left_barrel, self.left_plasma)
-        self.do_barrel_raytest(right_barrel, self.right_plasma)
+    def probe(self, rays, left_barrel, right_barrel):
+        self.left_ray = self.barrel_ray(rays, left_barrel)
+        self.right_ray = self.barrel_ray(rays, right_barrel)
 
-    def do_barrel_raytest(self, barrel, sight):
+    def barrel_ray(self, rays, barrel):
         pfrom = barrel.get_pos(self.scene)
         pto = pfrom + self.scene.get_relative_vector(barrel, Vec3(0,0,-60))
-        result = self.physics.ray_test_closest(pfrom, pto, MAP_COLLIDE_BIT | SOLID_COLLIDE_BIT)
+        return rays.submit(pfrom, pto, MAP_COLLIDE_BIT | SOLID_COLLIDE_BIT), pto
+
+    def update(self, left_barrel, right_barrel):
+        self.do_barrel_raytest(self.left_ray, self.left_plasma)
+        self.do_barrel_raytest(self.right_ray, self.right_plasma)
+
+    def do_barrel_raytest(self, ray, sight):
+        key, pto = ray
+        result = self.world.rays.result(key)
         if result.has_hit():
             sight.set_pos(self.scene, result.get_hit_pos())
-            obj = False
-            nodename = result.get_node().get_name()
-            try:
-                obj = self.world.objects[nodename]
-            except:
-                raise
+            obj, category = self.world.entities.lookup(result.get_node())
             hostile = getattr(obj, 'hostile', False)
             if hostile is False:
                 self.enemy(sight)
@@ -158,9 +235,62 @@ class Sights (object):
         sight.find("**/sight").setColor(*SIGHTS_FRIENDLY_COLOR)
 
 
+class LegTable (object):
+    """
+    The walk cycle of one kind of leg, precomputed into flat lists indexed by slot: the walk ellipse x, the foot's
+    target, and the leg's pose on flat ground, at every point of the cycle while walking and standing. Legs of the
+    same kind share one table; see get.
+    """
+
+    tables = {}
+
+    @classmethod
+    def get(cls, kind, hip_pos, floor_y, coefficient):
+        """
+        Returns the table for the given kind of leg, building it from this leg's measurements if it is the first.
+        """
+        table = cls.tables.get(kind)
+        if table is None:
+            table = cls(hip_pos, floor_y, coefficient)
+            if kind is not None:
+                cls.tables[kind] = table
+        return table
+
+    @staticmethod
+    def slot(sizeparam, step, up_step, direction):
+        """
+        Returns the slot for the given point of the walk cycle, or None if it is not in the table.
+        """
+        if sizeparam == MAX_WALKFUNC_SIZE_FACTOR:
+            walking = 1
+        elif sizeparam == MIN_WALKFUNC_SIZE_FACTOR:
+            walking = 0
+        else:
+            return None
+        if not -WALKFUNC_STEPS <= step <= WALKFUNC_STEPS:
+            return None
+        return ((walking * (2 * WALKFUNC_STEPS + 1) + step + WALKFUNC_STEPS) * 2 + up_step) * 3 + direction + 1
+
+    def __init__(self, hip_pos, floor_y, coefficient):
+        self.floor_y = floor_y
+        self.walkfunc_xs = []
+        self.targets = []
+        # (top bone pitch, bottom bone pitch, on ground), or None where the foot would be out of reach.
+        self.poses = []
+        for sizeparam in (MIN_WALKFUNC_SIZE_FACTOR, MAX_WALKFUNC_SIZE_FACTOR):
+            for step in xrange(-WALKFUNC_STEPS, WALKFUNC_STEPS + 1):
+                for up_step in (False, True):
+                    for direction in (-1, 0, 1):
+                        x, target_x, target_y = walkfunc_target(step, up_step, direction, sizeparam, coefficient)
+                        self.walkfunc_xs.append(x)
+                        self.targets.append(Point3(target_x, target_y, 0))
+                        on_ground = target_y < floor_y
+                        angles = leg_angles(hip_pos - Point3(target_x, max(target_y, floor_y), 0))
+                        self.poses.append(angles and angles + (on_ground,))
+
 class LegBones (object):
 
-    def __init__(self, scene, physics, hip, foot, foot_ref, top, bottom):
+    def __init__(self, scene, rays, hip, foot, foot_ref, top, bottom, kind=None):
         self.foot_bone = foot
         self.foot_ref = foot_ref
         self.foot_ref.set_hpr(self.foot_ref, 90, 0, 0)
@@ -176,7 +306,9 @@ class LegBones (object):
         self.hip_rest = self.hip_bone.get_pos()
         self.is_on_ground = False
         self.scene = scene
-        self.physics = physics
+        self.rays = rays
+        self.floor_ray = None
+        self.profiler = get_profiler()
         self.top_bone_target_angle = self.top_bone.get_p()
         print "top bone angle: %s" % self.top_bone_target_angle
         self.bottom_bone_target_angle = self.bottom_bone.get_p()
@@ -205,10 +337,18 @@ class LegBones (object):
         self.walkfunc_x_max = math.sqrt(self.walkfunc_sizeparam / self.walkfunc_ellipse_mag_coefficient)
 
         self.direction = 0
+        # On flat ground, the floor is level with the bottom of the walker, i.e. its origin.
+        floor_y = -self.foot_ref.get_y()
+        self.table = LegTable.get(kind, self.hip_bone.get_pos(self.foot_ref), floor_y, self.walkfunc_ellipse_mag_coefficient)
+        self.cycle_slot = None
 
     def _recompute_walkfunc_x(self):
         """compute x and then proportion so that it matches
         current size vs the maximum size of the ellipse"""
+        slot = self.cycle_slot = LegTable.slot(self.walkfunc_sizeparam, self.walk_seq_step, self.up_step, self.direction)
+        if slot is not None:
+            self.walkfunc_x = self.table.walkfunc_xs[slot]
+            return
         self.walkfunc_x_max = math.sqrt(float(self.walkfunc_sizeparam) / float(self.walkfunc_ellipse_mag_coefficient))
         self.walkfunc_x = (abs(self.walk_seq_step) * self.walkfunc_x_max) / (WALKFUNC_STEPS)
         self.walkfunc_x = (self.walkfunc_x * self.walkfunc_sizeparam) / MAX_WALKFUNC_SIZE_FACTOR
@@ -233,6 +373,8 @@ class LegBones (object):
         return ((-self.direction * 15 * self.walkfunc_x) - math.sqrt(75 * ((-self.walkfunc_ellipse_mag_coefficient * math.pow(self.walkfunc_x, 2)) + self.walkfunc_sizeparam))) / 100
 
     def _get_target_pos(self):
+        if self.cycle_slot is not None:
+            return Point3(self.table.targets[self.cycle_slot])
         walkfunc_y = None
         if self.up_step:
             walkfunc_y = self._walkfunc_upper(self.walkfunc_x)
@@ -253,12 +395,18 @@ class LegBones (object):
         bone.set_pos(rest_pos.x,deltay - (self.crouch_factor * .02), rest_pos.z)
 
 
-    def get_floor_spot(self):
+    def probe(self):
         l_from = self.foot_bone.get_pos(self.scene)
         l_to = self.foot_bone.get_pos(self.scene)
         l_from.y += 1
         l_to.y -= .7
-        result = self.physics.ray_test_closest(l_from, l_to, MAP_COLLIDE_BIT | SOLID_COLLIDE_BIT)
+        self.floor_ray = self.rays.submit(l_from, l_to, MAP_COLLIDE_BIT | SOLID_COLLIDE_BIT)
+
+    def get_floor_spot(self):
+        # Probed at the start of the tick, so every IK pass this tick shares one ray test.
+        if self.floor_ray is None:
+            self.probe()
+        result = self.rays.result(self.floor_ray)
         if result.has_hit():
             return self.foot_ref.get_relative_point(self.scene, result.get_hit_pos())
         else:
@@ -266,6 +414,12 @@ class LegBones (object):
 
     def ik_leg(self):
         floor_pos = self.get_floor_spot()
+        if floor_pos and self.cycle_slot is not None and not self.crouch_factor and \
+                abs(floor_pos.y - self.table.floor_y) < FLAT_FLOOR_TOLERANCE:
+            # Flat ground, standing up: the pose is already known. (The table is built with the hip at rest, so a
+            # crouching leg is always solved.)
+            self.sample_cycle()
+            return
         target_pos = self._get_target_pos()
         hip_pos = self.hip_bone.get_pos(self.foot_ref)
 
@@ -280,23 +434,22 @@ class LegBones (object):
         #turn off the ground for debugging
         #target_vector = hip_pos - target_pos
 
-        pt_length = target_vector.length()
-        if .01 < pt_length < (TOP_LEG_LENGTH + BOTTOM_LEG_LENGTH +.1):
-            tt_angle_cos = (math.pow(TOP_LEG_LENGTH, 2) + math.pow(pt_length, 2) - math.pow(BOTTOM_LEG_LENGTH,2))/(2*TOP_LEG_LENGTH*pt_length)
-            try:
-                target_top_angle = rad2Deg(math.acos(tt_angle_cos))
-            except ValueError:
-                return
-            target_vector.normalize()
-            self.hip_bone.get_relative_vector(self.foot_ref, target_vector)
-            delta = target_vector.get_xy().signed_angle_deg(Vec3.unitY().get_xy())
-            self.top_bone.set_p(90 - target_top_angle + delta)
-
-            tb_angle_cos = ((math.pow(TOP_LEG_LENGTH, 2) + math.pow(BOTTOM_LEG_LENGTH, 2) - math.pow(pt_length,2))/(2*TOP_LEG_LENGTH*BOTTOM_LEG_LENGTH))
-            target_bottom_angle = rad2Deg(math.acos(tb_angle_cos))
-            self.bottom_bone.set_p((180 - target_bottom_angle) * -1)
-        else:
+        angles = leg_angles(target_vector)
+        if angles:
+            self.top_bone.set_p(angles[0])
+            self.bottom_bone.set_p(angles[1])
+
+    def sample_cycle(self):
+        """
+        Poses the leg from the precomputed walk cycle instead of solving IK against the floor.
+        """
+        if self.cycle_slot is None:
             return
+        pose = self.table.poses[self.cycle_slot]
+        if pose:
+            self.top_bone.set_p(pose[0])
+            self.bottom_bone.set_p(pose[1])
+            self.is_on_ground = pose[2]
 
 class Skeleton (object):
 
@@ -316,6 +469,8 @@ class Skeleton (object):
         self.walk_playing = False
         self.lf_sound_played = False
         self.rf_sound_played = False
+        self.lf_sound = None
+        self.rf_sound = None
 
 
     def _move_shoulder(self, data, shoulder):
@@ -344,10 +499,15 @@ class Skeleton (object):
             audio3d.attachSoundToObject(self.rf_sound, self.right_leg.foot_bone)
             self.rf_played_since = 0
 
-    def update_legs(self, walk, dt, scene, physics):
+    def probe(self):
+        self.left_leg.probe()
+        self.right_leg.probe()
+
+    def update_legs(self, walk, dt, scene, physics, lod=LOD_FULL):
+        # Always passed on, so the legs see it drop back to zero and can use their tables again.
+        self.left_leg.crouch_factor = self.crouch_factor
+        self.right_leg.crouch_factor = self.crouch_factor
         if self.crouch_factor > 0:
-            self.left_leg.crouch_factor = self.crouch_factor
-            self.right_leg.crouch_factor = self.crouch_factor
             self.shoulder.set_pos(self.resting.x, self.resting.y - self.crouch_factor * .8, self.resting.z)
         if walk != 0:
             #self.walk()
@@ -356,14 +516,19 @@ class Skeleton (object):
                 leg.walkfunc_sizeparam = MAX_WALKFUNC_SIZE_FACTOR
                 leg._increment_walk_seq_step(walk * dt)
                 leg._recompute_walkfunc_x()
-                leg.ik_leg()
+                if lod == LOD_FULL:
+                    leg.ik_leg()
+                else:
+                    leg.sample_cycle()
             if self.left_leg.is_on_ground and not self.lf_sound_played:
-                self.lf_sound.play()
+                if self.lf_sound:
+                    self.lf_sound.play()
                 self.lf_sound_played = True
             if not self.left_leg.is_on_ground:
                 self.lf_sound_played = False
             if self.right_leg.is_on_ground and not self.rf_sound_played:
-                self.rf_sound.play()
+                if self.rf_sound:
+                    self.rf_sound.play()
                 self.rf_sound_played = True
             if not self.right_leg.is_on_ground:
                 self.rf_sound_played = False
@@ -372,15 +537,32 @@ class Skeleton (object):
             for leg in [self.left_leg, self.right_leg]:
                 leg.walkfunc_sizeparam = .001
                 leg._recompute_walkfunc_x()
-                leg.ik_leg()
+                if lod == LOD_FULL:
+                    leg.ik_leg()
+                else:
+                    leg.sample_cycle()
 
 
 class Walker (PhysicalObject):
 
     collide_bits = SOLID_COLLIDE_BIT
-
-    def __init__(self, incarnator, colordict=None, player=False):
-        super(Walker, self).__init__()
+    category = CATEGORY_WALKER
+    net_priority = 4.0
+    model = 'walker.egg'
+    # For each model, the path (as child indices from the actor) to each part found by name; see get_model_part.
+    part_paths = {}
+    # One loaded Actor per model, which every walker's actor is copied from; see get_template.
+    templates = {}
+
+    @classmethod
+    def get_template(cls):
+        template = cls.templates.get(cls.model)
+        if template is None:
+            template = cls.templates[cls.model] = Actor(cls.model)
+        return template
+
+    def __init__(self, incarnator, colordict=None, player=False, name=None):
+        super(Walker, self).__init__(name)
         self.spawn_point = incarnator
         self.on_ground = False
         self.mass = 150.0 # 220.0 for heavy
@@ -412,12 +594,46 @@ class Walker (PhysicalObject):
         self.player = player
         self.can_jump = False
         self.crouch_impulse = 0
+        # Scratch objects reused by every update, to avoid allocating new ones each tick.
+        self.walk_integrator = Friction(Vec3(0, 0, 0), DEFAULT_FRICTION)
+        self.walk_vector = Vec3(0, 0, 0)
+        self.head_pos = Point3(0, 0, 0)
+        self.ray_from = Point3(0, 0, 0)
+        self.ray_to = Point3(0, 0, 0)
+        self.fall_pos = Point3(0, 0, 0)
+        self.start_pos = Point3(0, 0, 0)
+        self.walk_pos = Point3(0, 0, 0)
+        self.goal_pos = Point3(0, 0, 0)
+        # Set on the client for the local player's walker; see pavara.prediction.
+        self.prediction = None
+        self.lod = LOD_FULL
+        self.frozen_time = 0.0
 
     def get_model_part(self, obj_name):
-        return self.actor.find("**/%s" % obj_name)
+        """
+        Finds a named part of the model. Every walker with the same model has the same node hierarchy, so the part
+        is only searched for once per model; after that it is reached by child indices.
+        """
+        paths = self.part_paths.setdefault(self.model, {})
+        path = paths.get(obj_name)
+        if path is None:
+            part = self.actor.find("**/%s" % obj_name)
+            path = []
+            np = part
+            while not np.is_empty() and np != self.actor:
+                parent = np.get_parent()
+                path.append(parent.node().find_child(np.node()))
+                np = parent
+            path.reverse()
+            paths[obj_name] = path = tuple(path) if not part.is_empty() else None
+            return part
+        np = self.actor
+        for index in path:
+            np = np.get_child(index)
+        return np
 
     def create_node(self):
-        self.actor = Actor('walker.egg')
+        self.actor = Actor(other=self.get_template())
         if self.colordict:
             self.setup_color(self.colordict)
         self.actor.set_pos(*self.spawn_point.pos)
@@ -432,6 +648,7 @@ class Walker (PhysicalObject):
 
     def create_solid(self):
         walker_capsule = BulletGhostNode(self.name + "_walker_cap")
+        self.world.entities.tag(walker_capsule, self, CATEGORY_WALKER | CATEGORY_WALKER_CAPSULE)
         self.walker_capsule_shape = BulletCylinderShape(.7, .2, YUp)
         walker_bullet_np = self.actor.attach_new_node(walker_capsule)
         walker_bullet_np.node().add_shape(self.walker_capsule_shape)
@@ -450,6 +667,7 @@ class Walker (PhysicalObject):
         shape.add_geom(geom)
 
         node = BulletRigidBodyNode(self.name + pname)
+        self.world.entities.tag(node, self, CATEGORY_WALKER)
         np = self.actor.attach_new_node(node)
         np.node().add_shape(shape)
         np.node().set_kinematic(True)
@@ -496,18 +714,20 @@ class Walker (PhysicalObject):
         #pelvis_bone.attach_new_node(right_foot_bone_origin_ref)
 
         left_bones = LegBones(
-            self.world.scene, self.world.physics,
+            self.world.scene, self.world.rays,
             self.actor.exposeJoint(None, 'modelRoot', 'left_hip_bone'),
             left_foot_bone,
             left_foot_bone_origin_ref,
-            *[self.actor.controlJoint(None, 'modelRoot', name) for name in ['left_top_bone', 'left_bottom_bone']]
+            *[self.actor.controlJoint(None, 'modelRoot', name) for name in ['left_top_bone', 'left_bottom_bone']],
+            kind=(self.model, 'left')
         )
         right_bones = LegBones(
-            self.world.scene, self.world.physics,
+            self.world.scene, self.world.rays,
             self.actor.exposeJoint(None, 'modelRoot', 'right_hip_bone'),
             right_foot_bone,
             right_foot_bone_origin_ref,
-            *[self.actor.controlJoint(None, 'modelRoot', name) for name in  ['right_top_bone', 'right_bottom_bone']]
+            *[self.actor.controlJoint(None, 'modelRoot', name) for name in  ['right_top_bone', 'right_bottom_bone']],
+            kind=(self.model, 'right')
         )
 
         self.skeleton = Skeleton(left_bones, right_bones, pelvis_bone)
@@ -518,6 +738,7 @@ class Walker (PhysicalObject):
         self.loaded_grenade = LoadedGrenade(self.head_bone_joint, self.primary_color)
         if self.player:
             self.sights = Sights(self.left_barrel_joint, self.right_barrel_joint, self.world)
+        self.world.register_probe(self)
 
 
 
@@ -526,28 +747,28 @@ class Walker (PhysicalObject):
         print self, 'HIT BY', other, 'AT', world_pt
 
     def handle_command(self, cmd, pressed):
-        if cmd is 'crouch' and pressed:
+        if cmd == 'crouch' and pressed:
             self.crouching = True
             if self.on_ground:
                 self.can_jump = True
-        if cmd is 'crouch' and not pressed and self.on_ground and self.can_jump:
+        if cmd == 'crouch' and not pressed and self.on_ground and self.can_jump:
             self.crouching = False
             self.y_velocity = Vec3(0, 6.8, 0)
             self.can_jump = False
-        if cmd is 'fire' and pressed:
+        if cmd == 'fire' and pressed:
             self.handle_fire()
             return
-        if cmd is 'missile' and pressed:
+        if cmd == 'missile' and pressed:
             if self.loaded_grenade.can_fire():
                 self.loaded_grenade.toggle_visibility()
             self.loaded_missile.toggle_visibility()
             return
-        if cmd is 'grenade' and pressed:
+        if cmd == 'grenade' and pressed:
             if self.loaded_missile.can_fire():
                 self.loaded_missile.toggle_visibility()
             self.loaded_grenade.toggle_visibility()
             return
-        if cmd is 'grenade_fire' and pressed:
+        if cmd == 'grenade_fire' and pressed:
             if self.loaded_missile.can_fire():
                 self.loaded_missile.toggle_visibility()
             if not self.loaded_grenade.can_fire():
@@ -556,13 +777,14 @@ class Walker (PhysicalObject):
             walker_v.y = self.y_velocity.y
             self.loaded_grenade.fire(self.world, walker_v)
             return
-        self.movement[cmd] = self.factors[cmd] if pressed else 0.0
+        if cmd in self.factors:
+            self.movement[cmd] = self.factors[cmd] if pressed else 0.0
 
     def handle_fire(self):
         if self.loaded_missile.can_fire():
             self.loaded_missile.fire(self.world)
         elif self.loaded_grenade.can_fire():
-            walker_v = self.xz_velocity
+            walker_v = Vec3(self.xz_velocity)
             walker_v.y = self.y_velocity.y
             self.loaded_grenade.fire(self.world, walker_v)
         else:
@@ -586,64 +808,160 @@ class Walker (PhysicalObject):
             plasma = self.world.attach(Plasma(origin, hpr, p_energy))
 
     def st_result(self, cur_pos, new_pos):
+        self.world.profiler.count('sweep_tests')
         return self.world.physics.sweepTestClosest(self.walker_capsule_shape, cur_pos, new_pos, self.collides_with, 0)
 
+    def motion_state(self):
+        """
+        Returns everything (besides the transform) that simulate depends on, for restore_motion.
+        """
+        return (dict(self.movement), Vec3(self.xz_velocity), Vec3(self.y_velocity), self.on_ground, self.crouching,
+                self.can_jump)
+
+    def restore_motion(self, state):
+        movement, xz_velocity, y_velocity, self.on_ground, self.crouching, self.can_jump = state
+        self.movement.update(movement)
+        self.xz_velocity = Vec3(xz_velocity)
+        self.y_velocity = Vec3(y_velocity)
+
+    def animation_lod(self):
+        if self.player:
+            return LOD_FULL
+        camera = self.world.camera
+        if camera is None:
+            return LOD_CYCLE
+        # Check the middle of the walker rather than its feet, which are often below the bottom of the screen.
+        pos = self.node.get_pos(camera)
+        pos.y += self.head_height.y * 0.5
+        if not camera.node().is_in_view(pos):
+            return LOD_FROZEN
+        distance = pos.length()
+        if distance < LOD_FULL_DISTANCE:
+            return LOD_FULL
+        elif distance < LOD_CYCLE_DISTANCE:
+            return LOD_CYCLE
+        return LOD_FROZEN
+
+    def probe(self, rays):
+        self.lod = self.animation_lod()
+        if self.lod == LOD_FULL:
+            self.skeleton.probe()
+        if self.player:
+            self.sights.probe(rays, self.left_barrel_joint, self.right_barrel_joint)
+
     def update(self, dt):
         dt = min(dt, 0.2) # let's just temporarily assume that if we're getting less than 5 fps, dt must be wrong.
+        if self.prediction is not None:
+            self.prediction.record(dt)
+        self.simulate(dt)
+        self.animate(dt)
+
+        if self.energy > WALKER_MIN_CHARGE_ENERGY:
+            if self.left_gun_charge < 1:
+                self.energy -= WALKER_ENERGY_TO_GUN_CHARGE[0]
+                self.left_gun_charge += WALKER_ENERGY_TO_GUN_CHARGE[1]
+            else:
+                self.left_gun_charge = math.floor(self.left_gun_charge)
+
+            if self.right_gun_charge < 1:
+                self.energy -= WALKER_ENERGY_TO_GUN_CHARGE[0]
+                self.right_gun_charge += WALKER_ENERGY_TO_GUN_CHARGE[1]
+            else:
+                self.right_gun_charge = math.floor(self.right_gun_charge)
+
+        if self.energy < 1:
+            self.energy += WALKER_RECHARGE_FACTOR * (dt)
+
+        if self.player:
+            self.sights.update(self.left_barrel_joint, self.right_barrel_joint)
+
+    def animate(self, dt):
+        lod = self.lod
+        if lod == LOD_FROZEN:
+            self.frozen_time += dt
+            if self.frozen_time < FROZEN_POSE_INTERVAL:
+                return
+            dt = self.frozen_time
+        self.frozen_time = 0.0
+        walk = self.movement['forward'] + self.movement['backward']
+
+        # this should return 'on ground' information
+        self.skeleton.update_legs(walk, dt, self.world.scene, self.world.physics, lod)
+        if self.on_ground:
+            self.skeleton.left_leg_on_ground = True
+            self.skeleton.right_leg_on_ground = True
+
+        if self.crouching and self.skeleton.crouch_factor < 1:
+            self.skeleton.crouch_factor = min(self.skeleton.crouch_factor + (dt*60)/10, 1)
+            self.skeleton.update_legs(0, dt, self.world.scene, self.world.physics, lod)
+        elif not self.crouching and self.skeleton.crouch_factor > 0:
+            self.skeleton.crouch_factor = max(self.skeleton.crouch_factor - (dt*60)/10, 0)
+            self.skeleton.update_legs(0, dt, self.world.scene, self.world.physics, lod)
+
+        #if self.crouch_impulse < 0:
+
+    def simulate(self, dt):
+        """
+        Moves the walker by dt seconds of walking, turning, falling and sliding along walls, leaving out animation and
+        everything else that does not affect where it ends up. Prediction replays this for inputs the server has not
+        applied yet.
+        """
         yaw = self.movement['left'] + self.movement['right']
         self.rotate_by(yaw * dt * 60, 0, 0)
         walk = self.movement['forward'] + self.movement['backward']
-        start = self.position()
-        cur_pos_ts = TransformState.make_pos(self.position() + self.head_height)
-
+        node = self.node
+        start = self.start_pos
+        start.set(node.get_x(), node.get_y(), node.get_z())
+        head = self.head_pos
+        head.assign(start)
+        head += self.head_height
+        cur_pos_ts = TransformState.make_pos(head)
+
+        walk_integrator = self.walk_integrator
         if self.on_ground:
-            friction = DEFAULT_FRICTION
+            walk_integrator.friction = DEFAULT_FRICTION
         else:
-            friction = AIR_FRICTION
+            walk_integrator.friction = AIR_FRICTION
 
         #to debug walk cycle (stay in place)
-        #riction = 0
+        #walk_integrator.friction = 0
 
-        speed = walk
-        pos = self.position()
-        self.move_by(0, 0, speed)
-        direction = self.position() - pos
-        newpos, self.xz_velocity = Friction(direction, friction).integrate(pos, self.xz_velocity, dt)
+        # Walk forward (along our own z axis), relative to the scene.
+        self.walk_vector.set(0, 0, walk)
+        walk_integrator.accel = self.world.scene.get_relative_vector(self.node, self.walk_vector)
+        newpos = self.walk_pos
+        walk_integrator.integrate_into(start, self.xz_velocity, dt, newpos, self.xz_velocity)
         self.move(newpos)
 
         # Cast a ray from just above our feet to just below them, see if anything hits.
-        pt_from = self.position() + Vec3(0, 1, 0)
-        pt_to = pt_from + Vec3(0, -1.1, 0)
-        result = self.world.physics.ray_test_closest(pt_from, pt_to, MAP_COLLIDE_BIT | SOLID_COLLIDE_BIT)
-
-        # this should return 'on ground' information
-        self.skeleton.update_legs(walk, dt, self.world.scene, self.world.physics)
+        pt_from = self.ray_from
+        pt_from.assign(newpos)
+        pt_from += FOOT_RAY_OFFSET
+        pt_to = self.ray_to
+        pt_to.assign(pt_from)
+        pt_to += FOOT_RAY
+        result = self.world.rays.closest(pt_from, pt_to, MAP_COLLIDE_BIT | SOLID_COLLIDE_BIT)
 
         if self.y_velocity.get_y() <= 0 and result.has_hit():
             self.on_ground = True
             self.crouch_impulse = self.y_velocity.y
-            self.y_velocity = Vec3(0, 0, 0)
+            self.y_velocity.set(0, 0, 0)
             self.move(result.get_hit_pos())
-            self.skeleton.left_leg_on_ground = True
-            self.skeleton.right_leg_on_ground = True
         else:
             self.on_ground = False
-            current_y = Point3(0, self.position().get_y(), 0)
-            y, self.y_velocity = self.integrator.integrate(current_y, self.y_velocity, dt)
-            self.move(self.position() + (y - current_y))
-
-        if self.crouching and self.skeleton.crouch_factor < 1:
-            self.skeleton.crouch_factor += (dt*60)/10
-            self.skeleton.update_legs(0, dt, self.world.scene, self.world.physics)
-        elif not self.crouching and self.skeleton.crouch_factor > 0:
-            self.skeleton.crouch_factor -= (dt*60)/10
-            self.skeleton.update_legs(0, dt, self.world.scene, self.world.physics)
-
-        #if self.crouch_impulse < 0:
-
-        goal = self.position()
-        adj_dist = abs((start - goal).length())
-        new_pos_ts = TransformState.make_pos(self.position() + self.head_height)
+            current_y = self.fall_pos
+            current_y.set(0, newpos.get_y(), 0)
+            self.integrator.integrate_into(current_y, self.y_velocity, dt, current_y, self.y_velocity)
+            newpos.set_y(current_y.get_y())
+            self.move(newpos)
+
+        goal = self.goal_pos
+        goal.set(node.get_x(), node.get_y(), node.get_z())
+        head.assign(goal)
+        head += self.head_height
+        new_pos_ts = TransformState.make_pos(head)
+        goal -= start
+        adj_dist = goal.length()
 
         sweep_result = self.st_result(cur_pos_ts, new_pos_ts)
         count = 0
@@ -652,31 +970,11 @@ class Walker (PhysicalObject):
             self.xz_velocity = -self.xz_velocity.cross(moveby).cross(moveby)
             moveby.normalize()
             moveby *= adj_dist * (1 - sweep_result.get_hit_fraction())
-            self.move(self.position() + moveby)
-            new_pos_ts = TransformState.make_pos(self.position() + self.head_height)
+            pos = self.position()
+            pos += moveby
+            self.move(pos)
+            head.assign(pos)
+            head += self.head_height
+            new_pos_ts = TransformState.make_pos(head)
             sweep_result = self.st_result(cur_pos_ts, new_pos_ts)
             count += 1
-
-        if self.energy > WALKER_MIN_CHARGE_ENERGY:
-            if self.left_gun_charge < 1:
-                self.energy -= WALKER_ENERGY_TO_GUN_CHARGE[0]
-                self.left_gun_charge += WALKER_ENERGY_TO_GUN_CHARGE[1]
-            else:
-                self.left_gun_charge = math.floor(self.left_gun_charge)
-
-            if self.right_gun_charge < 1:
-                self.energy -= WALKER_ENERGY_TO_GUN_CHARGE[0]
-                self.right_gun_charge += WALKER_ENERGY_TO_GUN_CHARGE[1]
-            else:
-                self.right_gun_charge = math.floor(self.right_gun_charge)
-
-        if self.energy < 1:
-            self.energy += WALKER_RECHARGE_FACTOR * (dt)
-
-        if self.player:
-            self.sights.update(self.left_barrel_joint, self.right_barrel_joint)
-
-
-
-
-
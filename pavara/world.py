@@ -1,7 +1,12 @@
 from pavara.constants import *
 from pavara.utils.integrator import Integrator, Friction
+from pavara.entities import EntityStore
 from pavara.base_objects import *
-from pavara.map_objects import Sky, Dome
+from pavara.map_objects import Sky, Dome, celestial_samples
+from pavara.collisions import CollisionDispatcher, RayQueries
+from pavara.snapshots import SnapshotBuffer
+from pavara.effects import DebrisPool
+from pavara.profiler import get_profiler
 from pavara.utils.geom import to_cartesian
 from panda3d.core import AmbientLight, DirectionalLight, VBase4, Vec3, TransparencyAttrib, CompassEffect, NodePath
 from panda3d.bullet import BulletDebugNode, BulletWorld, BulletGhostNode, BulletSphereShape, BulletRigidBodyNode
@@ -15,14 +20,15 @@ class World (object):
     """
 
     def __init__(self, camera, debug=False, audio3d=None, client=None, server=None):
+        self.camera = camera
+        self.audio3d = audio3d
         self.objects = {}
 
         self.incarnators = []
 
-        self.collidables = set()
-
-        self.updatables = set()
-        self.updatables_to_add = set()
+        # Every attached object by entity ID, and the systems (updates, collisions, ...) they take part in.
+        self.entities = EntityStore()
+        self.updaters_to_add = []
         self.garbage = set()
         self.scene = NodePath('world')
 
@@ -31,6 +37,9 @@ class World (object):
         self.gravity = DEFAULT_GRAVITY
         self.physics = BulletWorld()
         self.physics.set_gravity(self.gravity)
+        self.collisions = CollisionDispatcher(self)
+        self.rays = RayQueries(self)
+        self.profiler = get_profiler()
 
         self.debug = debug
 
@@ -44,6 +53,7 @@ class World (object):
             np.show()
             self.physics.set_debug_node(debug_node)
 
+        self.debris = self.attach(DebrisPool())
 
     def get_incarn(self):
         return random.choice(self.incarnators)
@@ -53,6 +63,7 @@ class World (object):
         assert hasattr(obj, 'world') and hasattr(obj, 'name')
         assert obj.name not in self.objects
         obj.world = self
+        self.entities.add(obj)
         if obj.name.startswith('Incarnator'):
             self.incarnators.append(obj)
         if hasattr(obj, 'create_node') and hasattr(obj, 'create_solid'):
@@ -75,9 +86,12 @@ class World (object):
                     obj.node.reparent_to(self.scene)
             elif obj.solid:
                 obj.node = self.scene.attach_new_node(obj.solid)
+            if obj.solid:
+                self.entities.tag(obj.solid, obj, obj.category)
             if obj.solid and obj.collide_bits is not None:
                 obj.solid.set_into_collide_mask(obj.collide_bits)
         self.objects[obj.name] = obj
+        self.profiler.count('attached')
         # Let the object know it has been attached.
         obj.attached()
         return obj
@@ -90,28 +104,77 @@ class World (object):
         h.move((0, 15, 0))
         return h
 
+    def register_collider(self, obj):
+        assert isinstance(obj, PhysicalObject)
+        self.entities.colliders.add(obj)
+
+    def contacts(self, obj):
+        """
+        Returns the Contacts the given collidable object was involved in during the last physics step.
+        """
+        return self.collisions.contacts_for(obj)
+
     def register_updater(self, obj):
         assert isinstance(obj, WorldObject)
-        self.updatables.add(obj)
+        self.entities.updaters.add(obj)
+
+    def register_probe(self, obj):
+        """
+        Registers an object whose probe(rays) method submits the ray queries it needs each tick, to be resolved
+        together before updates.
+        """
+        assert isinstance(obj, WorldObject)
+        self.entities.probes.add(obj)
 
     def register_updater_later(self, obj):
         assert isinstance(obj, WorldObject)
-        self.updatables_to_add.add(obj)
+        self.updaters_to_add.append(obj)
 
 
 
     def update(self, task):
         """
-        Called every frame to update the physics, etc.
+        Task wrapper around step, advancing the world by the frame time. Used when the world is driven by the
+        Panda3D task manager (i.e. on clients). Headless servers should use a pavara.simulation.Simulation instead.
+        """
+        self.step(globalClock.getDt())
+        return task.cont
+
+    def step(self, dt):
+        """
+        Advances the world by dt seconds: integrates bodies, resolves the rays probes ask for, updates all updaters,
+        ages everything with a lifetime, collects garbage, and steps the physics.
         """
-        dt = globalClock.getDt()
-        for obj in self.updatables_to_add:
-            self.updatables.add(obj)
-        self.updatables_to_add = set()
-        for obj in self.updatables:
-            obj.update(dt)
-        self.updatables -= self.garbage
-        self.collidables -= self.garbage
+        profiler = self.profiler
+        entities = self.entities
+        updaters = entities.updaters
+        for obj in self.updaters_to_add:
+            updaters.add(obj)
+        self.updaters_to_add = []
+        profiler.begin('World:Integrate')
+        entities.bodies.step(dt)
+        profiler.end('World:Integrate')
+        profiler.begin('World:Rays')
+        rays = self.rays
+        rays.clear()
+        for obj in entities.probes.members:
+            obj.probe(rays)
+        rays.resolve()
+        profiler.end('World:Rays')
+        # Anything that starts updating during this loop is appended, and first updated next tick.
+        members = updaters.members
+        if profiler.enabled:
+            for i in xrange(len(members)):
+                obj = members[i]
+                name = 'World:Update:%s' % obj.__class__.__name__
+                profiler.begin(name)
+                obj.update(dt)
+                profiler.end(name)
+        else:
+            for i in xrange(len(members)):
+                members[i].update(dt)
+        entities.lifetimes.step(dt)
+        profiler.begin('World:Garbage')
         while True:
             if len(self.garbage) < 1:
                 break;
@@ -123,59 +186,62 @@ class World (object):
             if hasattr(trash, 'dead'):
                 trash.dead()
             trash.node.remove_node()
+            self.objects.pop(trash.name, None)
+            entities.remove(trash)
+            profiler.count('removed')
             del(trash)
+        profiler.end('World:Garbage')
+        profiler.begin('World:Physics')
         self.physics.do_physics(dt)
-        for obj in self.collidables:
-            result = self.physics.contact_test(obj.node.node())
-            for contact in result.get_contacts():
-                obj1 = self.objects.get(contact.get_node0().get_name())
-                obj2 = self.objects.get(contact.get_node1().get_name())
-                if obj1 and obj2:
-                    # Check the collision bits to see if the two objects should collide.
-                    should_collide = obj1.collide_bits & obj2.collide_bits
-                    if not should_collide.is_zero():
-                        pt = contact.get_manifold_point()
-                        if obj1 in self.collidables:
-                            obj1.collision(obj2, pt, True)
-                        if obj2 in self.collidables:
-                            obj2.collision(obj1, pt, False)
-        return task.cont
+        profiler.end('World:Physics')
+        profiler.begin('World:Collisions')
+        self.collisions.dispatch()
+        profiler.end('World:Collisions')
+        profiler.end_frame()
 
 class ServerWorld(World):
     """
     The server's view of the world, sans any purely visual information.
     """
     def __init__(self, debug=False):
-        super(ServerWorld, self).__init__(debug)
+        super(ServerWorld, self).__init__(None, debug)
+        # Maps still talk to the sky, so give them one; without a camera it is just an empty node.
+        self.sky = self.attach(Sky())
+
+    def set_ambient(self, color):
+        pass
 
+    def create_celestial_node(self):
+        pass
 
+    def add_celestial(self, azimuth, elevation, color, intensity, radius, visible):
+        pass
 
-    def register_collider(self, obj):
-        assert isinstance(obj, PhysicalObject)
-        self.collidables.add(obj)
+    def add_starfield(self, starfield):
+        pass
 
     def do_explosion(self, node, radius, force):
         center = node.get_pos(self.scene);
         expl_body = BulletGhostNode("expl")
+        self.entities.tag(expl_body, None, CATEGORY_EXPLOSION)
         expl_shape = BulletSphereShape(radius)
         expl_body.add_shape(expl_shape)
         expl_bodyNP = self.scene.attach_new_node(expl_body)
         expl_bodyNP.set_pos(center)
         self.physics.attach_ghost(expl_body)
         result = self.physics.contact_test(expl_body)
+        self.profiler.count('contact_tests')
         for contact in result.getContacts():
-            n0_name = contact.getNode0().get_name()
-            n1_name = contact.getNode1().get_name()
-            obj = None
-            try:
-                obj = self.objects[n1_name]
-            except:
-                break
-            if n0_name == "expl" and n1_name not in EXPLOSIONS_DONT_PUSH and not n1_name.startswith('Walker'):
+            source, category0 = self.entities.lookup(contact.getNode0())
+            obj, category1 = self.entities.lookup(contact.getNode1())
+            if obj is None:
+                continue
+            if category0 & CATEGORY_EXPLOSION and not category1 & EXPLOSIONS_DONT_PUSH:
                 # repeat contact test with just this pair of objects
                 # otherwise all manifold point values will be the same
                 # for all objects in original result
                 real_c = self.physics.contact_test_pair(expl_body, obj.solid)
+                self.profiler.count('contact_tests')
                 mpoint = real_c.getContacts()[0].getManifoldPoint()
                 distance = mpoint.getDistance()
                 if distance < 0:
@@ -194,14 +260,11 @@ class ServerWorld(World):
         del(expl_body, expl_bodyNP)
 
 
-    def do_plasma_push(self, plasma, node, energy):
-        obj = None
-        try:
-            obj = self.objects[node]
-        except:
-            raise
+    def do_plasma_push(self, plasma, obj, category, energy):
+        if obj is None:
+            return
 
-        if node not in EXPLOSIONS_DONT_PUSH and not node.startswith('Walker'):
+        if not category & EXPLOSIONS_DONT_PUSH:
             if hasattr(obj, 'decompose'):
                 obj.decompose()
             else:
@@ -209,7 +272,7 @@ class ServerWorld(World):
                 dummy_node = NodePath('tmp')
                 dummy_node.set_hpr(plasma.hpr)
                 dummy_node.set_pos(plasma.pos)
-                f_vec = scene.get_relative_vector(dummy_node, Vec3(0,0,1))
+                f_vec = self.scene.get_relative_vector(dummy_node, Vec3(0,0,1))
                 local_point = (obj.node.get_pos() - dummy_node.get_pos()) *-1
                 f_vec.normalize()
                 solid.set_active(True)
@@ -228,12 +291,13 @@ class ClientWorld(World):
     Leaves most physics and game logic to the server to dictate.
     """
     def __init__(self, camera, debug=False, audio3d=False):
-        super(ClientWorld, self).__init__(debug)
-        self.camera = camera
-        self.audio3d = audio3d
+        super(ClientWorld, self).__init__(camera, debug, audio3d)
         self.ambient = self._make_ambient()
         self.celestials = CompositeObject()
+        self.starfields = []
         self.sky = self.attach(Sky())
+        # Snapshots from the server, buffered so remote objects can be drawn between them.
+        self.snapshots = SnapshotBuffer()
 
     def _make_ambient(self):
         alight = AmbientLight('ambient')
@@ -256,12 +320,11 @@ class ClientWorld(World):
         self.celestials.set_effect(CompassEffect.make(self.camera, CompassEffect.PPos))
         self.celestials.node().set_bounds(bounds)
         self.celestials.node().set_final(True)
+        for starfield in self.starfields:
+            self.celestials.attach_new_node(starfield.get_geom_node())
         self.celestials.reparent_to(self.scene)
 
-    def register_collider(self, obj):
-        pass
-
-    def do_plasma_push(self, plasma, node, energy):
+    def do_plasma_push(self, plasma, obj, category, energy):
         pass
 
     def do_explosion(self, node, radius, force):
@@ -282,12 +345,14 @@ class ClientWorld(World):
             node.look_at(*(location * -1))
             self.scene.set_light(node)
         if visible:
-            if radius <= 2.0:
-                samples = 6
-            elif radius >= 36.0:
-                samples = 40
-            else:
-                samples = int(round(((1.5 * radius) * (2 / 3.0)) + 3.75))
-            celestial = Dome(radius * 1.5, samples, 2, color, 0, location,
+            celestial = Dome(radius * 1.5, celestial_samples(radius), 2, color, 0, location,
                 ((-(math.degrees(azimuth))), 90 + math.degrees(elevation), 0))
-            self.celestials.attach(celestial)
\ No newline at end of file
+            self.celestials.attach(celestial)
+
+    def add_starfield(self, starfield):
+        """
+        Adds a Starfield to the sky. Like visible celestials, it is drawn once create_celestial_node is called.
+        """
+        if not self.camera:
+            return
+        self.starfields.append(starfield)
\ No newline at end of file